@@ -1,13 +1,32 @@
+import datetime
 import os
+import secrets
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+import click
+from flask import Flask, render_template, request, flash, redirect, session, g, jsonify
+from flask_wtf.csrf import validate_csrf
+from flask_migrate import Migrate
+from sqlalchemy import delete, exists, func, select, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import HTTPException
+from wtforms import ValidationError
 
 
 from forms import UserAddForm, LoginForm, MessageForm, CSFROnly, UpdateUserForm
-from models import db, connect_db, User, Message, bcrypt, Like
+from models import db, connect_db, User, Message, Like, LikeRequest, Follows
+from pagination import paginate
+import cache
+import dbpool
+import metrics
+import passwords
+import replicas
+import search
+import sessions
+import suggestions
+import timeline
+import tombstones
 
 load_dotenv()
 
@@ -25,9 +44,139 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-toolbar = DebugToolbarExtension(app)
+
+# Connection pool per worker process, statement timeout (ms, 0 for none)
+# and pgbouncer transaction pooling mode -- see dbpool.py
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 5))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+app.config['DB_STATEMENT_TIMEOUT'] = int(
+    os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+app.config['DB_PGBOUNCER'] = os.environ.get('DB_PGBOUNCER', '') == '1'
+
+# Read replicas for GET requests (comma-separated URLs), how long a user
+# reads from the primary after writing, and when a replica is too far behind
+# to use -- see replicas.py
+app.config['DATABASE_REPLICA_URLS'] = [
+    url.strip().replace("postgres://", "postgresql://")
+    for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    if url.strip()]
+app.config['REPLICA_STICKY_SECONDS'] = float(
+    os.environ.get('REPLICA_STICKY_SECONDS', 10))
+app.config['REPLICA_MAX_LAG'] = float(os.environ.get('REPLICA_MAX_LAG', 5))
+app.config['REPLICA_CHECK_INTERVAL'] = float(
+    os.environ.get('REPLICA_CHECK_INTERVAL', 5))
+
+# Home timeline strategy: "read" (query on every view), "write" (precomputed
+# per-user timelines) or "hybrid" (precomputed, except for accounts with at
+# least TIMELINE_CELEBRITY_FOLLOWERS followers) -- see timeline.py
+app.config['TIMELINE_MODE'] = os.environ.get('TIMELINE_MODE', 'read')
+app.config['TIMELINE_CELEBRITY_FOLLOWERS'] = int(
+    os.environ.get('TIMELINE_CELEBRITY_FOLLOWERS', 10000))
+# Newest messages of each account copied into a timeline on follow (and
+# by `flask timeline-worker` when an account stops being a celebrity)
+app.config['TIMELINE_BACKFILL_MESSAGES'] = int(
+    os.environ.get('TIMELINE_BACKFILL_MESSAGES', 200))
+
+# "Who to follow": suggestions kept per user, shown on the home page, and
+# follows read per user by `flask rebuild-suggestions` -- see suggestions.py
+app.config['SUGGESTIONS_TOP_K'] = int(os.environ.get('SUGGESTIONS_TOP_K', 20))
+app.config['SUGGESTIONS_SHOWN'] = int(os.environ.get('SUGGESTIONS_SHOWN', 5))
+app.config['SUGGESTIONS_MAX_SCAN'] = int(
+    os.environ.get('SUGGESTIONS_MAX_SCAN', 100000))
+
+# Number of rows per page on paginated lists (see pagination.py)
+app.config['PAGE_SIZE'] = int(os.environ.get('PAGE_SIZE', 50))
+
+# How long like toggles' idempotency keys are kept, in seconds (prune them
+# with `flask prune-like-requests`)
+app.config['IDEMPOTENCY_KEY_TTL'] = int(
+    os.environ.get('IDEMPOTENCY_KEY_TTL', 24 * 60 * 60))
+
+# Soft-delete messages (hide them, and delete them later in batches with
+# `flask compact-messages`) rather than deleting them straight away -- see
+# tombstones.py
+app.config['MESSAGE_SOFT_DELETE'] = (
+    os.environ.get('MESSAGE_SOFT_DELETE', '') == '1')
+app.config['MESSAGE_COMPACT_BATCH'] = int(
+    os.environ.get('MESSAGE_COMPACT_BATCH', 10000))
+
+# Most ids one batch like/follow request (/api/likes, /api/follows) can list
+app.config['API_BATCH_LIMIT'] = int(os.environ.get('API_BATCH_LIMIT', 500))
+
+# Username search: "trigram" (pg_trgm), "ngram" (in-process index, rebuilt
+# every USER_SEARCH_REFRESH seconds) or "auto" -- see search.py
+app.config['USER_SEARCH_BACKEND'] = os.environ.get(
+    'USER_SEARCH_BACKEND', 'auto')
+app.config['USER_SEARCH_REFRESH'] = int(
+    os.environ.get('USER_SEARCH_REFRESH', 300))
+
+# Text search configuration for message full-text search
+app.config['MESSAGE_SEARCH_LANGUAGE'] = os.environ.get(
+    'MESSAGE_SEARCH_LANGUAGE', 'english')
+
+# Where sessions live: "cookie" (Flask's signed cookie), "memory" (per
+# process) or "sqlite" (SESSION_SQLITE_PATH, shared by local workers and
+# created private to the app's user), and how often expired ones are
+# deleted -- see sessions.py
+app.config['SESSION_BACKEND'] = os.environ.get('SESSION_BACKEND', 'cookie')
+app.config['SESSION_SQLITE_PATH'] = os.environ.get(
+    'SESSION_SQLITE_PATH', '/tmp/warbler-sessions.sqlite3')
+app.config['SESSION_SWEEP_INTERVAL'] = int(
+    os.environ.get('SESSION_SWEEP_INTERVAL', 300))
+
+# Cache for logged-in users (and other shared values): "memory" (per-process
+# LRU) or "socket" (shared by local workers; run `flask cache-server` as the
+# app's user, which makes CACHE_SOCKET private to it -- see cache.py)
+app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'memory')
+app.config['CACHE_SOCKET'] = os.environ.get(
+    'CACHE_SOCKET', '/tmp/warbler-cache.sock')
+app.config['CACHE_MAX_ENTRIES'] = int(
+    os.environ.get('CACHE_MAX_ENTRIES', 10000))
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 300))
+
+# Rendered message list items, keyed by author profile version
+app.config['MESSAGE_CARD_CACHE_TTL'] = int(
+    os.environ.get('MESSAGE_CARD_CACHE_TTL', 86400))
+
+# Password hashing: bcrypt work factor, hashing processes per web worker
+# (0 = inline on the request thread; by default the CPUs split between the
+# WEB_CONCURRENCY workers), and how many hashes may queue before we answer
+# 503 -- see passwords.py
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get(
+    'PASSWORD_HASH_WORKERS',
+    passwords.default_workers(int(os.environ.get('WEB_CONCURRENCY', 1)))))
+app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get(
+    'PASSWORD_HASH_QUEUE', 4 * app.config['PASSWORD_HASH_WORKERS'] or 1))
+app.config['PASSWORD_HASH_TIMEOUT'] = float(
+    os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+
+# Request metrics at /metrics, and one JSON log line per request if
+# METRICS_LOG is set -- see metrics.py
+app.config['METRICS_LOG'] = os.environ.get('METRICS_LOG', '') == '1'
+
+# The debug toolbar is only loaded when asked for (DEBUG_TOOLBAR=1)
+app.config['DEBUG_TOOLBAR'] = os.environ.get('DEBUG_TOOLBAR', '') == '1'
+
+if app.config['DEBUG_TOOLBAR']:
+    from flask_debugtoolbar import DebugToolbarExtension
+    toolbar = DebugToolbarExtension(app)
+
+metrics.init_metrics(app)
 
 connect_db(app)
+replicas.init_replicas(app)
+
+# schema changes are Alembic migrations in migrations/; `flask db upgrade`
+migrate = Migrate(
+    app, db, directory=os.path.join(os.path.dirname(__file__), 'migrations'))
+
+cache.init_cache(app)
+passwords.init_app(app)
+sessions.init_sessions(app, CURR_USER_KEY)
 
 
 ##############################################################################
@@ -39,8 +188,13 @@ def add_user_to_g():
     """If we're logged in, add curr user to Flask global.
     Adds global csfr_form"""
 
+    if request.endpoint == 'static':
+        return
+
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = cache.load_user(
+            session[CURR_USER_KEY],
+            session if sessions.is_server_side(app) else None)
         g.csrf_form = CSFROnly()
 
     else:
@@ -51,6 +205,7 @@ def add_user_to_g():
 def do_login(user):
     """Log in user."""
 
+    sessions.regenerate(session)
     session[CURR_USER_KEY] = user.id
 
 
@@ -60,6 +215,8 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+    session.pop(cache.USER_SNAPSHOT_KEY, None)
+
 
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
@@ -91,6 +248,7 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        search.user_changed(user)
         do_login(user)
 
         return redirect("/")
@@ -111,6 +269,8 @@ def login():
             form.password.data)
 
         if user:
+            # authenticate may have upgraded the stored hash
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -136,41 +296,277 @@ def logout():
 
 
 
+##############################################################################
+# Follows and likes (shared by the pages and the JSON API)
+
+
+def follow_users(user, user_ids):
+    """Make `user` follow the users in `user_ids` they don't already, in one
+    INSERT, then update counters, timelines and suggestions for those.
+
+    Ids of users that don't exist are skipped. Returns the set of ids newly
+    followed.
+    """
+
+    if not user_ids:
+        return set()
+
+    followed = set(db.session.scalars(
+        insert(Follows.__table__)
+        .from_select(
+            ["user_being_followed_id", "user_following_id"],
+            select(User.id, db.literal(user.id))
+            .where(User.id.in_(user_ids)))
+        .on_conflict_do_nothing()
+        .returning(Follows.user_being_followed_id)))
+
+    if followed:
+        User.update_counts(User.id == user.id, following_count=len(followed))
+        User.update_counts(User.id.in_(followed), followers_count=1)
+        timeline.backfill(user.id, followed)
+        suggestions.enqueue(user.id, followed)
+
+    return followed
+
+
+def unfollow_users(user, user_ids):
+    """Make `user` stop following the users in `user_ids`, in one DELETE;
+    returns the set of ids they had been following."""
+
+    if not user_ids:
+        return set()
+
+    unfollowed = set(db.session.scalars(
+        delete(Follows.__table__)
+        .where(Follows.user_following_id == user.id,
+               Follows.user_being_followed_id.in_(user_ids))
+        .returning(Follows.user_being_followed_id)))
+
+    if unfollowed:
+        User.update_counts(
+            User.id == user.id, following_count=-len(unfollowed))
+        User.update_counts(User.id.in_(unfollowed), followers_count=-1)
+        timeline.prune(user.id, unfollowed)
+        timeline.queue_demotions(unfollowed)
+        suggestions.enqueue(user.id, unfollowed)
+
+    return unfollowed
+
+
+def like_messages(user, message_ids):
+    """Record that `user` likes the messages in `message_ids`, in one
+    INSERT; returns the set of ids newly liked (not ones already liked or
+    that don't exist)."""
+
+    if not message_ids:
+        return set()
+
+    liked = set(db.session.scalars(
+        insert(Like.__table__)
+        .from_select(
+            ["user_id", "message_id"],
+            select(db.literal(user.id), Message.id)
+            .where(Message.id.in_(message_ids),
+                   Message.deleted_at.is_(None)))
+        .on_conflict_do_nothing()
+        .returning(Like.message_id)))
+
+    if liked:
+        User.update_counts(User.id == user.id, likes_count=len(liked))
+
+    return liked
+
+
+def unlike_messages(user, message_ids):
+    """Remove `user`'s likes of the messages in `message_ids`, in one
+    DELETE; returns the set of ids that had been liked."""
+
+    if not message_ids:
+        return set()
+
+    unliked = set(db.session.scalars(
+        delete(Like.__table__)
+        .where(Like.user_id == user.id, Like.message_id.in_(message_ids))
+        .returning(Like.message_id)))
+
+    if unliked:
+        User.update_counts(User.id == user.id, likes_count=-len(unliked))
+
+    return unliked
+
+
+def toggle_like(user, message_id, key=None):
+    """Like a message if `user` doesn't, or unlike it if they do, in one
+    statement (with the likes counter); returns whether they like it now.
+
+    With an idempotency `key`, a repeat of the same request (a double click,
+    a retry) changes nothing and returns the first one's answer, even if
+    both arrive at once: the second waits on the first's row in
+    like_requests and then skips the toggle.
+    """
+
+    likes = Like.__table__
+    users = User.__table__
+    was_liked = (exists()
+                 .where(likes.c.user_id == user.id,
+                        likes.c.message_id == message_id))
+
+    if key is None:
+        wanted = select((~was_liked).label("liked")).cte("wanted")
+    else:
+        wanted = (insert(LikeRequest.__table__)
+                  .from_select(
+                      ["user_id", "key", "message_id", "liked"],
+                      select(db.literal(user.id), db.literal(key),
+                             db.literal(message_id), ~was_liked))
+                  .on_conflict_do_nothing()
+                  .returning(LikeRequest.liked)
+                  .cte("wanted"))
+
+    removed = (delete(likes)
+               .where(likes.c.user_id == user.id,
+                      likes.c.message_id == message_id,
+                      exists().where(~wanted.c.liked))
+               .returning(likes.c.message_id)
+               .cte("removed"))
+
+    added = (insert(likes)
+             .from_select(
+                 ["user_id", "message_id"],
+                 select(db.literal(user.id), Message.id)
+                 .where(Message.id == message_id,
+                        Message.deleted_at.is_(None),
+                        exists().where(wanted.c.liked)))
+             .on_conflict_do_nothing()
+             .returning(likes.c.message_id)
+             .cte("added"))
+
+    change = (select(func.count()).select_from(added).scalar_subquery()
+              - select(func.count()).select_from(removed).scalar_subquery())
+
+    counted = (update(users)
+               .where(users.c.id == user.id, change != 0)
+               .values(likes_count=users.c.likes_count + change)
+               .returning(users.c.id)
+               .cte("counted"))
+
+    # counted is selected from only so that it's part of the statement
+    liked, _ = db.session.execute(select(
+        select(wanted.c.liked).scalar_subquery(),
+        select(func.count()).select_from(counted).scalar_subquery(),
+    )).one()
+
+    if liked is None:
+        # a repeat: answer as the first request did
+        liked = db.session.scalar(
+            select(LikeRequest.liked)
+            .where(LikeRequest.user_id == user.id, LikeRequest.key == key))
+
+    return liked
+
+
+def request_idempotency_key():
+    """The idempotency key a form or API client sent, if any."""
+
+    key = (request.form.get("idempotency_key")
+           or request.headers.get("Idempotency-Key"))
+
+    return key if key and len(key) <= 64 else None
+
+
+@app.template_global()
+def idempotency_key():
+    """A fresh key for a toggle form, so submitting it twice toggles once."""
+
+    return secrets.token_urlsafe(16)
+
+
+def follow_user(user, followed_user):
+    """Make `user` follow `followed_user`; returns False, changing nothing,
+    if they already follow them."""
+
+    return bool(follow_users(user, [followed_user.id]))
+
+
+def unfollow_user(user, followed_user):
+    """Make `user` stop following `followed_user`; returns False if they
+    weren't."""
+
+    return bool(unfollow_users(user, [followed_user.id]))
+
+
+def like_message(user, message_id):
+    """Record that `user` likes a message; returns False if they already
+    did."""
+
+    return bool(like_messages(user, [message_id]))
+
+
+def unlike_message(user, message_id):
+    """Remove `user`'s like of a message; returns False if there was none."""
+
+    return bool(unlike_messages(user, [message_id]))
+
+
 ##############################################################################
 # General user routes:
 
+def user_cursor(user):
+    """Keyset pagination values for a user: (id,)."""
+
+    return (user.id,)
+
+
 @app.get('/users')
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and
+    'before'/'after' cursors to page through the results.
     """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    search = request.args.get('q')
+    query = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
+    if not query:
+        page = paginate(User.query, (User.id,), user_cursor)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = search.search_users(query)
 
-    return render_template('users/index.html', users=users)
+    following_ids = g.user.following_ids_among([user.id for user in page])
+
+    return render_template(
+        'users/index.html',
+        users=page.items,
+        page=page,
+        following_ids=following_ids)
 
 
 @app.get('/users/<int:user_id>')
 def show_user(user_id):
-    """Show user profile."""
+    """Show user profile, with a page of their messages."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
+    page = paginate(
+        Message.query.filter(Message.user_id == user.id),
+        (Message.timestamp, Message.id),
+        timeline.message_cursor)
+    liked_ids = g.user.liked_message_ids([msg.id for msg in page])
 
-    return render_template('users/show.html', user=user)
+    return render_template(
+        'users/show.html',
+        user=user,
+        messages=page.items,
+        cards=cache.message_cards(page.items),
+        page=page,
+        liked_ids=liked_ids)
 
 
 @app.get('/users/<int:user_id>/following')
@@ -182,7 +578,19 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    page = paginate(
+        User.query.join(Follows, Follows.user_being_followed_id == User.id)
+        .filter(Follows.user_following_id == user.id),
+        (User.id,),
+        user_cursor)
+    following_ids = g.user.following_ids_among([user.id for user in page])
+
+    return render_template(
+        'users/following.html',
+        user=user,
+        users=page.items,
+        page=page,
+        following_ids=following_ids)
 
 
 @app.get('/users/<int:user_id>/followers')
@@ -194,7 +602,19 @@ def show_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    page = paginate(
+        User.query.join(Follows, Follows.user_following_id == User.id)
+        .filter(Follows.user_being_followed_id == user.id),
+        (User.id,),
+        user_cursor)
+    following_ids = g.user.following_ids_among([user.id for user in page])
+
+    return render_template(
+        'users/followers.html',
+        user=user,
+        users=page.items,
+        page=page,
+        following_ids=following_ids)
 
 
 @app.post('/users/follow/<int:follow_id>')
@@ -209,7 +629,7 @@ def start_following(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    follow_user(g.user, followed_user)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -226,8 +646,8 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    followed_user = User.query.get_or_404(follow_id)
+    unfollow_user(g.user, followed_user)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -247,8 +667,12 @@ def profile():
         g.user.bio = form.bio.data
 
         input_password = form.password.data
-        if bcrypt.check_password_hash(g.user.password, input_password):
+        if passwords.check_password(g.user.password, input_password):
+            # new cache keys for this user's rendered messages
+            g.user.profile_version = User.profile_version + 1
             db.session.commit()
+            cache.invalidate_user(g.user.id)
+            search.user_changed(g.user)
             return redirect(f'/users/{g.user.id}')
         else:
             flash('wrong password')
@@ -256,6 +680,40 @@ def profile():
     else:
         return render_template('/users/edit.html', form=form)
 
+def delete_account(user):
+    """Delete `user` with everything of theirs, in a few statements however
+    much they've posted.
+
+    Their messages, follows and likes (and the likes and timeline entries
+    of their messages) go by the database's ON DELETE CASCADE, without being
+    loaded. The counters those rows contributed to are fixed up first, with
+    one UPDATE each.
+    """
+
+    followed = (select(Follows.user_being_followed_id)
+                .where(Follows.user_following_id == user.id))
+    User.update_counts(User.id.in_(followed), followers_count=-1)
+    timeline.queue_demotions(followed)
+    User.update_counts(
+        User.id.in_(
+            select(Follows.user_following_id)
+            .where(Follows.user_being_followed_id == user.id)),
+        following_count=-1)
+
+    likers = (select(Like.user_id, func.count().label("likes"))
+              .join(Message, Message.id == Like.message_id)
+              .where(Message.user_id == user.id,
+                     Like.user_id != user.id)
+              .group_by(Like.user_id)
+              .subquery())
+    db.session.execute(
+        update(User.__table__)
+        .where(User.id == likers.c.user_id)
+        .values(likes_count=User.likes_count - likers.c.likes))
+
+    db.session.delete(user)
+
+
 @app.post('/users/delete')
 def delete_user():
     """Delete user.
@@ -268,8 +726,12 @@ def delete_user():
         return redirect("/")
 
     if g.csrf_form.validate_on_submit():
-        db.session.delete(g.user)
+        user_id = g.user.id
+        delete_account(g.user)
         db.session.commit()
+        cache.invalidate_user(user_id)
+        search.user_deleted(user_id)
+        sessions.revoke_user(app, user_id)
         do_logout()
         return redirect("/signup")
 
@@ -281,9 +743,22 @@ def show_likes(user_id):
     """Display messages that user liked"""
 
     user = User.query.get_or_404(user_id)
-    messages = user.likes
-
-    return render_template('/users/likes.html', messages=messages, user=user)
+    page = paginate(
+        Message.query.options(db.selectinload(Message.user))
+        .join(Like, Like.message_id == Message.id)
+        .filter(Like.user_id == user.id),
+        (Message.timestamp, Message.id),
+        timeline.message_cursor)
+    liked_ids = (g.user.liked_message_ids([msg.id for msg in page])
+                 if g.user else set())
+
+    return render_template(
+        '/users/likes.html',
+        messages=page.items,
+        cards=cache.message_cards(page.items),
+        user=user,
+        page=page,
+        liked_ids=liked_ids)
 
 
 @app.post('/users/<int:user_id>/<int:msg_id>/likes')
@@ -294,19 +769,12 @@ def handle_like_msg(user_id,msg_id):
     message = Message.query.get_or_404(msg_id)
 
     if g.csrf_form.validate_on_submit():
-        if message not in g.user.likes:
-            new_fav = Like(user_id = g.user.id, message_id = message.id)
-            #can do g.user.append(message)
-            db.session.add(new_fav)
-            db.session.commit()
+        liked = toggle_like(g.user, message.id, request_idempotency_key())
+        db.session.commit()
+        if liked or g.user.id != user_id:
             return redirect(f'/users/{user_id}')
         else:
-            g.user.likes.remove(message)
-            db.session.commit()
-            if g.user.id == user_id:
-                return redirect(f'/users/{user_id}/likes')
-            else:
-                return redirect(f'/users/{user_id}')
+            return redirect(f'/users/{user_id}/likes')
     else:
         return redirect('/')
         #what should we be doing? Flash, error, etc?
@@ -331,7 +799,11 @@ def add_message():
 
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
+        search.index_message(msg)
         g.user.messages.append(msg)
+        db.session.flush()
+        User.update_counts(User.id == g.user.id, messages_count=1)
+        timeline.fan_out(msg)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -339,6 +811,31 @@ def add_message():
     return render_template('messages/create.html', form=form)
 
 
+@app.get('/messages/search')
+def search_messages():
+    """Search messages' text.
+
+    Takes a 'q' param (words, "quoted phrases" and prefix* terms) and
+    'before'/'after' cursors to page through the results.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    query = request.args.get('q', '')
+    page = search.search_messages(query)
+    liked_ids = g.user.liked_message_ids([msg.id for msg in page])
+
+    return render_template(
+        'messages/search.html',
+        query=query,
+        messages=page.items,
+        cards=cache.message_cards(page.items),
+        page=page,
+        liked_ids=liked_ids)
+
+
 @app.get('/messages/<int:message_id>')
 def show_message(message_id):
     """Show a message."""
@@ -364,7 +861,12 @@ def delete_message(message_id):
         return redirect("/")
 
     msg = Message.query.get_or_404(message_id)
-    db.session.delete(msg)
+    cache.invalidate_message_card(msg)
+
+    if tombstones.is_enabled():
+        tombstones.soft_delete(msg)
+    else:
+        tombstones.hard_delete(msg)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}")
@@ -373,23 +875,248 @@ def delete_message(message_id):
 def handle_like_message(message_id):
     """Handle likes a message from home page"""
 
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
     message = Message.query.get_or_404(message_id)
-    if message not in g.user.likes:
-        new_fav = Like(user_id = g.user.id, message_id = message.id)
-        db.session.add(new_fav)
-        #change to append
-        db.session.commit()
-        return redirect('/')
-    else:
-        g.user.likes.remove(message)
-        db.session.commit()
-        return redirect('/')
+    toggle_like(g.user, message.id, request_idempotency_key())
+    db.session.commit()
+    return redirect('/')
 
         #request.referrer object(where we came from) - might break with ad blockers
         # if request.referrer falsy, redirect to message itself, otherwise go to where came from
 
 
 
+##############################################################################
+# JSON API
+#
+# Compact JSON for the scripts in static/js: pages of messages with the same
+# cursors as the HTML pages, and like/follow toggles, one at a time or in
+# batches (for importers and clients syncing in bulk). Writes need the CSRF
+# token (from the page's csrf-token meta tag) in an X-CSRFToken header.
+
+
+def api_error(message, status):
+    return jsonify(error=message), status
+
+
+@app.errorhandler(HTTPException)
+def api_http_error(error):
+    """Errors under /api/ are JSON too."""
+
+    if request.path.startswith('/api/'):
+        return api_error(error.description, error.code)
+
+    return error
+
+
+def api_check(write=False):
+    """Return an error response if the request isn't allowed, else None."""
+
+    if not g.user:
+        return api_error("Access unauthorized.", 401)
+
+    if write and app.config.get('WTF_CSRF_ENABLED', True):
+        try:
+            validate_csrf(request.headers.get('X-CSRFToken'))
+        except ValidationError:
+            return api_error("Missing or invalid CSRF token.", 400)
+
+    return None
+
+
+def messages_json(page):
+    """A page of messages, with their authors listed once each, and which
+    of them the current user likes."""
+
+    liked_ids = g.user.liked_message_ids([msg.id for msg in page])
+    users = {}
+
+    for msg in page:
+        users[msg.user.id] = {
+            "username": msg.user.username,
+            "image_url": msg.user.image_url,
+        }
+
+    return jsonify(
+        messages=[
+            {
+                "id": msg.id,
+                "text": msg.text,
+                "timestamp": msg.timestamp.isoformat(),
+                "user_id": msg.user_id,
+                "liked": msg.id in liked_ids,
+            }
+            for msg in page
+        ],
+        users=users,
+        before=page.before,
+        after=page.after)
+
+
+@app.get('/api/timeline')
+def api_timeline():
+    """A page of the current user's home timeline."""
+
+    error = api_check()
+    if error:
+        return error
+
+    return messages_json(timeline.home_page(g.user))
+
+
+@app.get('/api/users/<int:user_id>/messages')
+def api_user_messages(user_id):
+    """A page of a user's messages."""
+
+    error = api_check()
+    if error:
+        return error
+
+    user = User.query.get_or_404(user_id)
+    page = paginate(
+        Message.query.filter(Message.user_id == user.id),
+        (Message.timestamp, Message.id),
+        timeline.message_cursor)
+
+    return messages_json(page)
+
+
+@app.route('/api/messages/<int:message_id>/like', methods=["POST", "DELETE"])
+def api_like(message_id):
+    """Like (POST) or unlike (DELETE) a message."""
+
+    error = api_check(write=True)
+    if error:
+        return error
+
+    message = Message.query.get_or_404(message_id)
+
+    if request.method == "POST":
+        like_message(g.user, message.id)
+    else:
+        unlike_message(g.user, message.id)
+    db.session.commit()
+
+    return jsonify(message_id=message.id, liked=request.method == "POST")
+
+
+@app.route('/api/users/<int:user_id>/follow', methods=["POST", "DELETE"])
+def api_follow(user_id):
+    """Follow (POST) or unfollow (DELETE) a user."""
+
+    error = api_check(write=True)
+    if error:
+        return error
+
+    user = User.query.get_or_404(user_id)
+
+    if request.method == "POST":
+        follow_user(g.user, user)
+    else:
+        unfollow_user(g.user, user)
+    db.session.commit()
+
+    return jsonify(user_id=user.id, following=request.method == "POST")
+
+
+def batch_ids(key):
+    """The ids listed under `key` in the request's JSON body, without
+    repeats; returns (ids, None), or (None, an error response)."""
+
+    data = request.get_json(silent=True)
+    ids = data.get(key) if isinstance(data, dict) else None
+    limit = app.config['API_BATCH_LIMIT']
+
+    if not isinstance(ids, list) or not all(type(id) is int for id in ids):
+        return None, api_error(f'Expected {{"{key}": [ids]}}.', 400)
+
+    if len(ids) > limit:
+        return None, api_error(f"At most {limit} ids per request.", 400)
+
+    return list(dict.fromkeys(ids)), None
+
+
+def batch_results(key, ids, changed, model, done, unchanged):
+    """Per-id results of a batch, in request order: `done` for ids in
+    `changed`, else `unchanged`, or "not_found" if there's no such row."""
+
+    missing = [id for id in ids if id not in changed]
+    found = (set(db.session.scalars(
+                 select(model.id).where(model.id.in_(missing))))
+             if missing else set())
+
+    return [
+        {key: id,
+         "status": (done if id in changed
+                    else unchanged if id in found
+                    else "not_found")}
+        for id in ids
+    ]
+
+
+@app.route('/api/likes', methods=["POST", "DELETE"])
+def api_likes():
+    """Like (POST) or unlike (DELETE) the messages in {"message_ids": [...]}.
+
+    Responds with {"results": [{"message_id", "status"}, ...]}, the status
+    being "liked"/"already_liked", "unliked"/"not_liked" or "not_found".
+    """
+
+    error = api_check(write=True)
+    if error:
+        return error
+
+    message_ids, error = batch_ids("message_ids")
+    if error:
+        return error
+
+    if request.method == "POST":
+        changed = like_messages(g.user, message_ids)
+        statuses = ("liked", "already_liked")
+    else:
+        changed = unlike_messages(g.user, message_ids)
+        statuses = ("unliked", "not_liked")
+
+    results = batch_results(
+        "message_id", message_ids, changed, Message, *statuses)
+    db.session.commit()
+
+    return jsonify(results=results)
+
+
+@app.route('/api/follows', methods=["POST", "DELETE"])
+def api_follows():
+    """Follow (POST) or unfollow (DELETE) the users in {"user_ids": [...]}.
+
+    Responds with {"results": [{"user_id", "status"}, ...]}, the status
+    being "followed"/"already_following", "unfollowed"/"not_following" or
+    "not_found".
+    """
+
+    error = api_check(write=True)
+    if error:
+        return error
+
+    user_ids, error = batch_ids("user_ids")
+    if error:
+        return error
+
+    if request.method == "POST":
+        changed = follow_users(g.user, user_ids)
+        statuses = ("followed", "already_following")
+    else:
+        changed = unfollow_users(g.user, user_ids)
+        statuses = ("unfollowed", "not_following")
+
+    results = batch_results("user_id", user_ids, changed, User, *statuses)
+    db.session.commit()
+
+    return jsonify(results=results)
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -399,24 +1126,151 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: a page of the most recent messages of followed_users
     """
 
     if g.user:
-        followed = [user.id for user in g.user.following]
-        followed.append(g.user.id)
+        page = timeline.home_page(g.user)
+        liked_ids = g.user.liked_message_ids([msg.id for msg in page])
+
+        return render_template(
+            'home.html',
+            messages=page.items,
+            cards=cache.message_cards(page.items),
+            page=page,
+            liked_ids=liked_ids,
+            suggested=suggestions.for_user(
+                g.user, app.config['SUGGESTIONS_SHOWN']))
 
-        messages = (Message
-                    .query
-                    .order_by(Message.timestamp.desc())
-                    .filter(Message.user_id.in_(followed))
-                    .limit(100))
+    else:
+        return render_template('home-anon.html')
 
 
-        return render_template('home.html', messages=messages)
+@app.errorhandler(passwords.HasherBusy)
+def password_hasher_busy(error):
+    """Too many logins/signups in flight: ask the client to retry."""
 
-    else:
-        return render_template('home-anon.html')
+    return "Server busy, please try again.", 503, {"Retry-After": "1"}
+
+
+@app.get('/metrics', endpoint='metrics')
+def metrics_page():
+    """Request metrics for this process, for Prometheus to scrape."""
+
+    return metrics.render(), 200, {
+        "Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+##############################################################################
+# Maintenance commands
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    """Recompute precomputed home timelines from follows and messages."""
+
+    count = timeline.rebuild()
+    db.session.commit()
+    click.echo(f"Rebuilt home timelines: {count} entries.")
+
+
+@app.cli.command('create-search-indexes')
+def create_search_indexes():
+    """Install pg_trgm and the trigram index used by username search."""
+
+    search.create_trigram_index()
+    db.session.commit()
+    click.echo("Created username trigram index.")
+
+
+@app.cli.command('rebuild-message-index')
+def rebuild_message_index():
+    """Recompute the full-text search documents of every message."""
+
+    count = search.reindex_messages()
+    click.echo(f"Indexed {count} messages.")
+
+
+@app.cli.command('rebuild-suggestions')
+def rebuild_suggestions():
+    """Recompute every user's "who to follow" suggestions."""
+
+    suggestions.rebuild(report=click.echo)
+
+
+@app.cli.command('suggestions-worker')
+@click.option('--batch', default=100, help="queued updates per transaction")
+@click.option('--interval', default=1.0, help="seconds between polls")
+@click.option('--once', is_flag=True, help="stop when the queue is empty")
+def suggestions_worker(batch, interval, once):
+    """Apply queued follows and unfollows to suggestions."""
+
+    suggestions.run_worker(batch, interval, once, report=click.echo)
+
+
+@app.cli.command('timeline-worker')
+@click.option('--batch', default=10, help="queued accounts per transaction")
+@click.option('--interval', default=1.0, help="seconds between polls")
+@click.option('--once', is_flag=True, help="stop when the queue is empty")
+def timeline_worker(batch, interval, once):
+    """Fan out accounts that stopped being celebrities to their followers."""
+
+    timeline.run_worker(batch, interval, once, report=click.echo)
+
+
+@app.cli.command('compact-messages')
+@click.option('--batch', default=None, type=int,
+              help="tombstones per transaction (MESSAGE_COMPACT_BATCH)")
+def compact_messages(batch):
+    """Delete soft-deleted messages and their likes, in batches."""
+
+    count = tombstones.compact(batch, report=click.echo)
+    click.echo(f"Compacted {count} messages.")
+
+
+@app.cli.command('cache-server')
+def cache_server():
+    """Serve the shared cache on CACHE_SOCKET for CACHE_BACKEND=socket."""
+
+    server = cache.CacheServer(
+        app.config['CACHE_SOCKET'], app.config['CACHE_MAX_ENTRIES'])
+    click.echo(f"Serving cache on {app.config['CACHE_SOCKET']}")
+    server.serve_forever()
+
+
+@app.cli.command('db-pool-report')
+@click.option('--workers', type=int,
+              default=lambda: int(os.environ.get('WEB_CONCURRENCY', 1)))
+@click.option('--concurrency', type=int,
+              default=lambda: int(os.environ.get('GUNICORN_THREADS', 1)),
+              help="requests each worker serves at once")
+def db_pool_report(workers, concurrency):
+    """Show how many database connections the workers can open."""
+
+    dbpool.print_report(app, workers, concurrency, report=click.echo)
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters():
+    """Recompute users' message/follow/like counters to repair drift."""
+
+    count = User.reconcile_counts()
+    db.session.commit()
+    click.echo(f"Reconciled counters: {count} users repaired.")
+
+
+@app.cli.command('prune-like-requests')
+def prune_like_requests():
+    """Forget like toggles' idempotency keys older than
+    IDEMPOTENCY_KEY_TTL."""
+
+    cutoff = func.now() - datetime.timedelta(
+        seconds=app.config['IDEMPOTENCY_KEY_TTL'])
+    count = (LikeRequest.query
+             .filter(LikeRequest.created_at < cutoff)
+             .delete(synchronize_session=False))
+    db.session.commit()
+    click.echo(f"Pruned {count} idempotency keys.")
 
 
 ##############################################################################
@@ -0,0 +1,171 @@
+"""Check that no page's queries need a sequential scan.
+
+Requests each GET page as a logged-in user (the one following the most
+people, so lists aren't empty), records the SELECTs it runs, and EXPLAIN
+ANALYZEs each one against the current database. Exits with status 1 if any
+plan reads a whole table, e.g. after seeding:
+
+    python seed.py && python -m benchmarks.explain_routes
+
+On a small seeded database the planner prefers scanning tiny tables even
+when an index fits, so sequential scans are disabled while explaining
+(--planner-defaults keeps them): a Seq Scan, or an index scan with no
+condition, then means no index can serve the query.
+"""
+
+import argparse
+import sys
+
+from sqlalchemy import event
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message
+
+# statements that read a whole table on purpose (search.NgramIndex.build)
+ALLOWED = {
+    "SELECT users.id AS users_id, users.username AS users_username "
+    "FROM users",
+}
+
+
+def routes(user, message):
+    """GET paths to check, for a user and one of their messages."""
+
+    return [
+        "/",
+        "/users",
+        "/users?q=a",
+        "/users?q=abc",
+        f"/users/{user.id}",
+        f"/users/{user.id}/following",
+        f"/users/{user.id}/followers",
+        f"/users/{user.id}/likes",
+        "/users/profile",
+        f"/messages/{message.id}",
+        f"/messages/search?q={message.text.split()[0]}",
+    ]
+
+
+def capture_selects(path, user_id):
+    """Request `path` as `user_id`; return the SELECTs run (with params)."""
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", record)
+
+    try:
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = user_id
+
+            response = client.get(path)
+            if response.status_code != 200:
+                raise RuntimeError(f"GET {path}: {response.status_code}")
+
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+
+    return statements
+
+
+def seq_scans(plan, limited=False):
+    """Relations read in full anywhere in an EXPLAIN JSON plan: sequential
+    scans, and index scans without a condition or an enclosing LIMIT (which
+    is how the planner reads a whole table with seq scans disabled)."""
+
+    found = []
+    node = plan.get("Node Type")
+
+    if node == "Seq Scan":
+        found.append(plan["Relation Name"])
+
+    elif (node in ("Index Scan", "Index Only Scan")
+            and "Index Cond" not in plan and not limited):
+        found.append(f"{plan['Relation Name']} (whole index)")
+
+    for child in plan.get("Plans", []):
+        found.extend(seq_scans(child, limited or node == "Limit"))
+
+    return found
+
+
+def explain(statement, parameters, planner_defaults=False):
+    """Run EXPLAIN ANALYZE; return (plan, [seq scanned relations])."""
+
+    connection = db.engine.raw_connection()
+
+    try:
+        cursor = connection.cursor()
+        if not planner_defaults:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+
+        cursor.execute(
+            f"EXPLAIN (ANALYZE, FORMAT JSON) {statement}", parameters)
+        plan = cursor.fetchone()[0][0]["Plan"]
+
+    finally:
+        # EXPLAIN ANALYZE really runs the statement; never keep its effects
+        connection.rollback()
+        connection.close()
+
+    return plan, seq_scans(plan)
+
+
+def check(user=None, planner_defaults=False, report=print):
+    """Explain every route's queries; return [(path, statement, tables)]
+    for those with sequential scans."""
+
+    if user is None:
+        user = User.query.order_by(User.following_count.desc()).first()
+
+    message = (Message.query.filter_by(user_id=user.id).first()
+               or Message.query.first())
+
+    if user is None or message is None:
+        raise RuntimeError("seed the database first (python seed.py)")
+
+    # the cached user would hide the query that loads it
+    app.extensions['warbler_cache'].delete(f"user:{user.id}")
+
+    failures = []
+
+    for path in routes(user, message):
+        for statement, parameters in capture_selects(path, user.id):
+            if " ".join(statement.split()) in ALLOWED:
+                continue
+
+            plan, tables = explain(statement, parameters, planner_defaults)
+            status = "SEQ SCAN " + ", ".join(tables) if tables else "ok"
+            report(f"{path:<32} {plan['Actual Total Time']:>9.2f}ms  {status}")
+
+            if tables:
+                failures.append((path, statement, tables))
+
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--planner-defaults", action="store_true",
+                        help="leave sequential scans enabled")
+    parser.add_argument("--verbose", action="store_true",
+                        help="print the statements that scan")
+    args = parser.parse_args()
+
+    with app.app_context():
+        failures = check(planner_defaults=args.planner_defaults)
+
+    for path, statement, tables in failures:
+        print(f"\n{path}: sequential scan of {', '.join(tables)}")
+        if args.verbose:
+            print(statement)
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+"""Stress test like toggles: throughput under contention, and consistency.
+
+Replaces the DATABASE_URL database's tables with --users users and a few
+--messages hot messages (so point it at a scratch database), serves the app
+from a local threaded WSGI server, and has every user toggle likes on the
+hot messages as fast as the server answers, --toggles in all. A --double
+fraction of toggles are double clicks: the same form, with the same
+idempotency key, submitted twice at once.
+
+Afterwards it checks that:
+
+- every (user, message) is liked exactly when it was toggled an odd number
+  of times, counting each key once
+- each user's likes_count matches their likes
+- each key was recorded once
+
+and that throughput in the slowest tenth of the run held up against the
+fastest. Exits non-zero if any check fails.
+
+    DATABASE_URL=postgresql:///warbler_bench python -m benchmarks.like_toggles \\
+        --users 50 --toggles 5000
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import random
+import secrets
+import sys
+import threading
+import time
+
+from sqlalchemy import func, insert, select
+
+from app import app
+from benchmarks import loadtest
+from models import db, Like, LikeRequest, Message, User
+import passwords
+
+WINDOWS = 10
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+##############################################################################
+# Setup
+
+
+def seed(args):
+    """Recreate the tables with `args.users` users and `args.messages`
+    messages; returns ([(id, username)], message ids)."""
+
+    db.drop_all()
+    db.create_all()
+
+    hashed = passwords.hash_password(loadtest.PASSWORD)
+    db.session.execute(insert(User), [
+        {"username": f"toggler{i}", "email": f"toggler{i}@example.com",
+         "password": hashed}
+        for i in range(args.users)])
+    users = db.session.query(User.id, User.username).order_by(User.id).all()
+
+    db.session.execute(insert(Message), [
+        {"text": f"hot message {i}", "user_id": users[0].id}
+        for i in range(args.messages)])
+    db.session.commit()
+
+    return users, [message_id for (message_id,) in
+                   db.session.query(Message.id).order_by(Message.id)]
+
+
+##############################################################################
+# Toggling
+
+
+def run_toggler(client, message_ids, toggles, double, sent, timings):
+    """Toggle likes of random `message_ids` `toggles` times, one at a time,
+    recording each key in `sent` and (finished at, latency, ok) in
+    `timings`."""
+
+    for i in range(toggles):
+        message_id = client.rng.choice(message_ids)
+        key = secrets.token_urlsafe(16)
+        path = f"/messages/{message_id}/like"
+        data = {"idempotency_key": key}
+        sent.append((client.user_id, message_id, key))
+
+        started = time.perf_counter()
+
+        if client.rng.random() < double:
+            statuses = []
+            clicks = [
+                threading.Thread(
+                    target=lambda: statuses.append(client.request(path, data)))
+                for click in range(2)]
+            for click in clicks:
+                click.start()
+            for click in clicks:
+                click.join()
+            ok = all(status == 302 for status in statuses)
+        else:
+            ok = client.request(path, data) == 302
+
+        finished = time.perf_counter()
+        timings.append((finished, finished - started, ok))
+
+
+def run(clients, message_ids, args):
+    """Run every client's toggles at once; returns ([(user id, message id,
+    key)], [(finished at, latency, ok)], started at)."""
+
+    logins = [threading.Thread(target=client.start) for client in clients]
+    for thread in logins:
+        thread.start()
+    for thread in logins:
+        thread.join()
+
+    sent = []
+    timings = []
+    per_client = args.toggles // len(clients)
+    threads = [
+        threading.Thread(target=run_toggler, args=(
+            client, message_ids, per_client, args.double, sent, timings))
+        for client in clients]
+
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sent, timings, started
+
+
+##############################################################################
+# Checks
+
+
+def check_consistency(sent):
+    """Compare the database with the toggles `sent`; returns a list of
+    problems."""
+
+    keys = {}
+    for user_id, message_id, key in sent:
+        keys.setdefault((user_id, message_id), set()).add(key)
+
+    expected = {pair for pair, pair_keys in keys.items()
+                if len(pair_keys) % 2}
+    liked = set(db.session.query(Like.user_id, Like.message_id))
+    problems = []
+
+    if liked != expected:
+        problems.append(
+            f"{len(liked - expected)} unexpected likes, "
+            f"{len(expected - liked)} missing likes")
+
+    counts = dict(db.session.execute(
+        select(Like.user_id, func.count()).group_by(Like.user_id)).all())
+    drifted = [
+        user_id for user_id, likes_count in
+        db.session.query(User.id, User.likes_count)
+        if likes_count != counts.get(user_id, 0)]
+
+    if drifted:
+        problems.append(f"{len(drifted)} users' likes_count drifted")
+
+    recorded = LikeRequest.query.count()
+    distinct = len({key for user_id, message_id, key in sent})
+
+    if recorded != distinct:
+        problems.append(f"{recorded} keys recorded for {distinct} sent")
+
+    return problems
+
+
+def throughput(timings, started, seconds):
+    """Toggles/sec in each of WINDOWS equal slices of the run."""
+
+    width = seconds / WINDOWS
+    counts = [0] * WINDOWS
+
+    for finished, latency, ok in timings:
+        counts[min(WINDOWS - 1, int((finished - started) / width))] += 1
+
+    return [round(count / width, 1) for count in counts]
+
+
+##############################################################################
+# Main
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=50,
+                        help="simulated users, toggling at once")
+    parser.add_argument("--messages", type=int, default=20,
+                        help="hot messages everyone toggles")
+    parser.add_argument("--toggles", type=int, default=5000)
+    parser.add_argument("--double", type=float, default=0.2,
+                        help="fraction of toggles submitted twice at once")
+    parser.add_argument("--min-ratio", type=float, default=0.5,
+                        help="slowest/fastest window throughput to pass")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output",
+                        help="JSON results file (default: "
+                             "benchmarks/results/like-toggles-<commit>.json)")
+    args = parser.parse_args()
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    commit = loadtest.git_commit()
+    rng = random.Random(args.seed)
+
+    with app.app_context():
+        users, message_ids = seed(args)
+
+    server = loadtest.serve()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    clients = [
+        loadtest.Client(base_url, user, [], 0, 0, random.Random(rng.random()))
+        for user in users]
+
+    sent, timings, started = run(clients, message_ids, args)
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+
+    with app.app_context():
+        problems = check_consistency(sent)
+
+    windows = throughput(timings, started, elapsed)
+    summary = loadtest.summarize(
+        [(latency, ok) for finished, latency, ok in timings], elapsed)
+    held = min(windows) >= args.min_ratio * max(windows)
+
+    print(f"{summary['requests']} toggles in {elapsed:.1f}s: "
+          f"{summary['requests_per_second']}/s, p50 {summary['p50_ms']} ms, "
+          f"p99 {summary['p99_ms']} ms, {summary['errors']} errors")
+    print(f"toggles/s by tenth of the run: {windows}")
+
+    if summary["errors"]:
+        problems.append(f"{summary['errors']} toggles failed")
+    if not held:
+        problems.append(
+            f"throughput fell below {args.min_ratio:.0%} of its best")
+
+    for problem in problems:
+        print(f"FAILED: {problem}")
+    if not problems:
+        print("Consistent.")
+
+    output = args.output or os.path.join(
+        HERE, "results", f"like-toggles-{commit}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    with open(output, "w") as output_file:
+        json.dump({
+            "commit": commit,
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "settings": vars(args),
+            "summary": summary,
+            "windows": windows,
+            "problems": problems,
+        }, output_file, indent=2)
+
+    print(f"\nSaved {output}")
+
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+"""Load test Warbler with a realistic mix of traffic.
+
+Seeds the database from freshly generated CSVs (the DATABASE_URL database
+is dropped and recreated, so point it at a scratch database), serves the
+app from a local threaded WSGI server and has --clients simulated users
+browse it for --seconds. Each logs in as a seeded user, then repeatedly
+picks an action, weighted by MIX: home page, a profile, follow/unfollow,
+like, post, user and message search, or logging in again.
+
+Reports requests/sec and p50/p95/p99 latency per action and saves them as
+JSON (by default under benchmarks/results/, which git ignores, named after
+the commit), so a later run can be compared with --compare:
+
+    DATABASE_URL=postgresql:///warbler_bench python -m benchmarks.loadtest \\
+        --users 10000 --messages 100000 --follows 500000 --likes 200000
+
+Clients send the CSRF token from the login form with every POST, so they
+also work against a separately started server (see benchmarks/workers.py).
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.cookiejar import CookieJar
+
+from werkzeug.serving import make_server
+
+from app import app
+from models import db, User, Follows, Message
+import loader
+import passwords
+
+PASSWORD = "password"
+
+# relative weight of each action in the traffic mix
+MIX = {
+    "home": 30,
+    "profile": 20,
+    "follow": 8,
+    "like": 15,
+    "post": 7,
+    "search_users": 7,
+    "search_messages": 8,
+    "login": 5,
+}
+
+SEARCH_WORDS = ["bird", "song", "morning", "tree", "river", "sky", "nest"]
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+##############################################################################
+# Setup
+
+
+def seed(args, report=print):
+    """Generate CSVs of the requested size and load them; give every user
+    the password PASSWORD."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        subprocess.run(
+            [sys.executable, os.path.join(HERE, "..", "generator",
+                                          "create_csvs.py"),
+             "--offline", "--seed", str(args.seed), "--out-dir", directory,
+             "--users", str(args.users), "--messages", str(args.messages),
+             "--follows", str(args.follows), "--likes", str(args.likes)],
+            check=True)
+
+        loader.load(directory, report=report)
+
+    User.query.update(
+        {User.password: passwords.hash_password(PASSWORD)},
+        synchronize_session=False)
+    db.session.commit()
+
+
+def serve():
+    """Start the app on a free local port; returns the server."""
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+##############################################################################
+# Simulated users
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Time each request on its own rather than following redirects."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Client:
+    """A simulated user: a cookie jar, who they follow, and the actions
+    they can take."""
+
+    def __init__(self, base_url, user, following, max_user_id,
+                 max_message_id, rng):
+        self.base_url = base_url
+        self.username = user.username
+        self.user_id = user.id
+        self.following = set(following)
+        self.max_user_id = max_user_id
+        self.max_message_id = max_message_id
+        self.rng = rng
+        self.opener = urllib.request.build_opener(
+            _NoRedirect, urllib.request.HTTPCookieProcessor(CookieJar()))
+        self.csrf_token = None
+
+    def request(self, path, data=None):
+        """Make a request; return its status code."""
+
+        body = None
+        if data is not None:
+            if self.csrf_token:
+                data = {**data, "csrf_token": self.csrf_token}
+            body = urllib.parse.urlencode(data).encode()
+
+        try:
+            with self.opener.open(self.base_url + path, body) as response:
+                response.read()
+                return response.status
+
+        except urllib.error.HTTPError as error:
+            error.read()
+            return error.code
+
+    def fetch_csrf_token(self):
+        """Start a session and keep its CSRF token for later POSTs."""
+
+        with self.opener.open(self.base_url + "/login") as response:
+            match = CSRF_TOKEN.search(response.read().decode())
+
+        self.csrf_token = match and match.group(1)
+
+    def start(self):
+        """Log in for the first time."""
+
+        self.fetch_csrf_token()
+
+        # the password hasher sheds load with 503s while everyone logs in
+        while self.login() != 302:
+            time.sleep(0.1)
+
+    def login(self):
+        return self.request(
+            "/login", {"username": self.username, "password": PASSWORD})
+
+    def home(self):
+        return self.request("/")
+
+    def profile(self):
+        return self.request(f"/users/{self.rng.randint(1, self.max_user_id)}")
+
+    def follow(self):
+        # unfollow someone about a third of the time, so the graph stays
+        # roughly the same size
+        if self.following and self.rng.random() < 0.35:
+            other = self.rng.choice(sorted(self.following))
+            self.following.discard(other)
+            return self.request(f"/users/stop-following/{other}", {})
+
+        other = self.rng.randint(1, self.max_user_id)
+        if other == self.user_id or other in self.following:
+            return self.home()
+
+        self.following.add(other)
+        return self.request(f"/users/follow/{other}", {})
+
+    def like(self):
+        message_id = self.rng.randint(1, self.max_message_id)
+        return self.request(f"/messages/{message_id}/like", {})
+
+    def post(self):
+        words = self.rng.choices(SEARCH_WORDS, k=8)
+        return self.request("/messages/new", {"text": " ".join(words)})
+
+    def search_users(self):
+        return self.request(f"/users?q={self.username[:3]}")
+
+    def search_messages(self):
+        return self.request(
+            f"/messages/search?q={self.rng.choice(SEARCH_WORDS)}")
+
+
+def run_client(client, deadline, results, lock):
+    """Take weighted random actions until `deadline`, recording
+    (latency, ok) per action."""
+
+    actions = list(MIX)
+    weights = [MIX[action] for action in actions]
+    timings = {action: [] for action in actions}
+
+    while time.monotonic() < deadline:
+        action = client.rng.choices(actions, weights)[0]
+
+        started = time.perf_counter()
+        status = getattr(client, action)()
+        timings[action].append((time.perf_counter() - started, status < 400))
+
+    with lock:
+        for action, samples in timings.items():
+            results.setdefault(action, []).extend(samples)
+
+
+def make_clients(base_url, count, rng):
+    """`count` Clients, each logging in as a random seeded user."""
+
+    with app.app_context():
+        max_user_id = db.session.query(db.func.max(User.id)).scalar()
+        max_message_id = db.session.query(db.func.max(Message.id)).scalar()
+        users = User.query.order_by(db.func.random()).limit(count).all()
+
+        return [
+            Client(base_url, user, [
+                followed for (followed,) in db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == user.id)],
+                max_user_id, max_message_id, random.Random(rng.random()))
+            for user in users]
+
+
+def run_clients(clients, seconds):
+    """Log every client in, then run them all at once for `seconds`;
+    return ({action: [(latency, ok)]}, elapsed seconds)."""
+
+    logins = [threading.Thread(target=client.start) for client in clients]
+    for thread in logins:
+        thread.start()
+    for thread in logins:
+        thread.join()
+
+    results = {}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+    started = time.monotonic()
+    threads = [
+        threading.Thread(target=run_client,
+                         args=(client, deadline, results, lock))
+        for client in clients]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results, time.monotonic() - started
+
+
+##############################################################################
+# Reporting
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not ordered:
+        return None
+
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(samples, seconds):
+    latencies = sorted(latency for latency, ok in samples)
+    ms = lambda value: round(value * 1000, 2) if value is not None else None
+
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for latency, ok in samples if not ok),
+        "requests_per_second": round(len(samples) / seconds, 1),
+        "p50_ms": ms(percentile(latencies, 0.50)),
+        "p95_ms": ms(percentile(latencies, 0.95)),
+        "p99_ms": ms(percentile(latencies, 0.99)),
+    }
+
+
+def summarize_results(results, seconds):
+    """summarize() each action of run_clients' results, and all of them."""
+
+    summary = {
+        action: summarize(results.get(action, []), seconds)
+        for action in MIX}
+    summary["total"] = summarize(
+        [sample for samples in results.values() for sample in samples],
+        seconds)
+
+    return summary
+
+
+def print_table(summary, baseline=None):
+    print(f"{'action':<16}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'p99 ms':>9}{'errors':>8}")
+
+    for action, stats in summary.items():
+        line = (f"{action:<16}{stats['requests_per_second']:>9}"
+                f"{stats['p50_ms']!s:>9}{stats['p95_ms']!s:>9}"
+                f"{stats['p99_ms']!s:>9}{stats['errors']:>8}")
+
+        old = (baseline or {}).get(action)
+        if old and old["p95_ms"] and stats["p95_ms"]:
+            change = (stats["p95_ms"] - old["p95_ms"]) / old["p95_ms"]
+            line += f"   p95 {change:+.0%} vs baseline"
+
+        print(line)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--follows", type=int, default=20000)
+    parser.add_argument("--likes", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-seed", action="store_true",
+                        help="reuse the database from an earlier run")
+    parser.add_argument("--clients", type=int, default=8,
+                        help="simulated users making requests at once")
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--output",
+                        help="JSON results file (default: "
+                             "benchmarks/results/loadtest-<commit>.json)")
+    parser.add_argument("--compare", help="earlier JSON results to compare")
+    args = parser.parse_args()
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    commit = git_commit()
+    rng = random.Random(args.seed)
+
+    if not args.no_seed:
+        with app.app_context():
+            seed(args)
+
+    server = serve()
+    clients = make_clients(
+        f"http://127.0.0.1:{server.server_port}", args.clients, rng)
+    results, elapsed = run_clients(clients, args.seconds)
+    server.shutdown()
+
+    summary = summarize_results(results, elapsed)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)["routes"]
+
+    print_table(summary, baseline)
+
+    output = args.output or os.path.join(
+        HERE, "results", f"loadtest-{commit}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    with open(output, "w") as output_file:
+        json.dump({
+            "commit": commit,
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "settings": vars(args),
+            "routes": summary,
+        }, output_file, indent=2)
+
+    print(f"\nSaved {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Measure password-check (login) throughput per core.
+
+Runs bcrypt checks for a fixed time, inline on one thread and then through
+passwords.PasswordHasher with each requested number of worker processes,
+driven by enough threads to keep the queue full. Reports logins/sec in
+total and per worker, e.g.
+
+    python -m benchmarks.login_throughput --rounds 12 --workers 1 2 4
+"""
+
+import argparse
+import os
+import threading
+import time
+
+import bcrypt
+
+import passwords
+
+
+def measure(hasher, hashed, seconds, threads):
+    """Checks completed per second by `threads` threads using `hasher`."""
+
+    done = []
+    deadline = time.monotonic() + seconds
+
+    def drive():
+        count = 0
+        while time.monotonic() < deadline:
+            try:
+                hasher.run(passwords._check, hashed, b"password")
+                count += 1
+            except passwords.HasherBusy:
+                time.sleep(0.001)
+        done.append(count)
+
+    workers = [threading.Thread(target=drive) for i in range(threads)]
+    start = time.monotonic()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    return sum(done) / (time.monotonic() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rounds", type=int, default=12,
+                        help="bcrypt work factor (default 12)")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4],
+                        help="process pool sizes to try")
+    parser.add_argument("--seconds", type=float, default=5,
+                        help="how long to run each measurement")
+    args = parser.parse_args()
+
+    hashed = bcrypt.hashpw(b"password", bcrypt.gensalt(args.rounds))
+
+    print(f"bcrypt cost {args.rounds}, {os.cpu_count()} CPUs")
+    print(f"{'mode':<12}{'logins/s':>12}{'per core':>12}")
+
+    rate = measure(passwords.PasswordHasher(0, 1, None), hashed,
+                   args.seconds, 1)
+    print(f"{'inline':<12}{rate:>12.1f}{rate:>12.1f}")
+
+    for workers in args.workers:
+        hasher = passwords.PasswordHasher(workers, 4 * workers, None)
+        # start the pool before timing
+        hasher.run(passwords._check, hashed, b"password")
+
+        rate = measure(hasher, hashed, args.seconds, 4 * workers)
+        print(f"{f'pool x{workers}':<12}{rate:>12.1f}"
+              f"{rate / workers:>12.1f}")
+        hasher.pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""Compare gunicorn's sync and gevent worker modes at the same memory.
+
+Seeds the DATABASE_URL database like benchmarks/loadtest.py (so point it at
+a scratch database), then for each worker mode starts gunicorn with
+gunicorn.conf.py and the same number of worker processes, and runs the
+load test's traffic mix against it at each --clients level. Memory is the
+resident set of gunicorn and all its processes, measured after each level
+(Linux only).
+
+    DATABASE_URL=postgresql:///warbler_bench python -m benchmarks.workers \\
+        --workers 2 --clients 8 32 128
+
+Results are printed and saved as JSON (by default under benchmarks/results/,
+named after the commit).
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+from app import app
+from benchmarks import loadtest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+
+##############################################################################
+# Running gunicorn
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(mode, workers, port):
+    """Start gunicorn in worker `mode`; return the process once it serves."""
+
+    env = {**os.environ, "WEB_WORKER": mode, "WEB_CONCURRENCY": str(workers)}
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+         "-b", f"127.0.0.1:{port}", "--log-level", "warning", "app:app"],
+        cwd=ROOT, env=env)
+
+    deadline = time.monotonic() + 30
+
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/login"):
+                return process
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+
+    process.terminate()
+    raise RuntimeError(f"gunicorn ({mode}) didn't start")
+
+
+def stop_gunicorn(process):
+    process.send_signal(signal.SIGTERM)
+    process.wait(timeout=30)
+
+
+def descendants(pid):
+    """`pid` and all the processes under it."""
+
+    pids = [pid]
+
+    for task in os.listdir(f"/proc/{pid}/task"):
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as children:
+                for child in children.read().split():
+                    pids.extend(descendants(int(child)))
+        except FileNotFoundError:
+            pass
+
+    return pids
+
+
+def resident_mb(pid):
+    """Resident memory of `pid` and its descendants, in MB."""
+
+    total_kb = 0
+
+    for process in descendants(pid):
+        try:
+            with open(f"/proc/{process}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+        except FileNotFoundError:
+            pass
+
+    return round(total_kb / 1024, 1)
+
+
+##############################################################################
+# Benchmark
+
+
+def benchmark(mode, args, rng):
+    """Run each --clients level against gunicorn in `mode`; return
+    {clients: summary of all requests, plus "memory_mb"}."""
+
+    port = free_port()
+    process = start_gunicorn(mode, args.workers, port)
+    levels = {}
+
+    try:
+        for count in args.clients:
+            clients = loadtest.make_clients(
+                f"http://127.0.0.1:{port}", count, rng)
+            results, elapsed = loadtest.run_clients(clients, args.seconds)
+
+            summary = loadtest.summarize_results(results, elapsed)["total"]
+            summary["memory_mb"] = resident_mb(process.pid)
+            levels[count] = summary
+
+    finally:
+        stop_gunicorn(process)
+
+    return levels
+
+
+def print_table(results):
+    print(f"{'mode':<8}{'clients':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'p99 ms':>9}{'errors':>8}{'RSS MB':>9}")
+
+    for mode, levels in results.items():
+        for count, stats in levels.items():
+            print(f"{mode:<8}{count:>8}{stats['requests_per_second']:>9}"
+                  f"{stats['p50_ms']!s:>9}{stats['p95_ms']!s:>9}"
+                  f"{stats['p99_ms']!s:>9}{stats['errors']:>8}"
+                  f"{stats['memory_mb']:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--follows", type=int, default=20000)
+    parser.add_argument("--likes", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-seed", action="store_true",
+                        help="reuse the database from an earlier run")
+    parser.add_argument("--workers", type=int, default=2,
+                        help="gunicorn worker processes, in both modes")
+    parser.add_argument("--clients", type=int, nargs="+",
+                        default=[8, 32, 128],
+                        help="simulated users making requests at once")
+    parser.add_argument("--seconds", type=float, default=20,
+                        help="length of each run")
+    parser.add_argument("--modes", nargs="+", default=["sync", "gevent"])
+    parser.add_argument("--output",
+                        help="JSON results file (default: "
+                             "benchmarks/results/workers-<commit>.json)")
+    args = parser.parse_args()
+
+    commit = loadtest.git_commit()
+    rng = random.Random(args.seed)
+
+    if not args.no_seed:
+        with app.app_context():
+            loadtest.seed(args)
+
+    results = {mode: benchmark(mode, args, rng) for mode in args.modes}
+
+    print_table(results)
+
+    output = args.output or os.path.join(
+        HERE, "results", f"workers-{commit}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    with open(output, "w") as output_file:
+        json.dump({
+            "commit": commit,
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "settings": vars(args),
+            "results": results,
+        }, output_file, indent=2)
+
+    print(f"\nSaved {output}")
+
+
+if __name__ == "__main__":
+    main()
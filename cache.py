@@ -0,0 +1,366 @@
+"""Shared caches for Warbler.
+
+CACHE_BACKEND selects where cached values live:
+
+- "memory": (default) an LRU dict in each process
+- "socket": a small cache server on a local unix socket (CACHE_SOCKET), so
+            every gunicorn worker on the box shares one cache; start it with
+            `flask cache-server`, as the same user as the app
+
+The cache holds rendered HTML and user snapshots, so only that user may use
+the socket: the server creates it mode 0600, and clients won't talk to a
+socket another user owns (say, one planted in /tmp while the server was
+down).
+
+Values must be JSON-serializable. Cache errors are treated as misses: a
+cache that is down makes requests slower, never broken.
+
+The user cache keeps a snapshot of each logged-in user's profile columns so
+`add_user_to_g` can skip loading the user from the database. Entries are
+tagged with a per-user version that profile edits and deletes bump, and
+expire after USER_CACHE_TTL. With CACHE_BACKEND=memory a bump is only seen
+by the process that made it, so other workers may show the old profile
+until then.
+
+The message card cache keeps the rendered, viewer-independent part of each
+message in a list (avatar, username, date, text), keyed by message id and
+the author's profile_version; templates add only the viewer's like button.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from markupsafe import Markup
+from sqlalchemy.orm import make_transient_to_detached
+
+from models import db, User
+
+
+##############################################################################
+# Backends
+
+
+class LRUCache:
+    """In-process least-recently-used cache with per-entry expiry."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        values = []
+
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+
+                if entry is None:
+                    values.append(None)
+                elif entry[1] is not None and entry[1] < now:
+                    del self.entries[key]
+                    values.append(None)
+                else:
+                    self.entries.move_to_end(key)
+                    values.append(entry[0])
+
+        return values
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + ttl if ttl else None
+
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def incr(self, key):
+        """Increment an integer counter (which never expires); returns the
+        new value."""
+
+        with self.lock:
+            value = self.entries.get(key, (0, None))[0] + 1
+            self.entries[key] = (value, None)
+            self.entries.move_to_end(key)
+
+        return value
+
+
+class SocketCache:
+    """Client for a CacheServer listening on a local unix socket.
+
+    Speaks one JSON object per line; keeps a connection per thread.
+    """
+
+    def __init__(self, path, timeout=0.05):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self.local, "conn", None)
+
+        if conn is None:
+            if os.stat(self.path).st_uid != os.getuid():
+                raise PermissionError(f"{self.path} is another user's")
+
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            conn = self.local.conn = sock.makefile("rwb")
+
+        return conn
+
+    def _call(self, request):
+        """Send `request`; return the server's result, or None if the cache
+        can't be reached (after one reconnect)."""
+
+        payload = json.dumps(request, separators=(",", ":")).encode() + b"\n"
+
+        for attempt in range(2):
+            try:
+                conn = self._connection()
+                conn.write(payload)
+                conn.flush()
+                line = conn.readline()
+                if line:
+                    return json.loads(line)
+
+            except OSError:
+                pass
+
+            self.local.conn = None
+
+        return None
+
+    def get_many(self, keys):
+        return self._call({"op": "get_many", "keys": keys}) or [None] * len(keys)
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def set(self, key, value, ttl=None):
+        self._call({"op": "set", "key": key, "value": value, "ttl": ttl})
+
+    def delete(self, key):
+        self._call({"op": "delete", "key": key})
+
+    def incr(self, key):
+        return self._call({"op": "incr", "key": key})
+
+
+class _CacheRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        store = self.server.store
+
+        for line in self.rfile:
+            request = json.loads(line)
+            op = request["op"]
+
+            if op == "get_many":
+                result = store.get_many(request["keys"])
+            elif op == "set":
+                result = store.set(
+                    request["key"], request["value"], request["ttl"])
+            elif op == "delete":
+                result = store.delete(request["key"])
+            elif op == "incr":
+                result = store.incr(request["key"])
+            else:
+                result = None
+
+            self.wfile.write(
+                json.dumps(result, separators=(",", ":")).encode() + b"\n")
+            self.wfile.flush()
+
+
+class CacheServer(socketserver.ThreadingUnixStreamServer):
+    """An LRUCache served over a unix socket, shared by local workers."""
+
+    daemon_threads = True
+
+    def __init__(self, path, max_entries=10000):
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self.store = LRUCache(max_entries)
+        super().__init__(path, _CacheRequestHandler)
+
+    def server_bind(self):
+        # create the socket private to this user (no window where it isn't)
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+
+##############################################################################
+# Setup
+
+
+def init_cache(app):
+    """Create the app's cache from its config."""
+
+    if app.config['CACHE_BACKEND'] == "socket":
+        backend = SocketCache(app.config['CACHE_SOCKET'])
+    else:
+        backend = LRUCache(app.config['CACHE_MAX_ENTRIES'])
+
+    app.extensions['warbler_cache'] = backend
+
+
+def get_cache():
+    """The current app's cache backend."""
+
+    return current_app.extensions['warbler_cache']
+
+
+##############################################################################
+# Logged-in user cache
+
+
+# Columns kept in the cache; everything else (password hash, counters) is
+# loaded from the database on first access, if a page needs it.
+USER_CACHE_COLUMNS = (
+    "id",
+    "username",
+    "email",
+    "image_url",
+    "header_image_url",
+    "bio",
+    "location",
+    "profile_version",
+)
+
+# session key of the logged-in user's snapshot, with server-side sessions
+USER_SNAPSHOT_KEY = "user"
+
+
+def _user_key(user_id):
+    return f"user:{user_id}"
+
+
+def _user_version_key(user_id):
+    return f"user-version:{user_id}"
+
+
+def load_user(user_id, holder=None):
+    """Return the User for `user_id`, from the cache when it's current.
+
+    A cached user is attached to the session without a query; columns not
+    in the cache load lazily.
+
+    With `holder` (a server-side session), the user's snapshot is kept
+    there under USER_SNAPSHOT_KEY instead, and only its version is read
+    from the cache. The snapshot carries its own expiry, as a session can
+    outlive the version in a worker's cache (or be read by a worker that
+    never saw the bump).
+    """
+
+    cache = get_cache()
+
+    if holder is None:
+        entry, version = cache.get_many(
+            [_user_key(user_id), _user_version_key(user_id)])
+    else:
+        entry = holder.get(USER_SNAPSHOT_KEY)
+        version = cache.get(_user_version_key(user_id))
+
+        if entry is not None and entry.get("expires", 0) <= time.time():
+            entry = None
+
+    version = version or 0
+
+    if (entry is not None and entry["version"] == version
+            and entry["columns"]["id"] == user_id):
+        user = User(**entry["columns"])
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    user = User.query.get(user_id)
+
+    if user is not None:
+        entry = {
+            "version": version,
+            "columns": {
+                name: getattr(user, name) for name in USER_CACHE_COLUMNS},
+        }
+
+        if holder is None:
+            cache.set(
+                _user_key(user_id), entry,
+                current_app.config['USER_CACHE_TTL'])
+        else:
+            entry["expires"] = (
+                int(time.time()) + current_app.config['USER_CACHE_TTL'])
+            holder[USER_SNAPSHOT_KEY] = entry
+
+    return user
+
+
+def invalidate_user(user_id):
+    """Discard the cached user after a profile edit or delete."""
+
+    cache = get_cache()
+    cache.incr(_user_version_key(user_id))
+    cache.delete(_user_key(user_id))
+
+
+##############################################################################
+# Message card fragments
+
+
+MESSAGE_CARD_TEMPLATE = "messages/_card.html"
+
+
+def _card_key(message):
+    return f"card:{message.id}:{message.user.profile_version}"
+
+
+def message_cards(messages):
+    """Return {message id: Markup} of the viewer-independent part of each
+    message's list item, rendering and caching the ones not cached yet.
+
+    Messages' authors should already be loaded (e.g. with selectinload).
+    """
+
+    cache = get_cache()
+    keys = [_card_key(msg) for msg in messages]
+    template = None
+    cards = {}
+
+    for msg, key, html in zip(messages, keys, cache.get_many(keys)):
+        if html is None:
+            if template is None:
+                template = current_app.jinja_env.get_template(
+                    MESSAGE_CARD_TEMPLATE)
+
+            html = template.render(msg=msg)
+            cache.set(key, html, current_app.config['MESSAGE_CARD_CACHE_TTL'])
+
+        cards[msg.id] = Markup(html)
+
+    return cards
+
+
+def invalidate_message_card(message):
+    """Discard a deleted message's cached card."""
+
+    get_cache().delete(_card_key(message))
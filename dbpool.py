@@ -0,0 +1,158 @@
+"""Database connection pools for Warbler.
+
+Each process (gunicorn worker) has its own SQLAlchemy pool per database: up
+to DB_POOL_SIZE connections kept open, plus DB_MAX_OVERFLOW opened under
+load and closed again when returned. A request waits up to DB_POOL_TIMEOUT
+seconds for a connection before failing. Connections are checked before use
+(DB_POOL_PRE_PING) and replaced after DB_POOL_RECYCLE seconds, so restarts
+and idle timeouts between us and Postgres don't surface as errors.
+
+DB_STATEMENT_TIMEOUT (milliseconds, 0 for none) cancels runaway queries.
+It's off by default so CLI jobs (loading CSVs, building indexes) can run
+long; gunicorn.conf.py turns it on for web workers.
+
+DB_PGBOUNCER=1 is for connecting through pgbouncer in transaction pooling
+mode, where consecutive transactions may run on different server
+connections. pgbouncer does the pooling, so the app keeps no pool of its
+own, and nothing may rely on session state: the statement timeout is set
+with SET LOCAL at the start of each transaction instead of as a connection
+option (pgbouncer rejects startup options). psycopg2 never uses server-side
+prepared statements, so there's nothing to turn off there. To save the SET
+LOCAL round trip, set the timeout on the role instead (ALTER ROLE ... SET
+statement_timeout) and leave DB_STATEMENT_TIMEOUT at 0.
+
+`print_report` shows how many connections the configured workers can open,
+next to what Postgres allows.
+"""
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import NullPool
+
+
+def engine_options(config):
+    """SQLAlchemy create_engine options for the pool settings in `config`."""
+
+    timeout = config['DB_STATEMENT_TIMEOUT']
+
+    if config['DB_PGBOUNCER']:
+        return {"poolclass": NullPool}
+
+    options = {
+        "pool_size": config['DB_POOL_SIZE'],
+        "max_overflow": config['DB_MAX_OVERFLOW'],
+        "pool_timeout": config['DB_POOL_TIMEOUT'],
+        "pool_recycle": config['DB_POOL_RECYCLE'],
+        "pool_pre_ping": config['DB_POOL_PRE_PING'],
+    }
+
+    if timeout:
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={timeout}"}
+
+    return options
+
+
+def init_engine(engine, config):
+    """Set up what engine_options can't: in pgbouncer mode, the statement
+    timeout of each transaction."""
+
+    timeout = config['DB_STATEMENT_TIMEOUT']
+
+    if config['DB_PGBOUNCER'] and timeout:
+        @event.listens_for(engine, "begin")
+        def set_statement_timeout(connection):
+            cursor = connection.connection.cursor()
+            cursor.execute(f"SET LOCAL statement_timeout = {int(timeout)}")
+            cursor.close()
+
+
+##############################################################################
+# Pool math
+
+
+def connections_per_worker(config):
+    """Most connections one worker can hold to each database, or None when
+    the app doesn't pool (pgbouncer mode)."""
+
+    if config['DB_PGBOUNCER']:
+        return None
+
+    return config['DB_POOL_SIZE'] + config['DB_MAX_OVERFLOW']
+
+
+def server_limits(url):
+    """Return (max_connections, superuser_reserved_connections) of the
+    database at `url`, or None if it can't be asked."""
+
+    engine = create_engine(url, poolclass=NullPool)
+
+    try:
+        with engine.connect() as connection:
+            return tuple(
+                int(connection.execute(text(f"SHOW {setting}")).scalar())
+                for setting in (
+                    "max_connections", "superuser_reserved_connections"))
+
+    except SQLAlchemyError:
+        return None
+
+    finally:
+        engine.dispose()
+
+
+def pool_report(config, workers, concurrency, limits=None):
+    """Lines describing the connections `workers` processes serving up to
+    `concurrency` requests at once each (threads or greenlets) may open,
+    with warnings; `limits` is from server_limits."""
+
+    per_worker = connections_per_worker(config)
+    replicas = len(config['DATABASE_REPLICA_URLS'])
+    lines = []
+
+    if per_worker is None:
+        # one connection per busy request, pooled by pgbouncer
+        total = workers * concurrency
+        lines.append(
+            f"Database: pgbouncer mode, no app-side pool; {workers} workers "
+            f"x {concurrency} requests = up to {total} pgbouncer clients")
+    else:
+        total = workers * per_worker
+        lines.append(
+            f"Database pool per worker: {config['DB_POOL_SIZE']} + "
+            f"{config['DB_MAX_OVERFLOW']} overflow = {per_worker} "
+            f"connections for {concurrency} concurrent requests")
+        lines.append(
+            f"Database connections: {workers} workers x {per_worker} = "
+            f"up to {total} to the primary"
+            + (f" and to each of {replicas} replicas" if replicas else ""))
+
+        if concurrency > per_worker:
+            lines.append(
+                f"WARNING: {concurrency} concurrent requests share "
+                f"{per_worker} connections; waiting requests fail after "
+                f"{config['DB_POOL_TIMEOUT']}s")
+
+    if limits is not None:
+        max_connections, reserved = limits
+        available = max_connections - reserved
+        lines.append(
+            f"Postgres: max_connections {max_connections}, "
+            f"{reserved} reserved for superusers, {available} available")
+
+        if per_worker is not None and total > available:
+            lines.append(
+                f"WARNING: up to {total} connections but Postgres allows "
+                f"{available}; lower DB_POOL_SIZE/DB_MAX_OVERFLOW or the "
+                f"number of workers, or use pgbouncer")
+
+    return lines
+
+
+def print_report(app, workers, concurrency, report=print):
+    """Report the pool math for `app`, asking the primary for its limits."""
+
+    limits = server_limits(app.config['SQLALCHEMY_DATABASE_URI'])
+
+    for line in pool_report(app.config, workers, concurrency, limits):
+        report(line)
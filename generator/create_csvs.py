@@ -2,14 +2,28 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. a load-test data set:
+
+    python generator/create_csvs.py --users 1000000 --messages 10000000 \\
+        --follows 100000000 --likes 20000000 --offline --out-dir /tmp/big
+
+Rows are written as they are generated, and the follow graph is sampled in
+O(edges) time and O(users) memory: each user's number of follows is drawn
+from a power law, and who they follow is drawn from a power law over a
+shuffled popularity ranking, so a few accounts collect most followers.
+The same --seed and --as-of always produce the same files.
+
+--offline avoids the network (header images are fetched otherwise) and
+Faker, using built-in words instead.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
+import os
+from array import array
+from datetime import datetime
+from random import Random
+
 from helpers import get_random_datetime
 
 MAX_WARBLER_LENGTH = 140
@@ -17,61 +31,236 @@ MAX_WARBLER_LENGTH = 140
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
+NUM_LIKES = 2000
+
+# hash of the seed users' shared password
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+OFFLINE_HEADER_IMAGE_URLS = ["/static/images/warbler-hero.jpg"]
+
+OFFLINE_WORDS = (
+    "bird song nest wing feather tree morning early worm sky branch flock "
+    "migrate sparrow robin finch wren call chirp dawn dusk river meadow "
+    "forest seed berry summer winter spring autumn rain wind sun cloud"
+).split()
+
+OFFLINE_CITIES = ["Springfield", "Riverside", "Fairview", "Kingston",
+                  "Greenville", "Bristol", "Clinton", "Madison"]
+
+# Zipf-like skew of popularity: sampled ranks are int(n * random() ** SKEW),
+# so the top 1% of accounts get roughly 1% ** (1 / SKEW) of the picks
+POPULARITY_SKEW = 3.0
+
+# Pareto shape for how many follows/likes each user makes
+ACTIVITY_SHAPE = 1.5
+
+
+##############################################################################
+# Text and images
+
+
+class OfflineText:
+    """Stand-in for Faker using built-in words (no dependencies)."""
+
+    def __init__(self, rng):
+        self.rng = rng
+
+    def user_name(self):
+        return "".join(self.rng.sample(OFFLINE_WORDS, 2))
+
+    def sentence(self):
+        words = self.rng.choices(OFFLINE_WORDS, k=self.rng.randint(4, 10))
+        return " ".join(words).capitalize() + "."
+
+    def paragraph(self):
+        return " ".join(self.sentence() for i in range(self.rng.randint(1, 4)))
+
+    def city(self):
+        return self.rng.choice(OFFLINE_CITIES)
+
+
+def make_text(rng, seed, offline):
+    if offline:
+        return OfflineText(rng)
+
+    from faker import Faker
+
+    Faker.seed(seed)
+    return Faker()
+
+
+def profile_image_urls():
+    return [
+        f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+        for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+        for i in range(count)
+    ]
+
+
+def header_image_urls(offline):
+    if offline:
+        return OFFLINE_HEADER_IMAGE_URLS
+
+    import requests
+
+    return [
+        requests.get(f"http://www.splashbase.co/api/v1/images/{i}",
+                     timeout=10).json()['url']
+        for i in range(1, 46)
+    ]
+
+
+##############################################################################
+# Sampling
+
+
+def popularity_ranking(rng, count):
+    """Ids 1..count in random order: index 0 is the most popular."""
+
+    ranking = array('i', range(1, count + 1))
+    rng.shuffle(ranking)
+    return ranking
+
+
+def pick_popular(rng, ranking):
+    """Pick an id, favouring the front of `ranking` (power law)."""
+
+    return ranking[int(len(ranking) * rng.random() ** POPULARITY_SKEW)]
+
+
+def activity(rng, mean, limit):
+    """A power-law distributed count with roughly the given mean."""
+
+    scale = mean * (ACTIVITY_SHAPE - 1) / ACTIVITY_SHAPE
+    return min(limit, int(scale * rng.paretovariate(ACTIVITY_SHAPE)))
+
+
+def sample_edges(rng, sources, targets, count, allow_self=True):
+    """Yield about `count` distinct (source, target) pairs.
+
+    Each source id in 1..sources makes a power-law number of picks from the
+    popularity ranking of targets, with the mean adjusted as it goes so the
+    total lands on `count`; duplicates within a source are skipped, so
+    memory is O(targets + largest degree).
+    """
+
+    ranking = popularity_ranking(rng, targets)
+    limit = targets if allow_self else targets - 1
+    remaining = count
+
+    for source in range(1, sources + 1):
+        if remaining <= 0:
+            return
+
+        mean = remaining / (sources - source + 1)
+        wanted = min(remaining, activity(rng, mean, limit))
+        chosen = set()
+
+        # bounded retries keep this O(picks) even for very popular targets
+        for attempt in range(wanted * 2):
+            if len(chosen) == wanted:
+                break
+
+            target = pick_popular(rng, ranking)
+            if target in chosen or (not allow_self and target == source):
+                continue
+
+            chosen.add(target)
+            yield source, target
+
+        remaining -= len(chosen)
+
+
+##############################################################################
+# Writers
+
+
+def write_users(path, rng, text, num_users, offline):
+    images = profile_image_urls()
+    headers = header_image_urls(offline)
+
+    with open(path, 'w', newline='') as users_csv:
+        users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
+        users_writer.writeheader()
+
+        for i in range(num_users):
+            # suffix with the row number so usernames and emails are unique
+            username = f"{text.user_name()}{i}"
+            users_writer.writerow(dict(
+                email=f"{username}@example.com",
+                username=username,
+                image_url=rng.choice(images),
+                password=PASSWORD_HASH,
+                bio=text.sentence(),
+                header_image_url=rng.choice(headers),
+                location=text.city()
+            ))
+
+
+def write_messages(path, rng, text, num_users, num_messages, as_of):
+    ranking = popularity_ranking(rng, num_users)
 
-fake = Faker()
+    with open(path, 'w', newline='') as messages_csv:
+        messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
+        messages_writer.writeheader()
 
-# Generate random profile image URLs to use for users
+        for i in range(num_messages):
+            messages_writer.writerow(dict(
+                text=text.paragraph()[:MAX_WARBLER_LENGTH],
+                timestamp=get_random_datetime(rng=rng, now=as_of),
+                user_id=pick_popular(rng, ranking)
+            ))
 
-image_urls = [
-    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
-    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
-    for i in range(count)
-]
 
-# Generate random header image URLs to use for users
+def write_pairs(path, headers, pairs):
+    with open(path, 'w', newline='') as pairs_csv:
+        writer = csv.writer(pairs_csv)
+        writer.writerow(headers)
+        writer.writerows(pairs)
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
+def main():
+    parser = argparse.ArgumentParser(description="Generate Warbler CSVs.")
+    parser.add_argument("--users", type=int, default=NUM_USERS)
+    parser.add_argument("--messages", type=int, default=NUM_MESSAGES)
+    parser.add_argument("--follows", type=int, default=NUM_FOLLWERS)
+    parser.add_argument("--likes", type=int, default=NUM_LIKES)
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random seed; the same seed gives the same files")
+    parser.add_argument("--as-of", type=datetime.fromisoformat,
+                        default=datetime.now().replace(
+                            hour=0, minute=0, second=0, microsecond=0),
+                        help="latest message timestamp (default: today)")
+    parser.add_argument("--out-dir", default="generator")
+    parser.add_argument("--offline", action="store_true",
+                        help="no network access and no Faker")
+    args = parser.parse_args()
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
+    rng = Random(args.seed)
+    text = make_text(rng, args.seed, args.offline)
+    out = lambda filename: os.path.join(args.out_dir, filename)
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
+    os.makedirs(args.out_dir, exist_ok=True)
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
+    write_users(out('users.csv'), rng, text, args.users, args.offline)
+    write_messages(out('messages.csv'), rng, text, args.users, args.messages,
+                   args.as_of)
 
-# Generate follows.csv from random pairings of users
+    # (followed, follower) pairs; follower ids drive the out-degree
+    follows = (
+        (followed, follower) for follower, followed in
+        sample_edges(rng, args.users, args.users, args.follows,
+                     allow_self=False))
+    write_pairs(out('follows.csv'), FOLLOWS_CSV_HEADERS, follows)
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+    likes = sample_edges(rng, args.users, args.messages, args.likes)
+    write_pairs(out('likes.csv'), LIKES_CSV_HEADERS, likes)
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == "__main__":
+    main()
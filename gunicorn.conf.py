@@ -0,0 +1,49 @@
+"""gunicorn settings for Warbler (the Procfile runs `gunicorn -c ...`).
+
+WEB_CONCURRENCY worker processes, of the kind WEB_WORKER selects:
+
+- "sync": (default) GUNICORN_THREADS threads each
+- "gevent": up to GEVENT_CONNECTIONS requests at once each, on greenlets.
+            The standard library is monkey-patched and psycopg2 made
+            green, so a request waiting on Postgres (or on the password
+            hashing processes) lets the others run. Each greenlet gets its
+            own database session, removed when its request ends, and waits
+            its turn for one of the pool's connections.
+
+Every worker has its own database pool (see dbpool.py), so the first worker
+to start logs how many connections they can open between them.
+"""
+
+import os
+
+# exported, so the app can size per-worker pools (see passwords.py)
+os.environ.setdefault('WEB_CONCURRENCY', '2')
+workers = int(os.environ['WEB_CONCURRENCY'])
+worker_mode = os.environ.get('WEB_WORKER', 'sync')
+
+if worker_mode == 'gevent':
+    worker_class = 'gevent'
+    worker_connections = int(os.environ.get('GEVENT_CONNECTIONS', 100))
+    concurrency = worker_connections
+else:
+    threads = int(os.environ.get('GUNICORN_THREADS', 4))
+    concurrency = threads
+
+# cancel runaway queries in web requests (but not in CLI jobs, which
+# don't read this file)
+os.environ.setdefault('DB_STATEMENT_TIMEOUT', '5000')
+
+
+def post_fork(server, worker):
+    if worker_mode == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
+
+
+def post_worker_init(worker):
+    if worker.age == 1:
+        import dbpool
+
+        dbpool.print_report(
+            worker.wsgi, workers, concurrency, report=worker.log.info)
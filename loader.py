@@ -0,0 +1,210 @@
+"""Bulk-load the generator CSVs into Postgres with COPY.
+
+Rows are streamed from each CSV straight into COPY in bounded chunks, so
+memory use doesn't depend on file size and no row ever becomes a Python
+object. Secondary indexes, unique and foreign key constraints are dropped
+for the load and rebuilt once at the end, which is much cheaper than
+maintaining them row by row. Afterwards the id sequences are reset and
+derived data (counters, search documents, precomputed timelines) is
+computed in bulk.
+"""
+
+import io
+import os
+import time
+
+from flask import current_app
+
+from models import db
+import timeline
+
+# (table, CSV file) in foreign key order; users.csv and messages.csv have
+# no id column, so rows get ids 1, 2, 3... in file order
+TABLES = [
+    ("users", "users.csv"),
+    ("messages", "messages.csv"),
+    ("follows", "follows.csv"),
+    ("likes", "likes.csv"),
+]
+
+SEQUENCES = [("users", "id"), ("messages", "id")]
+
+DEFAULT_CHUNK_BYTES = 8 * 1024 * 1024
+
+
+def _deferrable_ddl(cursor, tables):
+    """Return (drop, create) DDL for the foreign key and unique constraints
+    and secondary indexes of `tables`."""
+
+    drop = []
+    create = []
+
+    cursor.execute("""
+        SELECT conrelid::regclass::text, conname,
+               pg_get_constraintdef(oid), contype
+        FROM pg_constraint
+        WHERE contype IN ('f', 'u')
+          AND conrelid::regclass::text = ANY(%s)
+    """, (tables,))
+
+    for table, name, definition, kind in cursor.fetchall():
+        drop.append(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"')
+        create.append((kind, f'ALTER TABLE {table} ADD CONSTRAINT "{name}" '
+                             f'{definition}'))
+
+    cursor.execute("""
+        SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid)
+        FROM pg_index
+        WHERE indrelid::regclass::text = ANY(%s)
+          AND NOT indisprimary
+          AND indexrelid NOT IN (SELECT conindid FROM pg_constraint)
+    """, (tables,))
+
+    for name, definition in cursor.fetchall():
+        drop.append(f'DROP INDEX "{name}"')
+        create.append(("i", definition))
+
+    # unique constraints first (foreign keys may reference them), then
+    # foreign keys, then plain indexes
+    order = {"u": 0, "f": 1, "i": 2}
+    create.sort(key=lambda item: order[item[0]])
+
+    return drop, [statement for kind, statement in create]
+
+
+def _chunks(csv_file, chunk_bytes):
+    """Yield blocks of whole CSV records of about `chunk_bytes` each.
+
+    A record ends at a newline outside quotes; since quotes inside fields
+    are doubled, that's a newline with an even number of quotes before it
+    in the record.
+    """
+
+    lines = []
+    size = 0
+    quotes = 0
+
+    for line in csv_file:
+        lines.append(line)
+        size += len(line)
+        quotes += line.count('"')
+
+        if quotes % 2 == 0 and size >= chunk_bytes:
+            yield "".join(lines), len(lines)
+            lines = []
+            size = 0
+            quotes = 0
+
+    if lines:
+        yield "".join(lines), len(lines)
+
+
+def copy_csv(cursor, table, path, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """COPY the CSV at `path` into `table` in chunks; return rows loaded."""
+
+    rows = 0
+
+    with open(path, newline="") as csv_file:
+        header = csv_file.readline().strip()
+        statement = f"COPY {table} ({header}) FROM STDIN WITH (FORMAT csv)"
+
+        for data, lines in _chunks(csv_file, chunk_bytes):
+            cursor.copy_expert(statement, io.StringIO(data))
+            rows += cursor.rowcount if cursor.rowcount >= 0 else lines
+
+    return rows
+
+
+def _finish(cursor):
+    """Reset sequences and compute derived data after a load."""
+
+    for table, column in SEQUENCES:
+        cursor.execute(f"""
+            SELECT setval(pg_get_serial_sequence('{table}', '{column}'),
+                          COALESCE(MAX({column}), 1),
+                          MAX({column}) IS NOT NULL)
+            FROM {table}
+        """)
+
+    cursor.execute(
+        "UPDATE messages SET search_vector = to_tsvector(%s, text)",
+        (current_app.config['MESSAGE_SEARCH_LANGUAGE'],))
+
+    for column, table, key in [
+            ("messages_count", "messages", "user_id"),
+            ("following_count", "follows", "user_following_id"),
+            ("followers_count", "follows", "user_being_followed_id"),
+            ("likes_count", "likes", "user_id")]:
+        cursor.execute(f"""
+            UPDATE users SET {column} = counts.n
+            FROM (SELECT {key} AS id, COUNT(*) AS n
+                  FROM {table} GROUP BY {key}) AS counts
+            WHERE users.id = counts.id
+        """)
+
+
+def load(directory, chunk_bytes=DEFAULT_CHUNK_BYTES, report=print):
+    """Recreate the schema and load every CSV in `directory`.
+
+    Returns {table: rows loaded}.
+    """
+
+    db.drop_all()
+    db.create_all()
+
+    connection = db.engine.raw_connection()
+    loaded = {}
+
+    try:
+        cursor = connection.cursor()
+        drop, create = _deferrable_ddl(
+            cursor, [table for table, filename in TABLES])
+
+        for statement in drop:
+            cursor.execute(statement)
+
+        started = time.perf_counter()
+
+        for table, filename in TABLES:
+            path = os.path.join(directory, filename)
+            if not os.path.exists(path):
+                report(f"{table:<10} skipped, no {path}")
+                continue
+
+            table_started = time.perf_counter()
+            loaded[table] = rows = copy_csv(cursor, table, path, chunk_bytes)
+            elapsed = time.perf_counter() - table_started
+            report(f"{table:<10} {rows:>12,} rows "
+                   f"{rows / elapsed if elapsed else 0:>12,.0f} rows/s")
+
+        step_started = time.perf_counter()
+        _finish(cursor)
+        report(f"derived data in {time.perf_counter() - step_started:.1f}s")
+
+        step_started = time.perf_counter()
+        for statement in create:
+            cursor.execute(statement)
+        cursor.execute("ANALYZE")
+        report(f"indexes and constraints in "
+               f"{time.perf_counter() - step_started:.1f}s")
+
+        connection.commit()
+
+    except Exception:
+        connection.rollback()
+        raise
+
+    finally:
+        connection.close()
+
+    if timeline.is_enabled():
+        count = timeline.rebuild()
+        db.session.commit()
+        report(f"timelines  {count:>12,} entries")
+
+    total = sum(loaded.values())
+    elapsed = time.perf_counter() - started
+    report(f"total      {total:>12,} rows "
+           f"{total / elapsed if elapsed else 0:>12,.0f} rows/s")
+
+    return loaded
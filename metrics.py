@@ -0,0 +1,250 @@
+"""Request metrics for Warbler.
+
+For every request (except static files) we record, per endpoint:
+
+- latency, as a histogram
+- number of SQL statements and time spent in them (SQLAlchemy cursor
+  events on every engine)
+- time spent rendering templates (Flask's template signals)
+
+`render()` exposes the totals in the Prometheus text format (the app serves
+it at /metrics). With METRICS_LOG set, each request is also logged as one
+JSON line on the "warbler.requests" logger.
+
+Metrics live in each process: with several gunicorn workers, each reports
+its own. Recording a request costs a few microseconds.
+"""
+
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+from flask import before_render_template, g, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+request_log = logging.getLogger("warbler.requests")
+
+# the request being measured on this thread, if any
+_current = threading.local()
+
+
+class RequestStats:
+    """What one request has cost so far."""
+
+    __slots__ = (
+        "started", "status", "sql_count", "sql_time",
+        "template_started", "template_time")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.status = 500
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_started = None
+        self.template_time = 0.0
+
+
+class EndpointMetrics:
+    """Running totals for one endpoint."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.statuses = {}
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+
+    def add(self, latency, stats):
+        self.buckets[bisect_left(LATENCY_BUCKETS, latency)] += 1
+        self.latency_sum += latency
+        self.statuses[stats.status] = self.statuses.get(stats.status, 0) + 1
+        self.sql_count += stats.sql_count
+        self.sql_time += stats.sql_time
+        self.template_time += stats.template_time
+
+
+class Registry:
+    """Per-endpoint metrics for one process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, latency, stats):
+        with self.lock:
+            metrics = self.endpoints.get(endpoint)
+            if metrics is None:
+                metrics = self.endpoints[endpoint] = EndpointMetrics()
+
+            metrics.add(latency, stats)
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format."""
+
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            lines = [
+                "# HELP warbler_request_duration_seconds Request latency.",
+                "# TYPE warbler_request_duration_seconds histogram",
+            ]
+
+            for endpoint, metrics in endpoints:
+                cumulative = 0
+                bounds = [str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"]
+
+                for bound, count in zip(bounds, metrics.buckets):
+                    cumulative += count
+                    lines.append(
+                        f'warbler_request_duration_seconds_bucket'
+                        f'{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+
+                lines.append(
+                    f'warbler_request_duration_seconds_sum'
+                    f'{{endpoint="{endpoint}"}} {metrics.latency_sum}')
+                lines.append(
+                    f'warbler_request_duration_seconds_count'
+                    f'{{endpoint="{endpoint}"}} {cumulative}')
+
+            for name, kind, help_text, value in [
+                    ("warbler_requests_total", "counter",
+                     "Requests by response status.", None),
+                    ("warbler_sql_statements_total", "counter",
+                     "SQL statements executed.", "sql_count"),
+                    ("warbler_sql_duration_seconds_total", "counter",
+                     "Time spent executing SQL.", "sql_time"),
+                    ("warbler_template_render_seconds_total", "counter",
+                     "Time spent rendering templates.", "template_time")]:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+                for endpoint, metrics in endpoints:
+                    if value is None:
+                        for status, count in sorted(metrics.statuses.items()):
+                            lines.append(
+                                f'{name}{{endpoint="{endpoint}",'
+                                f'status="{status}"}} {count}')
+                    else:
+                        lines.append(
+                            f'{name}{{endpoint="{endpoint}"}} '
+                            f'{getattr(metrics, value)}')
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+##############################################################################
+# Hooks
+
+
+def _start_request():
+    if request.endpoint in ("static", "metrics"):
+        _current.stats = None
+    else:
+        _current.stats = RequestStats()
+
+
+def _record_status(response):
+    stats = getattr(_current, "stats", None)
+    if stats is not None:
+        stats.status = response.status_code
+
+    return response
+
+
+def _finish_request(error):
+    stats = getattr(_current, "stats", None)
+    if stats is None:
+        return
+
+    _current.stats = None
+    latency = time.perf_counter() - stats.started
+    endpoint = request.endpoint or "unmatched"
+    registry.record(endpoint, latency, stats)
+
+    if request_log.isEnabledFor(logging.INFO):
+        user = g.get("user")
+        request_log.info(json.dumps({
+            "endpoint": endpoint,
+            "method": request.method,
+            "path": request.path,
+            "status": stats.status,
+            "user_id": user.id if user is not None else None,
+            "duration_ms": round(latency * 1000, 3),
+            "sql_statements": stats.sql_count,
+            "sql_ms": round(stats.sql_time * 1000, 3),
+            "template_ms": round(stats.template_time * 1000, 3),
+        }))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if getattr(_current, "stats", None) is not None:
+        conn.info["warbler_query_started"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    stats = getattr(_current, "stats", None)
+    started = conn.info.pop("warbler_query_started", None)
+
+    if stats is not None and started is not None:
+        stats.sql_count += 1
+        stats.sql_time += time.perf_counter() - started
+
+
+def _before_render(sender, template, context, **extra):
+    stats = getattr(_current, "stats", None)
+    if stats is not None:
+        stats.template_started = time.perf_counter()
+
+
+def _after_render(sender, template, context, **extra):
+    stats = getattr(_current, "stats", None)
+    if stats is not None and stats.template_started is not None:
+        stats.template_time += time.perf_counter() - stats.template_started
+        stats.template_started = None
+
+
+_engine_hooks_installed = False
+
+
+def init_metrics(app):
+    """Measure `app`'s requests, and log them if METRICS_LOG is set."""
+
+    global _engine_hooks_installed
+
+    app.before_request_funcs.setdefault(None, []).insert(0, _start_request)
+    app.after_request(_record_status)
+    app.teardown_request(_finish_request)
+
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    if not _engine_hooks_installed:
+        # on the Engine class, so every engine (and replica) is measured
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        _engine_hooks_installed = True
+
+    if app.config['METRICS_LOG']:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        request_log.addHandler(handler)
+        request_log.setLevel(logging.INFO)
+        request_log.propagate = False
+
+
+def render():
+    """This process's metrics in the Prometheus text format."""
+
+    return registry.render()
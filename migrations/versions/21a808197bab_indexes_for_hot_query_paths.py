@@ -0,0 +1,42 @@
+"""indexes for hot query paths
+
+Revision ID: 21a808197bab
+Revises: 706ad39fa9cc
+Create Date: 2026-10-18 18:47:56.713384
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '21a808197bab'
+down_revision = '706ad39fa9cc'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_follows_user_following_id', 'follows', ['user_following_id']),
+    ('ix_likes_message_id', 'likes', ['message_id']),
+    ('ix_messages_user_id_timestamp', 'messages',
+     ['user_id', sa.text('timestamp DESC')]),
+    ('ix_timeline_entries_message_id', 'timeline_entries', ['message_id']),
+]
+
+
+def upgrade():
+    # CONCURRENTLY doesn't block writes while building on a live database,
+    # but can't run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(
+                name, table, columns, unique=False,
+                postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(
+                name, table_name=table, postgresql_concurrently=True)
@@ -2,11 +2,16 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, or_, select
+from sqlalchemy.dialects.postgresql import ARRAY, TSVECTOR
+from sqlalchemy.orm import with_loader_criteria
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+import dbpool
+import passwords
+from replicas import RoutingSQLAlchemy
+
+# GET requests may read from replicas -- see replicas.py
+db = RoutingSQLAlchemy()
 
 DEFAULT_IMAGE_URL = "/static/images/default-pic.png"
 DEFAULT_HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
@@ -29,6 +34,11 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # the primary key serves "who does X follow?"; this serves the reverse
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id', 'user_following_id'),
+    )
+
 
 class User(db.Model):
     """User in the system."""
@@ -75,7 +85,52 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message', backref="user")
+    # Bumped whenever the profile (username, image...) changes, so cached
+    # renderings of this user's messages are replaced (see cache.py).
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Denormalized counts for profile headers, kept in step by the routes
+    # that change them (see update_counts) and repaired by
+    # reconcile_counts.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # passive deletes: deleting a user or message leaves its messages,
+    # follows and likes to the foreign keys' ON DELETE CASCADE, rather than
+    # loading them all to delete (or orphan) them one by one
+    messages = db.relationship(
+        'Message', backref="user", passive_deletes="all")
     #better name for user should be author
 
     followers = db.relationship(
@@ -83,13 +138,15 @@ class User(db.Model):
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
         secondaryjoin=(Follows.user_following_id == id),
-        backref="following",
+        backref=db.backref("following", passive_deletes=True),
+        passive_deletes=True,
     )
 
     likes = db.relationship(
         "Message",
         secondary='likes',
-        backref='users'
+        backref=db.backref('users', passive_deletes=True),
+        passive_deletes=True,
     )
     #rename to liked_messages, and for backref
 
@@ -105,7 +162,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash_password(password)
 
         user = User(
             username=username,
@@ -127,30 +184,123 @@ class User(db.Model):
 
         If this can't find matching user (or if password is wrong), returns
         False.
+
+        If the stored hash was made with a different work factor than is
+        now configured, it is replaced (the caller commits).
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = passwords.check_password(user.password, password)
             if is_auth:
+                if passwords.needs_rehash(user.password):
+                    user.password = passwords.hash_password(password)
                 return user
 
         return False
 
+    @classmethod
+    def update_counts(cls, criterion, **deltas):
+        """Add `deltas` to the counters of users matching `criterion`.
+
+        Done as a single UPDATE in the current transaction, e.g.
+        User.update_counts(User.id == user.id, likes_count=1).
+        """
+
+        (db.session
+         .query(cls)
+         .filter(criterion)
+         .update(
+             {getattr(cls, name): getattr(cls, name) + delta
+              for name, delta in deltas.items()},
+             synchronize_session=False))
+
+    @classmethod
+    def reconcile_counts(cls):
+        """Recompute every user's counters from the underlying tables.
+
+        Returns the number of users whose counts had drifted.
+        """
+
+        counts = {
+            cls.messages_count: (
+                select(func.count())
+                .where(Message.user_id == cls.id,
+                       Message.deleted_at.is_(None))
+                .scalar_subquery()),
+            cls.following_count: (
+                select(func.count())
+                .where(Follows.user_following_id == cls.id)
+                .scalar_subquery()),
+            cls.followers_count: (
+                select(func.count())
+                .where(Follows.user_being_followed_id == cls.id)
+                .scalar_subquery()),
+            cls.likes_count: (
+                select(func.count())
+                .where(Like.user_id == cls.id)
+                .scalar_subquery()),
+        }
+
+        return (db.session
+                .query(cls)
+                .filter(or_(*[column != count
+                              for column, count in counts.items()]))
+                .update(counts, synchronize_session=False))
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.query(
+            Follows.query
+            .filter_by(user_being_followed_id=self.id,
+                       user_following_id=other_user.id)
+            .exists()
+        ).scalar()
 
     def is_following(self, other_user):
         """Is this user following `other_user`?"""
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.query(
+            Follows.query
+            .filter_by(user_being_followed_id=other_user.id,
+                       user_following_id=self.id)
+            .exists()
+        ).scalar()
+
+    def following_ids_among(self, user_ids):
+        """Return the set of `user_ids` this user is following.
+
+        One query for a whole page of users, for list templates.
+        """
+
+        if not user_ids:
+            return set()
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id,
+                        Follows.user_being_followed_id.in_(user_ids)))
+
+        return {user_id for (user_id,) in rows}
+
+    def liked_message_ids(self, message_ids):
+        """Return the set of `message_ids` this user has liked.
+
+        One query for a whole page of messages, rather than checking each
+        message's likers.
+        """
+
+        if not message_ids:
+            return set()
+
+        rows = (db.session
+                .query(Like.message_id)
+                .filter(Like.user_id == self.id,
+                        Like.message_id.in_(message_ids)))
+
+        return {message_id for (message_id,) in rows}
 
 
 
@@ -180,13 +330,42 @@ class Message(db.Model):
         db.ForeignKey('users.id', ondelete='cascade')
     )
 
+    # full-text search document for `text`, set when the message is posted
+    # (see search.index_message); deferred so lists don't load it
+    search_vector = db.deferred(db.Column(
+        TSVECTOR,
+    ))
+
+    # set when the message is soft-deleted; ORM queries skip it from then on
+    # and `flask compact-messages` deletes it later (see tombstones.py)
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_messages_search_vector',
+            'search_vector',
+            postgresql_using='gin',
+        ),
+        # a user's messages, newest first (profiles, home timelines)
+        db.Index(
+            'ix_messages_user_id_timestamp',
+            'user_id',
+            timestamp.desc(),
+        ),
+        # tombstones waiting for compaction
+        db.Index(
+            'ix_messages_deleted_at',
+            'deleted_at',
+            postgresql_where=deleted_at.isnot(None),
+        ),
+    )
+
     def is_liked(self,user):
         """Tests if current user liked this message"""
-        # could do directly in jinja
-        if user in self.users:
-            return True
-        else:
-            return False
+        # primary key lookup, so we never load every liker of the message
+        return Like.query.get((user.id, self.id)) is not None
 
 class Like(db.Model):
     """Connection of a user <-> message."""
@@ -205,7 +384,198 @@ class Like(db.Model):
         primary_key=True,
     )
 
+    # likes of a message (deleting it, counting its likes)
+    __table_args__ = (
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
+
+class LikeRequest(db.Model):
+    """A like toggle already applied, by its idempotency key, so a repeat of
+    the same request (a double click, a retry) isn't applied again."""
+
+    __tablename__ = 'like_requests'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    key = db.Column(
+        db.String(64),
+        primary_key=True,
+    )
 
+    message_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # whether the toggle left the message liked
+    liked = db.Column(
+        db.Boolean,
+        nullable=False,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=func.now(),
+    )
+
+    # pruning expired keys
+    __table_args__ = (
+        db.Index('ix_like_requests_created_at', 'created_at'),
+    )
+
+
+
+
+class TimelineEntry(db.Model):
+    """Precomputed home timeline row: `message_id` appears on `user_id`'s
+    home page. Written on post (fan-out-on-write) and on follow/unfollow."""
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    # denormalized from the message so a timeline page is one index range
+    # and unfollowing can prune by author without touching messages
+    author_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_timeline_entries_user_id_timestamp',
+            'user_id',
+            timestamp.desc(),
+        ),
+        # entries of a message, for the cascade when it is deleted
+        db.Index('ix_timeline_entries_message_id', 'message_id'),
+    )
+
+
+class TimelineDemotion(db.Model):
+    """Queued account that fell below the celebrity follower threshold, whose
+    recent messages haven't been copied into its followers' timelines yet
+    (see timeline.process_demotions)."""
+
+    __tablename__ = 'timeline_demotions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    queued_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=func.now(),
+    )
+
+    # oldest first, for workers claiming batches
+    __table_args__ = (
+        db.Index('ix_timeline_demotions_queued_at', 'queued_at'),
+    )
+
+
+class FollowSuggestion(db.Model):
+    """A user's "who to follow" list: the top accounts followed by the
+    people they follow, best first, with how many of them follow each.
+    Maintained by suggestions.py."""
+
+    __tablename__ = 'follow_suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    # parallel arrays, so a user's whole list is one small row
+    suggested_ids = db.Column(
+        ARRAY(db.Integer),
+        nullable=False,
+    )
+
+    scores = db.Column(
+        ARRAY(db.Integer),
+        nullable=False,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=func.now(),
+    )
+
+
+class SuggestionUpdate(db.Model):
+    """Queued follow or unfollow whose effect on suggestions hasn't been
+    applied yet (see suggestions.process_updates)."""
+
+    __tablename__ = 'suggestion_updates'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    followed_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    queued_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=func.now(),
+    )
+
+    # oldest first, for workers claiming batches
+    __table_args__ = (
+        db.Index('ix_suggestion_updates_queued_at', 'queued_at'),
+    )
+
+
+@event.listens_for(db.session, "do_orm_execute")
+def _hide_deleted_messages(execute_state):
+    """Leave soft-deleted messages out of every ORM query -- lists, joins,
+    relationship loads, lookups by id -- unless it has the execution option
+    include_deleted=True.
+
+    Only SELECTs are filtered: statements that write from a select of
+    messages need their own `Message.deleted_at.is_(None)`.
+    """
+
+    if (execute_state.is_select
+            and not execute_state.is_column_load
+            and not execute_state.execution_options.get(
+                "include_deleted", False)):
+        execute_state.statement = execute_state.statement.options(
+            with_loader_criteria(
+                Message, Message.deleted_at.is_(None), include_aliases=True))
 
 
 def connect_db(app):
@@ -214,5 +584,9 @@ def connect_db(app):
     You should call this in your Flask app.
     """
 
+    app.config.setdefault(
+        'SQLALCHEMY_ENGINE_OPTIONS', dbpool.engine_options(app.config))
+
     db.app = app
     db.init_app(app)
+    dbpool.init_engine(db.engine, app.config)
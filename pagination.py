@@ -0,0 +1,160 @@
+"""Keyset (cursor) pagination for Warbler list pages.
+
+Pages are ordered newest-first on a unique key such as
+(Message.timestamp, Message.id). Rather than OFFSET, each page is fetched
+with a `WHERE key < cursor` (older, `?before=`) or `WHERE key > cursor`
+(newer, `?after=`) range, so the cost of a page doesn't grow with how far
+back it is.
+"""
+
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from flask import abort, current_app, request
+from sqlalchemy import tuple_
+
+
+class Page:
+    """One page of results plus the cursors of its neighbours.
+
+    `before` is the cursor for the next (older) page and `after` the cursor
+    for the previous (newer) page; either is None at the ends of the list.
+    """
+
+    def __init__(self, items, before=None, after=None):
+        self.items = items
+        self.before = before
+        self.after = after
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(values):
+    """Encode a tuple of key values as an opaque, URL-safe cursor."""
+
+    raw = json.dumps([
+        value.isoformat() if isinstance(value, datetime) else value
+        for value in values
+    ], separators=(",", ":"))
+
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, columns):
+    """Decode `cursor` into key values for `columns`; 400 if malformed."""
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded))
+
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError(cursor)
+
+        return tuple(
+            datetime.fromisoformat(value)
+            if column.type.python_type is datetime else
+            column.type.python_type(value)
+            for column, value in zip(columns, values)
+        )
+
+    except (ValueError, TypeError, binascii.Error):
+        abort(400, "Invalid page cursor.")
+
+
+def _key(parts):
+    """A (possibly composite) comparable key over columns or values."""
+
+    return parts[0] if len(parts) == 1 else tuple_(*parts)
+
+
+def paginate(query, columns, cursor_of, per_page=None):
+    """Return a Page of `query`, ordered newest-first by `columns`.
+
+    `columns` must be unique together (end with a primary key) and
+    `cursor_of(item)` returns an item's values for them. Cursors are read
+    from the `before`/`after` query string parameters.
+    """
+
+    per_page = per_page or current_app.config['PAGE_SIZE']
+    before = request.args.get('before')
+    after = request.args.get('after')
+    key = _key(columns)
+
+    if after:
+        values = decode_cursor(after, columns)
+        rows = (query
+                .filter(key > _key(values))
+                .order_by(*[column.asc() for column in columns])
+                .limit(per_page + 1)
+                .all())
+        has_newer = len(rows) > per_page
+        items = rows[:per_page][::-1]
+
+        return Page(
+            items,
+            before=encode_cursor(cursor_of(items[-1])) if items else after,
+            after=encode_cursor(cursor_of(items[0])) if has_newer else None,
+        )
+
+    if before:
+        values = decode_cursor(before, columns)
+        query = query.filter(key < _key(values))
+
+    rows = (query
+            .order_by(*[column.desc() for column in columns])
+            .limit(per_page + 1)
+            .all())
+    has_older = len(rows) > per_page
+    items = rows[:per_page]
+
+    return Page(
+        items,
+        before=encode_cursor(cursor_of(items[-1])) if has_older else None,
+        after=(encode_cursor(cursor_of(items[0])) if items else before)
+        if before else None,
+    )
+
+
+def paginate_ranked(rows, columns, per_page=None):
+    """Return a Page of `rows`, (key, item) pairs already sorted
+    newest/best-first by key, using the same cursors as `paginate`.
+
+    For results ranked in Python rather than in SQL; `columns` are only used
+    to decode cursors.
+    """
+
+    per_page = per_page or current_app.config['PAGE_SIZE']
+    before = request.args.get('before')
+    after = request.args.get('after')
+
+    if after:
+        values = decode_cursor(after, columns)
+        newer = [row for row in rows if row[0] > values]
+        has_newer = len(newer) > per_page
+        page = newer[-per_page:]
+
+        return Page(
+            [item for key, item in page],
+            before=encode_cursor(page[-1][0]) if page else after,
+            after=encode_cursor(page[0][0]) if has_newer else None,
+        )
+
+    if before:
+        values = decode_cursor(before, columns)
+        rows = [row for row in rows if row[0] < values]
+
+    page = rows[:per_page]
+    has_older = len(rows) > per_page
+
+    return Page(
+        [item for key, item in page],
+        before=encode_cursor(page[-1][0]) if has_older else None,
+        after=(encode_cursor(page[0][0]) if page else before)
+        if before else None,
+    )
@@ -0,0 +1,145 @@
+"""Password hashing for Warbler.
+
+bcrypt is deliberately slow, so hashing runs in a small process pool rather
+than on the request thread:
+
+- BCRYPT_LOG_ROUNDS is the work factor for new hashes. Hashes made with a
+  different factor are re-hashed the next time their user logs in.
+- PASSWORD_HASH_WORKERS processes do the hashing (0 hashes inline). Every
+  gunicorn worker starts its own pool, so by default each gets its share
+  of the CPUs: os.cpu_count() // WEB_CONCURRENCY, at least one.
+- At most PASSWORD_HASH_QUEUE hashes may be queued or running; past that,
+  callers get HasherBusy straight away (the app answers 503) instead of
+  piling up behind a login spike.
+
+The request still waits for its hash (`future.result()`), so the pool only
+frees a gunicorn worker to serve other requests meanwhile if it has more
+than one: gevent workers, or sync workers with GUNICORN_THREADS > 1. A
+single-threaded sync worker blocks either way, and gains only the queue
+bound.
+"""
+
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+import bcrypt
+from flask import current_app, has_app_context
+
+
+def default_workers(web_workers):
+    """Hashing processes per web worker, if `web_workers` share the CPUs."""
+
+    return max(1, (os.cpu_count() or 1) // max(1, web_workers))
+
+
+class HasherBusy(Exception):
+    """Too many password hashes are already queued; try again shortly."""
+
+
+# set by init_app, so that (like models.connect_db) scripts and tests can
+# hash passwords outside of an app context
+default_app = None
+
+
+def init_app(app):
+    """Use `app`'s config when there is no app context."""
+
+    global default_app
+    default_app = app
+
+
+def _app():
+    if has_app_context():
+        return current_app._get_current_object()
+
+    return default_app
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode("utf-8")
+
+
+def _check(hashed, password):
+    return bcrypt.checkpw(password, hashed)
+
+
+class PasswordHasher:
+    """Runs bcrypt in a process pool behind a bounded queue."""
+
+    def __init__(self, workers, queue_depth, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(queue_depth)
+        self.pool = None
+        self.pool_pid = None
+        self.lock = threading.Lock()
+
+    def _executor(self):
+        # pools don't survive fork, so each gunicorn worker makes its own
+        with self.lock:
+            if self.pool is None or self.pool_pid != os.getpid():
+                self.pool = ProcessPoolExecutor(self.workers)
+                self.pool_pid = os.getpid()
+
+            return self.pool
+
+    def run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+
+        if not self.slots.acquire(blocking=False):
+            raise HasherBusy()
+
+        try:
+            future = self._executor().submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+
+        future.add_done_callback(lambda future: self.slots.release())
+
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise HasherBusy()
+
+
+def _hasher():
+    app = _app()
+    hasher = app.extensions.get('warbler_password_hasher')
+
+    if hasher is None:
+        config = app.config
+        hasher = app.extensions['warbler_password_hasher'] = (
+            PasswordHasher(
+                config['PASSWORD_HASH_WORKERS'],
+                config['PASSWORD_HASH_QUEUE'],
+                config['PASSWORD_HASH_TIMEOUT']))
+
+    return hasher
+
+
+def hash_password(password):
+    """Return a bcrypt hash of `password` at the configured work factor."""
+
+    return _hasher().run(
+        _hash,
+        password.encode("utf-8"),
+        _app().config['BCRYPT_LOG_ROUNDS'])
+
+
+def check_password(hashed, password):
+    """Does `password` match the bcrypt hash `hashed`?"""
+
+    return _hasher().run(
+        _check, hashed.encode("utf-8"), password.encode("utf-8"))
+
+
+def needs_rehash(hashed):
+    """Was `hashed` made with a different work factor than configured?"""
+
+    # bcrypt hashes look like $2b$12$<salt+hash>
+    rounds = int(hashed.split("$")[2])
+
+    return rounds != _app().config['BCRYPT_LOG_ROUNDS']
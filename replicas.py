@@ -0,0 +1,229 @@
+"""Read replicas for Warbler.
+
+With DATABASE_REPLICA_URLS set (comma-separated database URLs), GET and HEAD
+requests read from a replica instead of the primary (DATABASE_URL):
+
+- Only plain SELECTs go to the replica. Flushes, INSERT/UPDATE/DELETE
+  statements, SELECT ... FOR UPDATE and anything else go to the primary,
+  whatever the request's method.
+- Read-your-writes: once a request has written, the rest of it reads from
+  the primary, and so do that browser's requests for the next
+  REPLICA_STICKY_SECONDS (remembered in the session cookie).
+- Health: each replica is checked at most every REPLICA_CHECK_INTERVAL
+  seconds, by the request that happens to pick it. A replica that can't be
+  reached, or is more than REPLICA_MAX_LAG seconds behind, is skipped until
+  a later check passes; with no healthy replica, reads use the primary. A
+  replica whose connection drops mid-request is marked down straight away
+  (that request fails; later ones go elsewhere).
+
+Keep REPLICA_MAX_LAG below REPLICA_STICKY_SECONDS, so a user never reads
+from a replica that hasn't caught up with their own writes.
+
+To try it with two local Postgres instances, make the second a streaming
+replica of the first:
+
+    pg_basebackup -D /tmp/replica -R -h localhost -p 5432
+    pg_ctl -D /tmp/replica -o "-p 5433" start
+
+    DATABASE_REPLICA_URLS=postgresql://localhost:5433/warbler flask run
+"""
+
+import logging
+import random
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.dml import UpdateBase
+
+import dbpool
+
+log = logging.getLogger("warbler.replicas")
+
+# session key: read from the primary until this time
+PRIMARY_UNTIL_KEY = "db_primary_until"
+
+# seconds to wait when connecting to a replica for a health check
+CONNECT_TIMEOUT = 2
+
+# seconds the replica is behind the primary; 0 when it has replayed all
+# the WAL it has received, NULL when it isn't a standby at all
+LAG_QUERY = text("""
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+""")
+
+
+##############################################################################
+# Replicas and their health
+
+
+class Replica:
+    """One replica's engine and its last health check."""
+
+    def __init__(self, url, max_lag, check_interval, config):
+        self.url = url
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+
+        options = dbpool.engine_options(config)
+        options["connect_args"] = {
+            **options.get("connect_args", {}),
+            "connect_timeout": CONNECT_TIMEOUT}
+        self.engine = create_engine(url, **options)
+        dbpool.init_engine(self.engine, config)
+        self.healthy = False
+        self.lag = None
+        self.checked_at = None
+        self._checking = threading.Lock()
+
+        event.listen(self.engine, "handle_error", self._handle_error)
+
+    def is_healthy(self):
+        """Whether to read from this replica, checking it first if the last
+        check is old (unless another thread is checking it already)."""
+
+        due = (self.checked_at is None
+               or time.monotonic() - self.checked_at >= self.check_interval)
+
+        if due and self._checking.acquire(blocking=False):
+            try:
+                self.check()
+            finally:
+                self._checking.release()
+
+        return self.healthy
+
+    def check(self):
+        """Connect and measure replication lag."""
+
+        try:
+            with self.engine.connect() as connection:
+                lag = connection.execute(LAG_QUERY).scalar()
+
+        except SQLAlchemyError as error:
+            if self.healthy or self.checked_at is None:
+                log.warning("replica %s is down: %s",
+                            self.engine.url, error)
+            self.healthy = False
+
+        else:
+            self.lag = float(lag or 0)
+            healthy = self.lag <= self.max_lag
+            if healthy != self.healthy:
+                log.warning("replica %s is %s (lag %.1fs)", self.engine.url,
+                            "up" if healthy else "lagging", self.lag)
+            self.healthy = healthy
+
+        self.checked_at = time.monotonic()
+
+    def _handle_error(self, context):
+        if context.is_disconnect or context.connection is None:
+            log.warning("replica %s is down: %s",
+                        self.engine.url, context.original_exception)
+            self.healthy = False
+            self.checked_at = time.monotonic()
+
+    def dispose(self):
+        self.engine.dispose()
+
+
+class ReplicaSet:
+    """The configured replicas; picks a healthy one for each request."""
+
+    def __init__(self, config):
+        self.replicas = [
+            Replica(url, config['REPLICA_MAX_LAG'],
+                    config['REPLICA_CHECK_INTERVAL'], config)
+            for url in config['DATABASE_REPLICA_URLS']]
+
+    def pick(self):
+        """Return the engine of a random healthy replica, or None."""
+
+        healthy = [
+            replica for replica in self.replicas if replica.is_healthy()]
+
+        if not healthy:
+            return None
+
+        return random.choice(healthy).engine
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica.dispose()
+
+
+##############################################################################
+# Routing
+
+
+def _is_read(clause):
+    return isinstance(clause, Select) and clause._for_update_arg is None
+
+
+class RoutingSession(SignallingSession):
+    """Sends the current request's reads to its replica, if it has one."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_request_context():
+            if self._flushing or isinstance(clause, UpdateBase):
+                g.db_wrote = True
+
+            elif (_is_read(clause) and not g.get("db_wrote")
+                    and g.get("db_replica") is not None):
+                return g.db_replica
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with sessions that can read from replicas."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def _choose_replica():
+    """Pick this request's replica: GETs only, and not just after a write."""
+
+    replicas = current_app.extensions['warbler_replicas']
+
+    if (not replicas.replicas or request.method not in ("GET", "HEAD")
+            or request.endpoint == "static"):
+        return
+
+    if session.get(PRIMARY_UNTIL_KEY, 0) > time.time():
+        return
+
+    g.db_replica = replicas.pick()
+
+
+def _remember_writes(response):
+    """After a write, keep reading from the primary for a while."""
+
+    if g.get("db_wrote"):
+        session[PRIMARY_UNTIL_KEY] = (
+            time.time() + current_app.config['REPLICA_STICKY_SECONDS'])
+
+    return response
+
+
+def init_replicas(app):
+    """Set up the replicas in DATABASE_REPLICA_URLS for `app`; call again
+    after changing the config (the old engines are closed)."""
+
+    old = app.extensions.get('warbler_replicas')
+
+    if old is None:
+        app.before_request(_choose_replica)
+        app.after_request(_remember_writes)
+    else:
+        old.dispose()
+
+    app.extensions['warbler_replicas'] = ReplicaSet(app.config)
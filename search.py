@@ -0,0 +1,434 @@
+"""Search backends for Warbler.
+
+Users
+-----
+
+Username search (/users?q=) matches usernames containing the query,
+case-insensitively, ranked by trigram similarity (which favours exact and
+prefix matches) and paged with (score, id) cursors.
+
+USER_SEARCH_BACKEND selects the implementation:
+
+- "trigram": Postgres pg_trgm; ILIKE served by a GIN trigram index
+             (`flask create-search-indexes`) and ranked by similarity()
+- "ngram":   an in-process trigram index built from the users table, for
+             databases without the pg_trgm extension (e.g. tests); queries
+             shorter than a trigram match username prefixes only
+- "auto":    (default) "trigram" if pg_trgm is installed, else "ngram"
+
+Messages
+--------
+
+Message search (/messages/search?q=) uses a Postgres full-text inverted
+index: each message's `search_vector` is set when it is posted and served
+by a GIN index, and deleting a message removes its entries. Queries
+combine plain words, "quoted phrases" and prefix* terms (all must match);
+results are ranked by relevance, then recency, and paged with
+(rank, timestamp, id) cursors. `flask rebuild-message-index` (re)indexes
+existing messages.
+"""
+
+import re
+import threading
+import time
+from bisect import bisect_left
+
+from flask import current_app
+from sqlalchemy import cast, func, text
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
+
+from models import db, Message, User
+from pagination import Page, paginate, paginate_ranked
+
+TRIGRAM_INDEX_DDL = (
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+    "ON users USING gin (username gin_trgm_ops)")
+
+
+##############################################################################
+# Trigram helpers shared by both backends
+
+
+def trigrams(value):
+    """Trigrams of `value` the way pg_trgm builds them: lowercased, each word
+    padded with two leading spaces and one trailing space."""
+
+    grams = set()
+    for word in value.lower().split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+
+    return grams
+
+
+def similarity(query_grams, value):
+    """pg_trgm-style similarity: shared trigrams over all trigrams."""
+
+    value_grams = trigrams(value)
+    union = len(query_grams | value_grams)
+
+    return len(query_grams & value_grams) / union if union else 0.0
+
+
+def _score_column():
+    """A pagination column for the similarity score (for cursor decoding)."""
+
+    return db.literal_column("score", db.Float)
+
+
+##############################################################################
+# Postgres pg_trgm backend
+
+
+_has_trigram = None
+
+
+def trigram_available():
+    """Is the pg_trgm extension installed in the connected database?"""
+
+    global _has_trigram
+
+    if _has_trigram is None:
+        _has_trigram = db.session.execute(text(
+            "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+        )).first() is not None
+
+    return _has_trigram
+
+
+def create_trigram_index():
+    """Install pg_trgm (if permitted) and the username trigram index."""
+
+    global _has_trigram
+
+    db.session.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    db.session.execute(text(TRIGRAM_INDEX_DDL))
+    _has_trigram = True
+
+
+def _escape_like(value):
+    return (value
+            .replace("\\", "\\\\")
+            .replace("%", "\\%")
+            .replace("_", "\\_"))
+
+
+def _trigram_score(query):
+    """Usernames' similarity() to `query`. It's a real; as a double the
+    cursor's value round-trips exactly, so rows tied with the last one on a
+    page aren't skipped."""
+
+    return cast(func.similarity(User.username, query), DOUBLE_PRECISION)
+
+
+def _trigram_search(query):
+    score = _trigram_score(query)
+
+    matches = (db.session
+               .query(User, score.label("score"))
+               .filter(User.username.ilike(
+                   f"%{_escape_like(query)}%", escape="\\")))
+
+    page = paginate(
+        matches,
+        (score, User.id),
+        lambda row: (row.score, row.User.id))
+    page.items = [row.User for row in page.items]
+
+    return page
+
+
+##############################################################################
+# In-process n-gram backend
+
+
+class NgramIndex:
+    """Trigram -> user id postings over every username, for substring search
+    without a database extension.
+
+    Built lazily from the users table and rebuilt once older than
+    USER_SEARCH_REFRESH seconds (so other workers' writes show up); writes
+    in this process are applied immediately with `add`/`remove`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.built_at = None
+        self.postings = {}
+        self.usernames = {}
+        self.sorted_names = None
+
+    def build(self):
+        postings = {}
+        usernames = {}
+
+        rows = (db.session
+                .query(User.id, User.username)
+                .yield_per(10000))
+
+        for user_id, username in rows:
+            usernames[user_id] = username.lower()
+            for gram in self._grams(username):
+                postings.setdefault(gram, set()).add(user_id)
+
+        with self.lock:
+            self.postings = postings
+            self.usernames = usernames
+            self.sorted_names = None
+            self.built_at = time.monotonic()
+
+    @staticmethod
+    def _grams(username):
+        """Unpadded trigrams, which is what a substring query can use."""
+
+        name = username.lower()
+        return {name[i:i + 3] for i in range(len(name) - 2)}
+
+    def is_stale(self, max_age):
+        return (self.built_at is None
+                or time.monotonic() - self.built_at > max_age)
+
+    def add(self, user_id, username):
+        with self.lock:
+            if self.built_at is None:
+                return
+
+            self._discard(user_id)
+            self.usernames[user_id] = username.lower()
+            for gram in self._grams(username):
+                self.postings.setdefault(gram, set()).add(user_id)
+            self.sorted_names = None
+
+    def remove(self, user_id):
+        with self.lock:
+            if self.built_at is None:
+                return
+
+            self._discard(user_id)
+            self.sorted_names = None
+
+    def _discard(self, user_id):
+        old = self.usernames.pop(user_id, None)
+        if old is not None:
+            for gram in self._grams(old):
+                self.postings.get(gram, set()).discard(user_id)
+
+    def _prefix_matches(self, query):
+        """Ids of usernames starting with a (shorter than a trigram) query."""
+
+        if self.sorted_names is None:
+            self.sorted_names = sorted(
+                (name, user_id) for user_id, name in self.usernames.items())
+
+        names = self.sorted_names
+        start = bisect_left(names, (query,))
+        matches = set()
+
+        for name, user_id in names[start:]:
+            if not name.startswith(query):
+                break
+            matches.add(user_id)
+
+        return matches
+
+    def search(self, query):
+        """Return ((score, id), user_id) pairs best-first for usernames
+        containing `query`."""
+
+        query = query.lower()
+
+        with self.lock:
+            if len(query) < 3:
+                candidates = self._prefix_matches(query)
+            else:
+                grams = sorted(
+                    (self.postings.get(gram, set())
+                     for gram in self._grams(query)),
+                    key=len)
+                candidates = set(grams[0]).intersection(*grams[1:])
+
+            names = {
+                user_id: self.usernames[user_id] for user_id in candidates}
+
+        query_grams = trigrams(query)
+        ranked = [
+            ((similarity(query_grams, name), user_id), user_id)
+            for user_id, name in names.items()
+            if query in name
+        ]
+        ranked.sort(reverse=True)
+
+        return ranked
+
+
+ngram_index = NgramIndex()
+
+
+def _ngram_search(query):
+    if ngram_index.is_stale(current_app.config['USER_SEARCH_REFRESH']):
+        ngram_index.build()
+
+    page = paginate_ranked(
+        ngram_index.search(query), (_score_column(), User.id))
+
+    users = {
+        user.id: user
+        for user in User.query.filter(User.id.in_(page.items))
+    }
+    page.items = [users[user_id] for user_id in page.items
+                  if user_id in users]
+
+    return page
+
+
+##############################################################################
+# Message full-text search
+
+
+PHRASE_OR_TERM = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def _language():
+    return current_app.config['MESSAGE_SEARCH_LANGUAGE']
+
+
+def message_document(text_column):
+    """The tsvector for a message's text."""
+
+    return func.to_tsvector(_language(), text_column)
+
+
+def parse_message_query(query):
+    """Build a tsquery from a search string, or None if it has no terms.
+
+    "quoted phrases" must appear in order, words ending in * match as
+    prefixes and other words match their stem; every part must match.
+    """
+
+    parts = []
+
+    for phrase, term in PHRASE_OR_TERM.findall(query):
+        if phrase:
+            if phrase.strip():
+                parts.append(func.phraseto_tsquery(_language(), phrase))
+
+        elif term.endswith("*"):
+            # to_tsquery has its own syntax, so only pass it word characters
+            words = re.findall(r"\w+", term)
+            if words:
+                prefix = " & ".join(words[:-1] + [f"{words[-1]}:*"])
+                parts.append(func.to_tsquery(_language(), prefix))
+
+        else:
+            parts.append(func.plainto_tsquery(_language(), term))
+
+    if not parts:
+        return None
+
+    tsquery = parts[0]
+    for part in parts[1:]:
+        tsquery = tsquery.op("&&")(part)
+
+    return tsquery
+
+
+def index_message(message):
+    """Set the search document of a new (or re-indexed) message."""
+
+    message.search_vector = message_document(message.text)
+
+
+def reindex_messages(batch_size=10000):
+    """Recompute every message's search document, committing each batch of
+    ids so no single transaction covers the whole table.
+
+    Returns the number of messages indexed.
+    """
+
+    total = 0
+    last_id = 0
+
+    while True:
+        upper = (db.session
+                 .query(Message.id)
+                 .filter(Message.id > last_id)
+                 .order_by(Message.id)
+                 .offset(batch_size - 1)
+                 .limit(1)
+                 .scalar())
+
+        batch = Message.query.filter(Message.id > last_id)
+        if upper is not None:
+            batch = batch.filter(Message.id <= upper)
+
+        total += batch.update(
+            {Message.search_vector: message_document(Message.text)},
+            synchronize_session=False)
+        db.session.commit()
+
+        if upper is None:
+            return total
+
+        last_id = upper
+
+
+def search_messages(query):
+    """Return a pagination.Page of messages matching `query`, most relevant
+    (then most recent) first."""
+
+    tsquery = parse_message_query(query)
+    if tsquery is None:
+        return Page([])
+
+    # ts_rank_cd is a real; as a double the cursor's value round-trips
+    # exactly, so rows tied with the last one on a page aren't skipped
+    rank = cast(
+        func.ts_rank_cd(Message.search_vector, tsquery), DOUBLE_PRECISION)
+
+    matches = (db.session
+               .query(Message, rank.label("rank"))
+               .options(db.selectinload(Message.user))
+               .filter(Message.search_vector.op("@@")(tsquery)))
+
+    page = paginate(
+        matches,
+        (rank, Message.timestamp, Message.id),
+        lambda row: (row.rank, row.Message.timestamp, row.Message.id))
+    page.items = [row.Message for row in page.items]
+
+    return page
+
+
+##############################################################################
+# Public API
+
+
+def _backend():
+    backend = current_app.config['USER_SEARCH_BACKEND']
+
+    if backend == "auto":
+        return "trigram" if trigram_available() else "ngram"
+
+    return backend
+
+
+def search_users(query):
+    """Return a pagination.Page of users whose username contains `query`,
+    best match first."""
+
+    if _backend() == "trigram":
+        return _trigram_search(query)
+
+    return _ngram_search(query)
+
+
+def user_changed(user):
+    """Reflect a signup or username change in the in-process index."""
+
+    ngram_index.add(user.id, user.username)
+
+
+def user_deleted(user_id):
+    """Drop a deleted user from the in-process index."""
+
+    ngram_index.remove(user_id)
@@ -1,19 +1,26 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+Drops and recreates every table, then streams the CSVs in generator/ (or
+--directory) into Postgres with COPY; see loader.py. The schema is then
+marked as up to date for `flask db upgrade`.
+"""
 
-db.drop_all()
-db.create_all()
+import argparse
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+from flask_migrate import stamp
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+from app import app
+import loader
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+parser = argparse.ArgumentParser(description="Seed the Warbler database.")
+parser.add_argument("--directory", default="generator",
+                    help="directory holding users/messages/follows/likes.csv")
+parser.add_argument("--chunk-mb", type=int, default=8,
+                    help="size of each COPY chunk in megabytes")
+args = parser.parse_args()
 
-db.session.commit()
+with app.app_context():
+    loader.load(args.directory, chunk_bytes=args.chunk_mb * 1024 * 1024)
+
+    # the tables were made from the models, so they match the latest migration
+    stamp()
@@ -0,0 +1,422 @@
+"""Server-side sessions for Warbler.
+
+SESSION_BACKEND selects where session data lives:
+
+- "cookie": (default) Flask's signed cookie holds the whole session
+- "memory": a dict in each process (for a single worker, or tests)
+- "sqlite": a SQLite file (SESSION_SQLITE_PATH) shared by every worker on
+            the box, and readable only by the app's user
+
+With a server-side backend the cookie holds only a random session id, and
+the session can also keep a snapshot of the logged-in user's columns (see
+cache.load_user), so most requests don't need the user cache. A snapshot is
+trusted for at most USER_CACHE_TTL seconds. Flask-WTF's
+CSRF token and flashed messages live there too.
+
+Sessions are stored in a compact binary encoding and expire
+PERMANENT_SESSION_LIFETIME after they were last saved; a session in use is
+re-saved once half of that has passed. Expired sessions are ignored when
+read and deleted in sweeps every SESSION_SWEEP_INTERVAL seconds, done by
+whichever request saves a session next. Logging in gets a fresh session id,
+and revoke_user ends all of a user's sessions at once (e.g. when their
+account is deleted).
+"""
+
+import os
+import secrets
+import sqlite3
+import struct
+import threading
+import time
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+COOKIE_BACKEND = "cookie"
+
+
+##############################################################################
+# Encoding
+#
+# A tag byte, then for ints a zigzag varint, for str/bytes a varint length
+# and the bytes, for lists/tuples/dicts a varint count and the items.
+
+
+_float = struct.Struct("<d")
+
+
+def _write_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, position):
+    value = shift = 0
+
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def _encode(out, value):
+    if value is None:
+        out += b"N"
+    elif value is True:
+        out += b"T"
+    elif value is False:
+        out += b"F"
+    elif isinstance(value, int):
+        out += b"i"
+        _write_varint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+    elif isinstance(value, float):
+        out += b"f" + _float.pack(value)
+    elif isinstance(value, str):
+        encoded = value.encode()
+        out += b"s"
+        _write_varint(out, len(encoded))
+        out += encoded
+    elif isinstance(value, bytes):
+        out += b"b"
+        _write_varint(out, len(value))
+        out += value
+    elif isinstance(value, (list, tuple)):
+        out += b"l" if isinstance(value, list) else b"t"
+        _write_varint(out, len(value))
+        for item in value:
+            _encode(out, item)
+    elif isinstance(value, dict):
+        out += b"d"
+        _write_varint(out, len(value))
+        for key, item in value.items():
+            _encode(out, key)
+            _encode(out, item)
+    else:
+        raise TypeError(f"can't store {type(value).__name__} in a session")
+
+
+def _decode(data, position):
+    tag = data[position]
+    position += 1
+
+    if tag == 0x4e:  # N
+        return None, position
+    if tag == 0x54:  # T
+        return True, position
+    if tag == 0x46:  # F
+        return False, position
+    if tag == 0x69:  # i
+        value, position = _read_varint(data, position)
+        return (value >> 1) ^ -(value & 1), position
+    if tag == 0x66:  # f
+        return _float.unpack_from(data, position)[0], position + 8
+
+    length, position = _read_varint(data, position)
+
+    if tag == 0x73:  # s
+        end = position + length
+        return bytes(data[position:end]).decode(), end
+    if tag == 0x62:  # b
+        end = position + length
+        return bytes(data[position:end]), end
+    if tag in (0x6c, 0x74):  # l, t
+        items = []
+        for i in range(length):
+            item, position = _decode(data, position)
+            items.append(item)
+        return (items if tag == 0x6c else tuple(items)), position
+    if tag == 0x64:  # d
+        items = {}
+        for i in range(length):
+            key, position = _decode(data, position)
+            items[key], position = _decode(data, position)
+        return items, position
+
+    raise ValueError(f"bad session data tag {tag!r}")
+
+
+def encode(value):
+    """Encode session data (None, bools, ints, floats, str, bytes, and
+    lists, tuples and dicts of them) as bytes."""
+
+    out = bytearray()
+    _encode(out, value)
+    return bytes(out)
+
+
+def decode(data):
+    """Inverse of encode."""
+
+    value, position = _decode(memoryview(data), 0)
+    return value
+
+
+##############################################################################
+# Stores
+
+
+class MemoryStore:
+    """Sessions in a dict in this process."""
+
+    def __init__(self, sweep_interval=300):
+        self.sessions = {}
+        self.by_user = {}
+        self.lock = threading.Lock()
+        self.sweep_interval = sweep_interval
+        self.swept_at = time.time()
+
+    def get(self, sid):
+        entry = self.sessions.get(sid)
+
+        if entry is None or entry[0] < time.time():
+            return None
+
+        return entry
+
+    def set(self, sid, data, expires, user_id):
+        with self.lock:
+            self._forget(sid)
+            self.sessions[sid] = (expires, data, user_id)
+            if user_id is not None:
+                self.by_user.setdefault(user_id, set()).add(sid)
+
+        if time.time() - self.swept_at >= self.sweep_interval:
+            self.sweep()
+
+    def delete(self, sid):
+        with self.lock:
+            self._forget(sid)
+
+    def delete_user(self, user_id):
+        with self.lock:
+            for sid in self.by_user.pop(user_id, ()):
+                self.sessions.pop(sid, None)
+
+    def sweep(self):
+        """Delete expired sessions."""
+
+        now = self.swept_at = time.time()
+
+        with self.lock:
+            expired = [
+                sid for sid, (expires, data, user_id) in self.sessions.items()
+                if expires < now]
+            for sid in expired:
+                self._forget(sid)
+
+    def _forget(self, sid):
+        entry = self.sessions.pop(sid, None)
+
+        if entry is not None and entry[2] is not None:
+            sids = self.by_user.get(entry[2])
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del self.by_user[entry[2]]
+
+
+class SQLiteStore:
+    """Sessions in a SQLite file shared by the processes on this box.
+
+    Session ids are credentials, so the file is kept private to the app's
+    user (mode 0600; SQLite gives its -wal and -shm files the same mode).
+    A file at `path` owned by anyone else is refused.
+    """
+
+    def __init__(self, path, sweep_interval=300):
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self.swept_at = time.time()
+        self.local = threading.local()
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            if os.fstat(fd).st_uid != os.getuid():
+                raise PermissionError(f"{path} is another user's")
+            os.fchmod(fd, 0o600)
+        finally:
+            os.close(fd)
+
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                sid TEXT PRIMARY KEY,
+                expires REAL NOT NULL,
+                data BLOB NOT NULL,
+                user_id INTEGER
+            ) WITHOUT ROWID""")
+        connection.execute("""
+            CREATE INDEX IF NOT EXISTS ix_sessions_user_id
+            ON sessions (user_id)""")
+        connection.execute("""
+            CREATE INDEX IF NOT EXISTS ix_sessions_expires
+            ON sessions (expires)""")
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+
+        if connection is None:
+            connection = self.local.connection = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA synchronous = NORMAL")
+
+        return connection
+
+    def get(self, sid):
+        return self._connection().execute(
+            "SELECT expires, data, user_id FROM sessions "
+            "WHERE sid = ? AND expires >= ?", (sid, time.time())).fetchone()
+
+    def set(self, sid, data, expires, user_id):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO sessions (sid, expires, data, user_id) "
+            "VALUES (?, ?, ?, ?)", (sid, expires, data, user_id))
+
+        if time.time() - self.swept_at >= self.sweep_interval:
+            self.sweep()
+
+    def delete(self, sid):
+        self._connection().execute(
+            "DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def delete_user(self, user_id):
+        self._connection().execute(
+            "DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    def sweep(self):
+        """Delete expired sessions."""
+
+        self.swept_at = time.time()
+        self._connection().execute(
+            "DELETE FROM sessions WHERE expires < ?", (self.swept_at,))
+
+
+##############################################################################
+# Flask integration
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """A session whose data is kept in a store, under a random id."""
+
+    def __init__(self, initial=None, sid=None, expires=None):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires = expires
+        self.previous_sid = None
+        self.modified = False
+
+    def regenerate(self):
+        """Move the session to a new id, e.g. on login, so an id learned
+        before then is no use."""
+
+        if self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = None
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    """Flask session interface for a MemoryStore or SQLiteStore; sessions
+    are indexed by the user id under `user_key`."""
+
+    def __init__(self, store, user_key):
+        self.store = store
+        self.user_key = user_key
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+
+        if sid:
+            entry = self.store.get(sid)
+            if entry is not None:
+                expires, data, user_id = entry
+                return ServerSession(decode(data), sid, expires)
+
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.previous_sid is not None:
+            self.store.delete(session.previous_sid)
+
+        if not session:
+            if session.sid is not None and session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        now = time.time()
+        # sliding expiry, without a write on every request
+        stale = (session.expires is not None
+                 and session.expires - now < lifetime / 2)
+
+        if not (session.modified or stale or session.sid is None):
+            return
+
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(24)
+
+        self.store.set(
+            session.sid, encode(dict(session)), now + lifetime,
+            session.get(self.user_key))
+
+        response.set_cookie(
+            name, session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app))
+
+
+def init_sessions(app, user_key):
+    """Use the session backend in app.config['SESSION_BACKEND'], with the
+    logged-in user's id kept under `user_key`; call again after changing
+    the backend."""
+
+    backend = app.config['SESSION_BACKEND']
+    interval = app.config['SESSION_SWEEP_INTERVAL']
+
+    if backend == COOKIE_BACKEND:
+        app.session_interface = app.__class__.session_interface
+    elif backend == "memory":
+        app.session_interface = ServerSessionInterface(
+            MemoryStore(interval), user_key)
+    elif backend == "sqlite":
+        app.session_interface = ServerSessionInterface(
+            SQLiteStore(app.config['SESSION_SQLITE_PATH'], interval),
+            user_key)
+    else:
+        raise ValueError(f"unknown SESSION_BACKEND {backend!r}")
+
+
+def is_server_side(app):
+    return isinstance(app.session_interface, ServerSessionInterface)
+
+
+def regenerate(session):
+    """Give a server-side session a new id (no-op for cookie sessions)."""
+
+    if isinstance(session, ServerSession):
+        session.regenerate()
+
+
+def revoke_user(app, user_id):
+    """End every session `user_id` is logged in with."""
+
+    if is_server_side(app):
+        app.session_interface.store.delete_user(user_id)
@@ -0,0 +1,150 @@
+// Infinite scroll and in-place like toggles for message lists.
+//
+// A list like <ul id="messages" data-source="/api/timeline" data-before="...">
+// loads older pages from the JSON API as it scrolls into view, and like
+// buttons (.like-form) toggle through the API instead of reloading the page.
+// Without JavaScript, the pager links and plain form posts still work.
+
+(function () {
+  "use strict";
+
+  const csrfMeta = document.querySelector('meta[name="csrf-token"]');
+  const csrfToken = csrfMeta ? csrfMeta.content : "";
+
+  function api(method, url) {
+    return fetch(url, {
+      method: method,
+      credentials: "same-origin",
+      headers: { "Accept": "application/json", "X-CSRFToken": csrfToken },
+    }).then(function (resp) {
+      if (!resp.ok) throw new Error(`${method} ${url}: ${resp.status}`);
+      return resp.json();
+    });
+  }
+
+  // Like toggles
+
+  function setLiked(form, liked) {
+    form.dataset.liked = liked ? "true" : "false";
+    const icon = form.querySelector("i");
+    if (icon) icon.className = liked ? "bi bi-star-fill" : "bi bi-star";
+  }
+
+  document.addEventListener("click", function (evt) {
+    const button = evt.target.closest(".like-form button");
+    if (!button) return;
+
+    evt.preventDefault();
+    const form = button.closest(".like-form");
+    if (!form.querySelector("i")) return;  // your own message
+    const liked = form.dataset.liked === "true";
+
+    setLiked(form, !liked);
+    api(liked ? "DELETE" : "POST", `/api/messages/${form.dataset.messageId}/like`)
+      .then(function (data) { setLiked(form, data.liked); })
+      .catch(function () { setLiked(form, liked); });
+  });
+
+  // Infinite scroll
+
+  const list = document.querySelector("#messages[data-source]");
+  if (!list) return;
+
+  let before = list.dataset.before;
+  let loading = false;
+  const viewerId = Number(list.dataset.userId);
+
+  function formatDate(timestamp) {
+    // timestamps are UTC without a zone; show them like the server does
+    const [year, month, day] = timestamp.slice(0, 10).split("-").map(Number);
+    return new Date(Date.UTC(year, month - 1, day)).toLocaleDateString(
+      "en-GB", { day: "2-digit", month: "long", year: "numeric", timeZone: "UTC" });
+  }
+
+  function element(tag, attrs, children) {
+    const el = document.createElement(tag);
+    for (const [name, value] of Object.entries(attrs || {})) {
+      el.setAttribute(name, value);
+    }
+    for (const child of children || []) {
+      el.append(child);
+    }
+    return el;
+  }
+
+  function renderMessage(msg, user) {
+    const profile = `/users/${msg.user_id}`;
+    const text = element("p");
+    text.textContent = msg.text;
+
+    const button = element("button", { type: "submit", class: "btn btn-link" });
+    if (msg.user_id !== viewerId) {
+      button.append(element("i", { class: msg.liked ? "bi bi-star-fill" : "bi bi-star" }));
+    }
+
+    const form = element("form", {
+      action: `/messages/${msg.id}/like`,
+      method: "POST",
+      class: "like-form",
+      "data-message-id": msg.id,
+      "data-liked": msg.liked ? "true" : "false",
+    }, [
+      element("input", { type: "hidden", name: "csrf_token", value: csrfToken }),
+      button,
+    ]);
+
+    const username = element("a", { href: profile });
+    username.textContent = `@${user.username}`;
+    const date = element("span", { class: "text-muted" });
+    date.textContent = formatDate(msg.timestamp);
+
+    return element("li", { class: "list-group-item" }, [
+      element("a", { href: `/messages/${msg.id}`, class: "message-link" }),
+      element("a", { href: profile }, [
+        element("img", { src: user.image_url, alt: "", class: "timeline-image" }),
+      ]),
+      element("div", { class: "message-area" }, [username, " ", date, text]),
+      element("div", { class: "like-btn" }, [form]),
+    ]);
+  }
+
+  const sentinel = document.createElement("div");
+  list.after(sentinel);
+
+  // scrolling replaces the "Older" link
+  const older = document.querySelector('.pager a[href*="before="]');
+  if (older) older.hidden = true;
+
+  function nearBottom() {
+    return sentinel.getBoundingClientRect().top < window.innerHeight + 600;
+  }
+
+  function loadMore() {
+    if (loading || !before) return;
+    loading = true;
+
+    const url = new URL(list.dataset.source, window.location.origin);
+    url.searchParams.set("before", before);
+
+    api("GET", url)
+      .then(function (data) {
+        for (const msg of data.messages) {
+          list.append(renderMessage(msg, data.users[msg.user_id]));
+        }
+        before = data.before;
+      })
+      .catch(function () {
+        // leave the pager link for the user to try instead
+        before = null;
+        if (older) older.hidden = false;
+      })
+      .finally(function () {
+        loading = false;
+        if (nearBottom()) loadMore();
+      });
+  }
+
+  new IntersectionObserver(function (entries) {
+    if (entries[0].isIntersecting) loadMore();
+  }, { rootMargin: "600px" }).observe(sentinel);
+})();
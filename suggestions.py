@@ -0,0 +1,460 @@
+""""Who to follow" suggestions for Warbler.
+
+A user's candidates are the accounts followed by the people they follow,
+scored by how many of those people follow them (excluding the user and
+anyone they already follow). The top SUGGESTIONS_TOP_K are stored per user
+in `follow_suggestions`, one row of parallel arrays, so the home sidebar
+reads them with a primary key lookup.
+
+Keeping them current:
+
+- Follows and unfollows queue a `suggestion_updates` row in the same
+  transaction; `flask suggestions-worker` applies them. For a queued
+  (user, followed) pair the user's list is recomputed, and `followed`'s
+  score is recomputed for each of the user's followers (the only other
+  lists the change can affect). Workers claim batches with SKIP LOCKED,
+  so several can run at once.
+- `flask rebuild-suggestions` recomputes every list from the whole graph,
+  to start with or to repair drift. An incremental update can only move the
+  changed account within a list, so an account pushed out of someone's top
+  K by it won't come back until the next rebuild.
+
+The rebuild holds the graph as compressed sparse rows: an offsets array
+(8 bytes per user id) and the followed ids in one flat array (4 bytes per
+follow) kept in a memory-mapped temporary file, so the operating system
+pages edges in and out under memory pressure rather than the process
+holding them all. Scoring one user reads at most SUGGESTIONS_MAX_SCAN
+follows, which bounds both its time and its counter's memory.
+"""
+
+import heapq
+import io
+import mmap
+import tempfile
+import time
+from array import array
+from collections import Counter
+from itertools import accumulate
+
+from flask import current_app
+from sqlalchemy import and_, delete, exists, func, select, true, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import aliased
+
+from models import db, Follows, FollowSuggestion, SuggestionUpdate, User
+
+# followers of the changed user updated per statement
+FOLLOWER_BATCH = 1000
+
+# users scored per COPY during a rebuild
+COPY_BATCH = 10000
+
+
+##############################################################################
+# Reading
+
+
+def for_user(user, limit):
+    """Return up to `limit` (User, score) suggestions for `user`, leaving
+    out anyone they've followed since the list was computed.
+
+    One query: the user's row, unnested in order and joined to users.
+    """
+
+    suggested = (
+        func.unnest(FollowSuggestion.suggested_ids, FollowSuggestion.scores)
+        .table_valued("user_id", "score", with_ordinality="position")
+        .render_derived())
+
+    already_following = exists().where(
+        Follows.user_following_id == user.id,
+        Follows.user_being_followed_id == User.id)
+
+    return (db.session
+            .query(User, suggested.c.score)
+            .select_from(FollowSuggestion)
+            .join(suggested, true())
+            .join(User, User.id == suggested.c.user_id)
+            .filter(FollowSuggestion.user_id == user.id, ~already_following)
+            .order_by(suggested.c.position)
+            .limit(limit)
+            .all())
+
+
+##############################################################################
+# Incremental updates
+
+
+def enqueue(user_id, followed_ids):
+    """Queue the effect of `user_id` following or unfollowing the users in
+    `followed_ids`; applied once the transaction commits and a worker runs."""
+
+    if not followed_ids:
+        return
+
+    db.session.execute(
+        insert(SuggestionUpdate.__table__)
+        .values([{"user_id": user_id, "followed_id": followed_id}
+                 for followed_id in followed_ids])
+        .on_conflict_do_nothing())
+
+
+def _top_k():
+    return current_app.config['SUGGESTIONS_TOP_K']
+
+
+def _ranked(ids_and_scores, k):
+    """The best `k` (id, score) pairs: highest score, then lowest id."""
+
+    return heapq.nlargest(
+        k, ids_and_scores, key=lambda pair: (pair[1], -pair[0]))
+
+
+def _save(lists):
+    """Upsert {user id: [(suggested id, score)]}."""
+
+    if not lists:
+        return
+
+    stmt = insert(FollowSuggestion.__table__).values([
+        {
+            "user_id": user_id,
+            "suggested_ids": [suggested for suggested, score in pairs],
+            "scores": [score for suggested, score in pairs],
+        }
+        for user_id, pairs in lists.items()])
+
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=["user_id"],
+        set_={
+            "suggested_ids": stmt.excluded.suggested_ids,
+            "scores": stmt.excluded.scores,
+            "updated_at": func.now(),
+        }))
+
+
+def recompute(user_ids):
+    """Recompute and save the full lists of `user_ids` with SQL."""
+
+    if not user_ids:
+        return
+
+    you = aliased(Follows)
+    them = aliased(Follows)
+
+    already_following = exists().where(
+        Follows.user_following_id == you.user_following_id,
+        Follows.user_being_followed_id == them.user_being_followed_id)
+
+    candidates = (
+        select(
+            you.user_following_id.label("user_id"),
+            them.user_being_followed_id.label("suggested_id"),
+            func.count().label("score"))
+        .join(them, them.user_following_id == you.user_being_followed_id)
+        .where(
+            you.user_following_id.in_(user_ids),
+            them.user_being_followed_id != you.user_following_id,
+            ~already_following)
+        .group_by(you.user_following_id, them.user_being_followed_id)
+        .subquery())
+
+    rank = func.row_number().over(
+        partition_by=candidates.c.user_id,
+        order_by=(candidates.c.score.desc(), candidates.c.suggested_id))
+    ranked = select(candidates, rank.label("rank")).subquery()
+
+    lists = {user_id: [] for user_id in user_ids}
+    rows = db.session.execute(
+        select(ranked.c.user_id, ranked.c.suggested_id, ranked.c.score)
+        .where(ranked.c.rank <= _top_k())
+        .order_by(ranked.c.user_id, ranked.c.rank))
+
+    for user_id, suggested_id, score in rows:
+        lists[user_id].append((suggested_id, score))
+
+    _save(lists)
+
+
+def merge(pairs, suggested_id, score, k):
+    """Return the list of (id, score) `pairs` with `suggested_id` re-scored
+    (dropped if `score` is 0), best `k` first."""
+
+    pairs = [pair for pair in pairs if pair[0] != suggested_id]
+    if score:
+        pairs.append((suggested_id, score))
+
+    return _ranked(pairs, k)
+
+
+def _rescore_followers(user_id, followed_id):
+    """Recompute `followed_id`'s score in the list of each of `user_id`'s
+    followers, a batch of followers at a time."""
+
+    k = _top_k()
+    last_id = 0
+
+    while True:
+        followers = [
+            follower_id for (follower_id,) in db.session.execute(
+                select(Follows.user_following_id)
+                .where(Follows.user_being_followed_id == user_id,
+                       Follows.user_following_id > last_id,
+                       Follows.user_following_id != followed_id)
+                .order_by(Follows.user_following_id)
+                .limit(FOLLOWER_BATCH))]
+
+        if not followers:
+            return
+
+        last_id = followers[-1]
+
+        # how many of each follower's followees follow `followed_id`
+        you = aliased(Follows)
+        them = aliased(Follows)
+        scores = dict(db.session.execute(
+            select(you.user_following_id, func.count())
+            .join(them, and_(
+                them.user_following_id == you.user_being_followed_id,
+                them.user_being_followed_id == followed_id))
+            .where(you.user_following_id.in_(followers))
+            .group_by(you.user_following_id)).all())
+
+        following = {
+            follower_id for (follower_id,) in db.session.execute(
+                select(Follows.user_following_id)
+                .where(Follows.user_being_followed_id == followed_id,
+                       Follows.user_following_id.in_(followers)))}
+
+        rows = {
+            row.user_id: row for row in
+            FollowSuggestion.query.filter(
+                FollowSuggestion.user_id.in_(followers))}
+
+        # followers with no list yet get a full one
+        recompute([
+            follower_id for follower_id in followers
+            if follower_id not in rows])
+
+        lists = {}
+        for follower_id, row in rows.items():
+            score = 0 if follower_id in following else scores.get(
+                follower_id, 0)
+            pairs = list(zip(row.suggested_ids, row.scores))
+            updated = merge(pairs, followed_id, score, k)
+
+            if updated != pairs:
+                lists[follower_id] = updated
+
+        _save(lists)
+
+
+def process_updates(limit=100):
+    """Claim and apply up to `limit` queued updates, oldest first, and
+    commit. Returns how many were applied."""
+
+    oldest = (select(SuggestionUpdate.user_id, SuggestionUpdate.followed_id)
+              .order_by(SuggestionUpdate.queued_at)
+              .limit(limit)
+              .with_for_update(skip_locked=True))
+
+    claimed = db.session.execute(
+        delete(SuggestionUpdate)
+        .where(tuple_(SuggestionUpdate.user_id,
+                      SuggestionUpdate.followed_id).in_(oldest))
+        .returning(SuggestionUpdate.user_id, SuggestionUpdate.followed_id)
+        .execution_options(synchronize_session=False)
+    ).all()
+
+    if claimed:
+        recompute(sorted({user_id for user_id, followed_id in claimed}))
+
+        for user_id, followed_id in claimed:
+            _rescore_followers(user_id, followed_id)
+
+    db.session.commit()
+
+    return len(claimed)
+
+
+def run_worker(batch=100, interval=1.0, once=False, report=print):
+    """Apply queued updates as they arrive, polling every `interval`
+    seconds when the queue is empty; with `once`, stop when it is."""
+
+    while True:
+        applied = process_updates(batch)
+
+        if applied:
+            report(f"Applied {applied} suggestion updates")
+        elif once:
+            return
+        else:
+            time.sleep(interval)
+
+
+##############################################################################
+# Full rebuild
+
+
+class FollowGraph:
+    """Who follows whom, as compressed sparse rows: the ids user `u` follows
+    are targets[offsets[u]:offsets[u + 1]]."""
+
+    def __init__(self, offsets, targets):
+        self.offsets = offsets
+        self.targets = targets
+
+    @classmethod
+    def load(cls, connection, directory=None):
+        """Read every follow through the DB-API `connection`, with the
+        targets array in a memory-mapped temporary file in `directory`.
+
+        The reads share one snapshot, in a read-only transaction that is
+        ended (rolled back) before returning, so follows and users committed
+        meanwhile can't disagree with the counts the offsets come from.
+        """
+
+        cursor = connection.cursor()
+        cursor.execute(
+            "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        cursor.execute("SELECT coalesce(max(id), 0) FROM users")
+        (max_id,) = cursor.fetchone()
+
+        # counts, then running totals: offsets[u] is where u's follows start
+        counts = array('q', bytes(8 * (max_id + 2)))
+        cursor.execute(
+            "SELECT user_following_id, count(*) FROM follows GROUP BY 1")
+        for user_id, count in cursor:
+            if user_id <= max_id:
+                counts[user_id + 1] = count
+
+        offsets = array('q', accumulate(counts))
+        del counts
+
+        edges = offsets[max_id + 1]
+        if edges:
+            mapped = tempfile.TemporaryFile(dir=directory)
+            mapped.truncate(4 * edges)
+            targets = memoryview(
+                mmap.mmap(mapped.fileno(), 4 * edges)).cast('i')
+            mapped.close()
+        else:
+            targets = array('i')
+
+        # a named cursor streams the follows instead of fetching them all
+        next_free = array('q', offsets)
+        stream = connection.cursor(name="follow_graph")
+        stream.itersize = 100000
+        stream.execute(
+            "SELECT user_following_id, user_being_followed_id FROM follows")
+
+        # the snapshot should make these checks moot, but a row that doesn't
+        # fit the counts is dropped rather than written over another user's
+        for user_id, followed_id in stream:
+            if user_id > max_id or followed_id > max_id:
+                continue
+
+            position = next_free[user_id]
+            if position == offsets[user_id + 1]:
+                continue
+
+            targets[position] = followed_id
+            next_free[user_id] = position + 1
+
+        stream.close()
+        connection.rollback()
+
+        return cls(offsets, targets)
+
+    @property
+    def max_id(self):
+        return len(self.offsets) - 2
+
+    def following(self, user_id):
+        return self.targets[self.offsets[user_id]:self.offsets[user_id + 1]]
+
+    def suggestions(self, user_id, k, max_scan):
+        """The top `k` (id, score) suggestions for `user_id`, reading at
+        most `max_scan` follows of the people they follow."""
+
+        following = self.following(user_id)
+        counts = Counter()
+        budget = max_scan
+
+        for followed_id in following:
+            theirs = self.following(followed_id)[:budget]
+            counts.update(theirs)
+            budget -= len(theirs)
+
+            if not budget:
+                break
+
+        counts.pop(user_id, None)
+        for followed_id in following:
+            counts.pop(followed_id, None)
+
+        return _ranked(counts.items(), k)
+
+
+def _array_literal(values):
+    return "{" + ",".join(map(str, values)) + "}"
+
+
+def rebuild(directory=None, report=print):
+    """Recompute every user's suggestions from the whole follow graph.
+
+    Returns the number of users with suggestions.
+    """
+
+    k = _top_k()
+    max_scan = current_app.config['SUGGESTIONS_MAX_SCAN']
+    connection = db.engine.raw_connection()
+    saved = 0
+
+    try:
+        started = time.perf_counter()
+        graph = FollowGraph.load(connection, directory)
+        report(f"Loaded {len(graph.targets):,} follows in "
+               f"{time.perf_counter() - started:.1f}s")
+
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM follow_suggestions")
+
+        rows = io.StringIO()
+        batched = 0
+
+        for user_id in range(1, graph.max_id + 1):
+            pairs = graph.suggestions(user_id, k, max_scan)
+            if not pairs:
+                continue
+
+            rows.write(
+                f"{user_id}\t"
+                f"{_array_literal(suggested for suggested, score in pairs)}\t"
+                f"{_array_literal(score for suggested, score in pairs)}\n")
+            batched += 1
+
+            if batched == COPY_BATCH:
+                saved += _copy(cursor, rows)
+                rows = io.StringIO()
+                batched = 0
+
+        saved += _copy(cursor, rows)
+        connection.commit()
+
+    finally:
+        connection.close()
+
+    report(f"Saved suggestions for {saved:,} users in "
+           f"{time.perf_counter() - started:.1f}s")
+
+    return saved
+
+
+def _copy(cursor, rows):
+    rows.seek(0)
+    cursor.copy_expert(
+        "COPY follow_suggestions (user_id, suggested_ids, scores) "
+        "FROM STDIN", rows)
+
+    return cursor.rowcount
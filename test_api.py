@@ -0,0 +1,233 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Like, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from test_query_counts import count_queries
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class APITestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        messages = [
+            Message(text=f"message {i}", user_id=u2.id) for i in range(5)]
+        db.session.add_all(messages)
+        db.session.add(Follows(
+            user_being_followed_id=u2.id, user_following_id=u1.id))
+        u1.following_count = u2.followers_count = 1
+        u2.messages_count = len(messages)
+        db.session.commit()
+
+        self.message_ids = [msg.id for msg in messages]
+        db.session.add(Like(user_id=u1.id, message_id=self.message_ids[0]))
+        u1.likes_count = 1
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        app.config['PAGE_SIZE'] = 3
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['PAGE_SIZE'] = 50
+        app.config['WTF_CSRF_ENABLED'] = False
+
+    def test_timeline_pages(self):
+        """Tests the timeline comes in pages linked by cursors"""
+        resp = self.client.get("/api/timeline")
+        first = resp.get_json()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(first["messages"]), 3)
+        self.assertEqual(
+            first["users"], {str(self.u2_id): {
+                "username": "u2",
+                "image_url": User.query.get(self.u2_id).image_url}})
+        self.assertIsNotNone(first["before"])
+
+        second = self.client.get(
+            f"/api/timeline?before={first['before']}").get_json()
+        ids = [msg["id"] for msg in first["messages"] + second["messages"]]
+
+        self.assertEqual(sorted(ids), sorted(self.message_ids))
+        self.assertIsNone(second["before"])
+        liked = {msg["id"]: msg["liked"]
+                 for msg in first["messages"] + second["messages"]}
+        self.assertTrue(liked[self.message_ids[0]])
+        self.assertFalse(liked[self.message_ids[1]])
+
+    def test_user_messages(self):
+        """Tests a user's messages are served as JSON"""
+        data = self.client.get(
+            f"/api/users/{self.u2_id}/messages").get_json()
+
+        self.assertEqual(len(data["messages"]), 3)
+        self.assertTrue(all(
+            msg["user_id"] == self.u2_id for msg in data["messages"]))
+
+    def test_like_and_unlike(self):
+        """Tests likes are set and removed idempotently, with counters"""
+        msg_id = self.message_ids[1]
+
+        for i in range(2):
+            resp = self.client.post(f"/api/messages/{msg_id}/like")
+            self.assertEqual(resp.get_json(),
+                             {"message_id": msg_id, "liked": True})
+
+        self.assertIsNotNone(Like.query.get((self.u1_id, msg_id)))
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 2)
+
+        for i in range(2):
+            resp = self.client.delete(f"/api/messages/{msg_id}/like")
+            self.assertEqual(resp.get_json(),
+                             {"message_id": msg_id, "liked": False})
+
+        self.assertIsNone(Like.query.get((self.u1_id, msg_id)))
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 1)
+
+    def test_follow_and_unfollow(self):
+        """Tests follows are set and removed idempotently, with counters"""
+        self.client.delete(f"/api/users/{self.u2_id}/follow")
+        resp = self.client.delete(f"/api/users/{self.u2_id}/follow")
+
+        self.assertEqual(resp.get_json(),
+                         {"user_id": self.u2_id, "following": False})
+        self.assertFalse(User.query.get(self.u1_id)
+                         .is_following(User.query.get(self.u2_id)))
+
+        self.client.post(f"/api/users/{self.u2_id}/follow")
+        resp = self.client.post(f"/api/users/{self.u2_id}/follow")
+
+        self.assertEqual(resp.get_json(),
+                         {"user_id": self.u2_id, "following": True})
+        self.assertEqual(User.query.get(self.u2_id).followers_count, 1)
+
+    def test_logged_out(self):
+        """Tests the API refuses anonymous requests"""
+        client = app.test_client()
+        resp = client.get("/api/timeline")
+
+        self.assertEqual(resp.status_code, 401)
+        self.assertIn("error", resp.get_json())
+
+    def test_missing_message(self):
+        """Tests errors under /api/ are JSON"""
+        resp = self.client.post("/api/messages/999999/like")
+
+        self.assertEqual(resp.status_code, 404)
+        self.assertIn("error", resp.get_json())
+
+    def test_csrf_header(self):
+        """Tests writes need the CSRF token header when CSRF is on"""
+        app.config['WTF_CSRF_ENABLED'] = True
+        msg_id = self.message_ids[1]
+
+        resp = self.client.post(f"/api/messages/{msg_id}/like")
+        self.assertEqual(resp.status_code, 400)
+
+        page = self.client.get("/").get_data(as_text=True)
+        token = page.split('name="csrf-token" content="')[1].split('"')[0]
+
+        resp = self.client.post(
+            f"/api/messages/{msg_id}/like", headers={"X-CSRFToken": token})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_batch_like(self):
+        """Tests a batch of likes reports each message, with counters"""
+        ids = self.message_ids[:3] + [999999]
+
+        resp = self.client.post("/api/likes", json={"message_ids": ids})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            [result["status"] for result in resp.get_json()["results"]],
+            ["already_liked", "liked", "liked", "not_found"])
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 3)
+
+        resp = self.client.delete(
+            "/api/likes", json={"message_ids": ids[1:]})
+
+        self.assertEqual(
+            resp.get_json()["results"],
+            [{"message_id": ids[1], "status": "unliked"},
+             {"message_id": ids[2], "status": "unliked"},
+             {"message_id": ids[3], "status": "not_found"}])
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 1)
+        self.assertEqual(
+            [like.message_id for like in Like.query.all()], ids[:1])
+
+    def test_batch_follow(self):
+        """Tests a batch of follows reports each user, with counters"""
+        others = [User.signup(f"o{i}", f"o{i}@email.com", "password", None)
+                  for i in range(3)]
+        db.session.commit()
+        ids = [self.u2_id] + [user.id for user in others]
+
+        resp = self.client.post("/api/follows", json={"user_ids": ids + ids})
+
+        self.assertEqual(
+            [result["status"] for result in resp.get_json()["results"]],
+            ["already_following", "followed", "followed", "followed"])
+        self.assertEqual(User.query.get(self.u1_id).following_count, 4)
+        self.assertEqual(
+            [User.query.get(id).followers_count for id in ids], [1, 1, 1, 1])
+
+        resp = self.client.delete("/api/follows", json={"user_ids": ids[:2]})
+
+        self.assertEqual(
+            [result["status"] for result in resp.get_json()["results"]],
+            ["unfollowed", "unfollowed"])
+        self.assertEqual(User.query.get(self.u1_id).following_count, 2)
+        self.assertEqual(User.query.get(self.u2_id).followers_count, 0)
+
+    def test_batch_statements(self):
+        """Tests a batch runs the same statements whatever its size"""
+        def like_all(message_ids):
+            self.client.delete(
+                "/api/likes", json={"message_ids": self.message_ids})
+            with count_queries() as statements:
+                self.client.post(
+                    "/api/likes", json={"message_ids": message_ids})
+            return len(statements)
+
+        self.assertEqual(like_all(self.message_ids[1:2]),
+                         like_all(self.message_ids[1:]))
+
+    def test_batch_invalid(self):
+        """Tests malformed or oversized batches are refused"""
+        app.config['API_BATCH_LIMIT'] = 2
+
+        try:
+            for body in [None, {"message_ids": "1"}, {"message_ids": ["1"]},
+                         {"message_ids": [1, 2, 3]}]:
+                resp = self.client.post("/api/likes", json=body)
+                self.assertEqual(resp.status_code, 400)
+                self.assertIn("error", resp.get_json())
+        finally:
+            app.config['API_BATCH_LIMIT'] = 500
@@ -0,0 +1,213 @@
+"""Cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+import os
+import stat
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import cache
+from test_query_counts import count_queries
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LRUCacheTestCase(TestCase):
+    def test_eviction(self):
+        """Tests the least recently used entry is evicted first"""
+        lru = cache.LRUCache(max_entries=2)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")
+        lru.set("c", 3)
+
+        self.assertEqual(lru.get_many(["a", "b", "c"]), [1, None, 3])
+
+    def test_ttl(self):
+        """Tests entries expire after their ttl"""
+        lru = cache.LRUCache()
+        lru.set("a", 1, ttl=0.01)
+        time.sleep(0.02)
+
+        self.assertIsNone(lru.get("a"))
+
+    def test_incr(self):
+        """Tests counters start at zero and increment"""
+        lru = cache.LRUCache()
+
+        self.assertEqual(lru.incr("n"), 1)
+        self.assertEqual(lru.incr("n"), 2)
+
+
+class SocketCacheTestCase(TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "cache.sock")
+        self.server = cache.CacheServer(self.path)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_shared_between_clients(self):
+        """Tests two clients (workers) see each other's writes"""
+        one = cache.SocketCache(self.path)
+        two = cache.SocketCache(self.path)
+
+        one.set("user:1", {"version": 0, "columns": {"id": 1}})
+        two.incr("user-version:1")
+
+        self.assertEqual(
+            one.get_many(["user:1", "user-version:1"]),
+            [{"version": 0, "columns": {"id": 1}}, 1])
+
+    def test_unreachable_is_a_miss(self):
+        """Tests a cache that's down behaves as empty"""
+        missing = cache.SocketCache(self.path + ".missing")
+
+        self.assertIsNone(missing.get("user:1"))
+        missing.set("user:1", {})
+
+    def test_socket_is_private(self):
+        """Tests only the server's user can connect to the socket"""
+        mode = stat.S_IMODE(os.stat(self.path).st_mode)
+
+        self.assertEqual(mode, 0o600)
+
+    def test_other_users_socket_is_a_miss(self):
+        """Tests a socket owned by another user isn't trusted"""
+        if os.getuid() != 0:
+            self.skipTest("requires root, to give the socket away")
+
+        client = cache.SocketCache(self.path)
+        client.set("card:1:0", "<p>hi</p>")
+        os.chown(self.path, 65534, -1)
+
+        self.assertIsNone(cache.SocketCache(self.path).get("card:1:0"))
+
+
+class UserCacheTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_cached_user_skips_query(self):
+        """Tests a warm cache loads the logged-in user without a query"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get('/messages/new')
+
+            with count_queries() as statements:
+                resp = c.get('/messages/new')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(statements, [])
+
+    def test_profile_edit_invalidates(self):
+        """Tests profile edits are visible on the next request"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get('/messages/new')
+            c.post('/users/profile', data={
+                "username": "renamed",
+                "email": "u1@email.com",
+                "image_url": "/static/images/default-pic.png",
+                "header_image_url": "",
+                "bio": "",
+                "password": "password"})
+
+            html = c.get('/messages/new').get_data(as_text=True)
+
+        self.assertIn('alt="renamed"', html)
+
+
+class MessageCardCacheTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        msg = Message(text="cached warble", user_id=u1.id)
+        db.session.add(msg)
+        db.session.commit()
+        self.msg_id = msg.id
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def card_key(self):
+        version = User.query.get(self.u1_id).profile_version
+        return f"card:{self.msg_id}:{version}"
+
+    def test_card_cached(self):
+        """Tests a message's card is rendered once and then reused"""
+        first = self.client.get(f'/users/{self.u1_id}').get_data(as_text=True)
+        cached = app.extensions['warbler_cache'].get(self.card_key())
+
+        self.assertIn("cached warble", cached)
+        self.assertIn(cached, first)
+
+        # a cached card is used as is
+        app.extensions['warbler_cache'].set(self.card_key(), "<p>from the cache</p>")
+        html = self.client.get('/').get_data(as_text=True)
+
+        self.assertIn("<p>from the cache</p>", html)
+
+    def test_profile_edit_replaces_cards(self):
+        """Tests cards show a renamed author straight away"""
+        self.client.get(f'/users/{self.u1_id}')
+        self.client.post('/users/profile', data={
+            "username": "renamed",
+            "email": "u1@email.com",
+            "image_url": "/static/images/default-pic.png",
+            "header_image_url": "",
+            "bio": "",
+            "password": "password"})
+
+        html = self.client.get('/').get_data(as_text=True)
+
+        self.assertIn("@renamed</a>", html)
+        self.assertNotIn("@u1</a>", html)
+
+    def test_delete_drops_card(self):
+        """Tests deleting a message discards its card"""
+        self.client.get('/')
+        key = self.card_key()
+        self.assertIsNotNone(app.extensions['warbler_cache'].get(key))
+
+        self.client.post(f'/messages/{self.msg_id}/delete')
+
+        self.assertIsNone(app.extensions['warbler_cache'].get(key))
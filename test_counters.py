@@ -0,0 +1,147 @@
+"""Denormalized user counter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_counters.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from test_query_counts import count_queries
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class CounterTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        m2 = Message(text="m2-text", user_id=u2.id)
+        db.session.add(m2)
+        db.session.commit()
+        self.m2_id = m2.id
+
+        User.reconcile_counts()
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def counts(self, user_id):
+        user = User.query.get(user_id)
+        return (user.messages_count, user.following_count,
+                user.followers_count, user.likes_count)
+
+    def test_routes_update_counters(self):
+        """Tests follow, like, post and their reversals keep counts right"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/users/follow/{self.u2_id}')
+            c.post(f'/messages/{self.m2_id}/like')
+            c.post("/messages/new", data={"text": "Hello"})
+
+            self.assertEqual(self.counts(self.u1_id), (1, 1, 0, 1))
+            self.assertEqual(self.counts(self.u2_id), (1, 0, 1, 0))
+
+            c.post(f'/users/stop-following/{self.u2_id}')
+            c.post(f'/messages/{self.m2_id}/like')
+
+            self.assertEqual(self.counts(self.u1_id), (1, 0, 0, 0))
+            self.assertEqual(self.counts(self.u2_id), (1, 0, 0, 0))
+
+    def test_delete_message_updates_counters(self):
+        """Tests deleting a liked message decrements author and likers"""
+        u1 = User.query.get(self.u1_id)
+        u1.likes.append(Message.query.get(self.m2_id))
+        User.reconcile_counts()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f'/messages/{self.m2_id}/delete')
+
+        self.assertEqual(self.counts(self.u1_id), (0, 0, 0, 0))
+        self.assertEqual(self.counts(self.u2_id), (0, 0, 0, 0))
+
+    def delete_account(self, user_id):
+        """Delete `user_id` through the route; returns the statements run."""
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        with count_queries() as statements:
+            resp = client.post('/users/delete')
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertIsNone(User.query.get(user_id))
+        return statements
+
+    def test_delete_account(self):
+        """Tests deleting an account cascades in the database, in as many
+        statements however much it has, and fixes others' counters"""
+        heavy = User.signup("heavy", "heavy@email.com", "password", None)
+        light = User.signup("light", "light@email.com", "password", None)
+        db.session.commit()
+        heavy_id, light_id = heavy.id, light.id
+
+        messages = [Message(text=f"heavy {i}", user_id=heavy_id)
+                    for i in range(30)]
+        db.session.add_all(messages)
+        db.session.commit()
+        db.session.add_all(
+            [Like(user_id=liker_id, message_id=msg.id)
+             for msg in messages for liker_id in (self.u1_id, heavy_id)]
+            + [Like(user_id=heavy_id, message_id=self.m2_id),
+               Follows(user_following_id=heavy_id,
+                       user_being_followed_id=self.u2_id),
+               Follows(user_following_id=self.u1_id,
+                       user_being_followed_id=heavy_id)])
+        User.reconcile_counts()
+        db.session.commit()
+
+        heavy_statements = self.delete_account(heavy_id)
+        light_statements = self.delete_account(light_id)
+
+        self.assertEqual(len(heavy_statements), len(light_statements))
+        self.assertEqual(
+            Message.query.filter(Message.text.like("heavy %")).count(), 0)
+        self.assertEqual(self.counts(self.u1_id), (0, 0, 0, 0))
+        self.assertEqual(self.counts(self.u2_id), (1, 0, 0, 0))
+        self.assertEqual(User.reconcile_counts(), 0)
+
+    def test_reconcile_counts(self):
+        """Tests reconciling repairs drifted counters only"""
+        u1 = User.query.get(self.u1_id)
+        u1.following.append(User.query.get(self.u2_id))
+        u1.likes_count = 7
+        db.session.commit()
+
+        repaired = User.reconcile_counts()
+        db.session.commit()
+
+        self.assertEqual(repaired, 2)
+        self.assertEqual(self.counts(self.u1_id), (0, 1, 0, 0))
+        self.assertEqual(self.counts(self.u2_id), (1, 0, 1, 0))
@@ -0,0 +1,95 @@
+"""Connection pool settings tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_dbpool.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+import dbpool
+
+CONFIG = {
+    'DB_POOL_SIZE': 5,
+    'DB_MAX_OVERFLOW': 5,
+    'DB_POOL_TIMEOUT': 10,
+    'DB_POOL_RECYCLE': 1800,
+    'DB_POOL_PRE_PING': True,
+    'DB_STATEMENT_TIMEOUT': 0,
+    'DB_PGBOUNCER': False,
+    'DATABASE_REPLICA_URLS': [],
+}
+
+
+class DBPoolTestCase(TestCase):
+    def engine(self, **settings):
+        config = {**CONFIG, **settings}
+        engine = create_engine(
+            app.config['SQLALCHEMY_DATABASE_URI'],
+            **dbpool.engine_options(config))
+        dbpool.init_engine(engine, config)
+        self.addCleanup(engine.dispose)
+
+        return engine
+
+    def assertTimesOut(self, engine):
+        with engine.connect() as connection, connection.begin():
+            with self.assertRaises(OperationalError) as raised:
+                connection.execute(text("SELECT pg_sleep(1)"))
+
+        self.assertIn("statement timeout", str(raised.exception))
+
+    def test_engine_options(self):
+        """Tests the pool settings become engine options"""
+        engine = self.engine()
+
+        self.assertEqual(engine.pool.size(), 5)
+        self.assertEqual(engine.pool._max_overflow, 5)
+        self.assertEqual(engine.pool._recycle, 1800)
+        self.assertTrue(engine.pool._pre_ping)
+
+    def test_statement_timeout(self):
+        """Tests the statement timeout is set on each connection"""
+        self.assertTimesOut(self.engine(DB_STATEMENT_TIMEOUT=100))
+
+    def test_pgbouncer_mode(self):
+        """Tests pgbouncer mode keeps no pool and sets the timeout per
+        transaction"""
+        engine = self.engine(DB_PGBOUNCER=True, DB_STATEMENT_TIMEOUT=100)
+
+        self.assertIsInstance(engine.pool, NullPool)
+        self.assertTimesOut(engine)
+
+        with engine.connect() as connection:
+            timeout = connection.execute(
+                text("SHOW statement_timeout")).scalar()
+        self.assertEqual(timeout, "0")
+
+    def test_pool_report(self):
+        """Tests the report warns when workers can exhaust Postgres"""
+        lines = dbpool.pool_report(CONFIG, 12, 4, limits=(100, 3))
+
+        self.assertIn(
+            "Database connections: 12 workers x 10 = up to 120 to the "
+            "primary", lines)
+        self.assertTrue(lines[-1].startswith(
+            "WARNING: up to 120 connections but Postgres allows 97"))
+
+        lines = dbpool.pool_report(CONFIG, 2, 4, limits=(100, 3))
+        self.assertFalse(any(line.startswith("WARNING") for line in lines))
+
+    def test_pool_report_concurrency(self):
+        """Tests the report warns when requests outnumber connections"""
+        lines = dbpool.pool_report(CONFIG, 1, 16)
+
+        self.assertIn(
+            "WARNING: 16 concurrent requests share 10 connections; waiting "
+            "requests fail after 10s", lines)
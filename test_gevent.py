@@ -0,0 +1,89 @@
+"""gevent worker mode tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_gevent.py
+#
+# gevent monkey-patches the whole process, so the requests run in a child
+# Python, set up the way gunicorn.conf.py sets up a gevent worker.
+
+
+import json
+import os
+import subprocess
+import sys
+from importlib.util import find_spec
+from unittest import TestCase, skipIf
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SCRIPT = """
+from gevent import monkey
+monkey.patch_all()
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
+import json
+import time
+
+import gevent
+
+from app import app, CURR_USER_KEY
+from models import db, User
+
+app.config['WTF_CSRF_ENABLED'] = False
+User.query.delete()
+user = User.signup("u1", "u1@email.com", "password", None)
+db.session.commit()
+user_id = user.id
+db.session.remove()
+
+sessions = []
+
+@app.before_request
+def slow_query():
+    sessions.append(id(db.session()))
+    db.session.execute(db.text("SELECT pg_sleep(0.5)"))
+
+def browse():
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = user_id
+    return client.get("/users").status_code
+
+started = time.monotonic()
+requests = [gevent.spawn(browse) for i in range(8)]
+gevent.joinall(requests)
+
+print(json.dumps({
+    "elapsed": time.monotonic() - started,
+    "statuses": [request.value for request in requests],
+    "sessions": len(set(sessions)),
+    "open_sessions": len(db.session.registry.registry),
+}))
+"""
+
+
+@skipIf(not (find_spec("gevent") and find_spec("psycogreen")),
+        "gevent and psycogreen aren't installed")
+class GeventTestCase(TestCase):
+    def test_requests_run_concurrently(self):
+        """Tests requests waiting on Postgres let others run, each with its
+        own session, removed when the request ends"""
+        env = {
+            **os.environ,
+            "DATABASE_URL": "postgresql:///warbler_test",
+            "PYTHONPATH": HERE,
+        }
+        child = subprocess.run(
+            [sys.executable, "-c", SCRIPT], env=env, cwd=HERE,
+            capture_output=True, text=True, timeout=60)
+        self.assertEqual(child.returncode, 0, child.stderr)
+
+        result = json.loads(child.stdout.splitlines()[-1])
+
+        self.assertEqual(result["statuses"], [200] * 8)
+        # eight half-second queries, overlapping
+        self.assertLess(result["elapsed"], 2)
+        self.assertEqual(result["sessions"], 8)
+        self.assertEqual(result["open_sessions"], 0)
@@ -0,0 +1,37 @@
+"""CSV bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loader.py
+
+
+import io
+from unittest import TestCase
+
+import loader
+
+
+class ChunkTestCase(TestCase):
+    def test_chunks_keep_quoted_newlines_together(self):
+        """Tests chunks only break between whole CSV records"""
+        csv_file = io.StringIO(
+            'one,"a ""quoted""\nmulti-line field"\n'
+            'two,plain\n'
+            'three,"x\ny\nz"\n')
+
+        chunks = list(loader._chunks(csv_file, chunk_bytes=1))
+
+        self.assertEqual(chunks, [
+            ('one,"a ""quoted""\nmulti-line field"\n', 2),
+            ('two,plain\n', 1),
+            ('three,"x\ny\nz"\n', 3),
+        ])
+
+    def test_chunks_bounded(self):
+        """Tests large files are split into chunks of about chunk_bytes"""
+        csv_file = io.StringIO("".join(f"{i},row\n" for i in range(1000)))
+
+        chunks = list(loader._chunks(csv_file, chunk_bytes=100))
+
+        self.assertTrue(all(len(data) < 110 for data, lines in chunks))
+        self.assertEqual(sum(lines for data, lines in chunks), 1000)
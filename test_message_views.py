@@ -5,10 +5,11 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
+import datetime
 import os
 from unittest import TestCase
 
-from models import db, Message, User
+from models import db, Message, User, Like, LikeRequest
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -158,16 +159,42 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
 
             self.assertNotIn(msg2, u1.likes)
 
+    def test_like_idempotency_key(self):
+        """Tests a toggle submitted twice with the same key is applied once"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
 
+            html = c.get('/').get_data(as_text=True)
+            self.assertIn('name="idempotency_key"', html)
 
+            for i in range(2):
+                c.post(f'/messages/{self.m2_id}/like',
+                       data={"idempotency_key": "click-1"})
 
+            self.assertIsNotNone(Like.query.get((self.u1_id, self.m2_id)))
+            self.assertEqual(User.query.get(self.u1_id).likes_count, 1)
 
+            # a new key toggles again
+            c.post(f'/messages/{self.m2_id}/like',
+                   data={"idempotency_key": "click-2"})
 
+            self.assertIsNone(Like.query.get((self.u1_id, self.m2_id)))
+            self.assertEqual(User.query.get(self.u1_id).likes_count, 0)
 
+    def test_prune_like_requests(self):
+        """Tests expired idempotency keys are pruned"""
+        db.session.add_all([
+            LikeRequest(user_id=self.u1_id, key="old", message_id=self.m2_id,
+                        liked=True,
+                        created_at=datetime.datetime(2000, 1, 1)),
+            LikeRequest(user_id=self.u1_id, key="new", message_id=self.m2_id,
+                        liked=False),
+        ])
+        db.session.commit()
 
+        result = app.test_cli_runner().invoke(args=["prune-like-requests"])
 
-
-
-
-
-
+        self.assertIn("Pruned 1 ", result.output)
+        self.assertEqual(
+            [request.key for request in LikeRequest.query.all()], ["new"])
@@ -0,0 +1,94 @@
+"""Request metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import os
+import time
+from types import SimpleNamespace
+from unittest import TestCase
+
+from flask import Response
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import metrics
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        metrics.registry.endpoints.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_records_request(self):
+        """Tests a page's latency, SQL and template time are recorded"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/users")
+            self.assertEqual(resp.status_code, 200)
+
+        recorded = metrics.registry.endpoints["list_users"]
+        self.assertEqual(sum(recorded.buckets), 1)
+        self.assertEqual(recorded.statuses, {200: 1})
+        self.assertGreater(recorded.sql_count, 0)
+        self.assertGreater(recorded.sql_time, 0)
+        self.assertGreater(recorded.template_time, 0)
+
+    def test_metrics_page(self):
+        """Tests /metrics serves the Prometheus text format"""
+        with app.test_client() as c:
+            c.get("/login")
+            resp = c.get("/metrics")
+            text = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("text/plain", resp.content_type)
+        self.assertIn(
+            'warbler_request_duration_seconds_bucket'
+            '{endpoint="login",le="+Inf"} 1', text)
+        self.assertIn(
+            'warbler_requests_total{endpoint="login",status="200"} 1', text)
+        self.assertNotIn('endpoint="metrics"', text)
+
+    def test_overhead(self):
+        """Tests recording a request costs well under 50µs"""
+        runs = 2000
+        response = Response()
+        conn = SimpleNamespace(info={})
+
+        with app.test_request_context("/users"):
+            started = time.perf_counter()
+
+            for i in range(runs):
+                metrics._start_request()
+                metrics._before_cursor_execute(
+                    conn, None, "", None, None, False)
+                metrics._after_cursor_execute(
+                    conn, None, "", None, None, False)
+                metrics._record_status(response)
+                metrics._finish_request(None)
+
+            per_request = (time.perf_counter() - started) / runs
+
+        self.assertLess(per_request, 50e-6)
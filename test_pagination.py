@@ -0,0 +1,111 @@
+"""Keyset pagination tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pagination.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from pagination import encode_cursor, decode_cursor
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class PaginationTestCase(TestCase):
+    def setUp(self):
+        app.config['PAGE_SIZE'] = 2
+
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        # five messages, one a day, plus two sharing a timestamp so the id
+        # tie-breaker matters
+        start = datetime(2022, 1, 1)
+        for i in range(5):
+            db.session.add(Message(
+                text=f"msg-{i}",
+                user_id=u1.id,
+                timestamp=start + timedelta(days=min(i, 3))))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['PAGE_SIZE'] = 50
+
+    def texts(self, html):
+        return [f"msg-{i}" for i in range(5) if f"msg-{i}<" in html]
+
+    def test_cursor_round_trip(self):
+        """Tests cursors decode back to their key values"""
+        values = (datetime(2022, 1, 1, 12, 30, 1, 5), 7)
+        cursor = encode_cursor(values)
+
+        with app.test_request_context():
+            decoded = decode_cursor(
+                cursor, (Message.timestamp, Message.id))
+
+        self.assertEqual(decoded, values)
+
+    def link(self, html, label):
+        """The href of the pager link labelled `label`, or None."""
+        marker = html.find(f'{label}</a>')
+        if marker == -1:
+            return None
+
+        href_start = html.rindex('href="', 0, marker) + len('href="')
+        href = html[href_start:html.index('"', href_start)]
+        return href.replace('&amp;', '&')
+
+    def test_profile_pages(self):
+        """Tests walking a profile older with 'before' and back newer with
+        'after' visits every message exactly once"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            older = []
+            url = f'/users/{self.u1_id}'
+            while url:
+                html = c.get(url).get_data(as_text=True)
+                older.append(self.texts(html))
+                last_html = html
+                url = self.link(html, "Older")
+
+            self.assertEqual(
+                older, [["msg-3", "msg-4"], ["msg-1", "msg-2"], ["msg-0"]])
+
+            newer = []
+            url = self.link(last_html, "Newer")
+            while url:
+                html = c.get(url).get_data(as_text=True)
+                newer.append(self.texts(html))
+                url = self.link(html, "Newer")
+
+            self.assertEqual(newer, [["msg-1", "msg-2"], ["msg-3", "msg-4"]])
+
+    def test_invalid_cursor(self):
+        """Tests a malformed cursor is a 400, not a 500"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f'/users/{self.u1_id}?before=not-a-cursor')
+
+            self.assertEqual(resp.status_code, 400)
@@ -0,0 +1,88 @@
+"""Password hashing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_passwords.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+import passwords
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class PasswordHashingTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['BCRYPT_LOG_ROUNDS'] = 12
+
+    def test_configured_rounds(self):
+        """Tests new hashes use the configured work factor"""
+        u1 = User.query.get(self.u1_id)
+
+        self.assertTrue(u1.password.startswith("$2b$04$"))
+        self.assertTrue(passwords.check_password(u1.password, "password"))
+        self.assertFalse(passwords.check_password(u1.password, "wrong"))
+
+    def test_rehash_on_login(self):
+        """Tests logging in upgrades a hash made at an old work factor"""
+        app.config['BCRYPT_LOG_ROUNDS'] = 5
+
+        resp = self.client.post(
+            "/login", data={"username": "u1", "password": "password"})
+
+        self.assertEqual(resp.status_code, 302)
+        u1 = User.query.get(self.u1_id)
+        self.assertTrue(u1.password.startswith("$2b$05$"))
+
+    def test_backpressure(self):
+        """Tests a full queue answers 503 rather than waiting"""
+        hasher = passwords.PasswordHasher(1, 1, 10)
+        hasher.slots.acquire()
+        app.extensions['warbler_password_hasher'], saved = (
+            hasher, app.extensions['warbler_password_hasher'])
+
+        try:
+            resp = self.client.post(
+                "/login", data={"username": "u1", "password": "password"})
+        finally:
+            app.extensions['warbler_password_hasher'] = saved
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers["Retry-After"], "1")
+
+    def test_inline(self):
+        """Tests hashing with no worker processes"""
+        hasher = passwords.PasswordHasher(0, 1, 10)
+        hashed = hasher.run(passwords._hash, b"password", 4)
+
+        self.assertTrue(hasher.run(passwords._check, hashed.encode(), b"password"))
+
+    def test_default_workers(self):
+        """Tests web workers split the CPUs between their pools"""
+        cpus = os.cpu_count() or 1
+
+        self.assertEqual(passwords.default_workers(1), cpus)
+        self.assertEqual(passwords.default_workers(cpus), 1)
+        self.assertEqual(passwords.default_workers(4 * cpus), 1)
@@ -0,0 +1,108 @@
+"""Per-route query budget tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_counts.py
+
+
+import os
+from contextlib import contextmanager
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Most SQL statements each page may issue, however many rows it shows.
+QUERY_BUDGETS = {
+    'home': 6,  # including the "who to follow" sidebar
+    'profile': 5,
+    'likes': 4,
+    'users': 3,
+}
+
+
+@contextmanager
+def count_queries():
+    """Count SQL statements executed inside the block."""
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
+class QueryCountTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        authors = []
+        for i in range(5):
+            author = User.signup(f"a{i}", f"a{i}@email.com", "password", None)
+            authors.append(author)
+        u1.following.extend(authors)
+        db.session.commit()
+
+        for i in range(30):
+            msg = Message(text=f"m{i}", user_id=authors[i % 5].id)
+            db.session.add(msg)
+            db.session.flush()
+            if i % 2:
+                db.session.add(Like(user_id=u1.id, message_id=msg.id))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def get_counted(self, url):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            with count_queries() as statements:
+                resp = c.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+        return len(statements)
+
+    def test_home_budget(self):
+        """Tests home page query count stays within budget"""
+        self.assertLessEqual(self.get_counted('/'), QUERY_BUDGETS['home'])
+
+    def test_profile_budget(self):
+        """Tests profile page query count stays within budget"""
+        author = User.query.filter_by(username="a1").one()
+        self.assertLessEqual(
+            self.get_counted(f'/users/{author.id}'), QUERY_BUDGETS['profile'])
+
+    def test_likes_budget(self):
+        """Tests likes page query count stays within budget"""
+        self.assertLessEqual(
+            self.get_counted(f'/users/{self.u1_id}/likes'),
+            QUERY_BUDGETS['likes'])
+
+    def test_user_list_budget(self):
+        """Tests user list query count stays within budget"""
+        self.assertLessEqual(self.get_counted('/users'), QUERY_BUDGETS['users'])
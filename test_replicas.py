@@ -0,0 +1,119 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+#
+# The "replica" here is the test database under another connection, so the
+# tests can see which engine each query went to.
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import replicas
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+REPLICA_URL = "postgresql:///warbler_test?application_name=warbler-replica"
+DOWN_URL = "postgresql://localhost:1/warbler_test"
+
+
+class ReplicaTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        self.use_replicas([REPLICA_URL])
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['REPLICA_STICKY_SECONDS'] = 10
+        app.config['REPLICA_MAX_LAG'] = 5
+        self.use_replicas([])
+
+    def use_replicas(self, urls):
+        """Configure replicas; count the statements each one runs."""
+        app.config['DATABASE_REPLICA_URLS'] = urls
+        replicas.init_replicas(app)
+        self.replica_statements = 0
+
+        for replica in app.extensions['warbler_replicas'].replicas:
+            event.listen(replica.engine, "before_cursor_execute",
+                         self.count_statement)
+
+    def count_statement(self, *args):
+        self.replica_statements += 1
+
+    def test_get_reads_from_replica(self):
+        """Tests GET pages read from the replica"""
+        resp = self.client.get("/users")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("@u1", resp.get_data(as_text=True))
+        # the health check, then the page's queries
+        self.assertGreater(self.replica_statements, 1)
+
+    def test_writes_go_to_primary(self):
+        """Tests POSTs write to the primary and stick the user to it"""
+        self.client.get("/users")
+        replica_reads = self.replica_statements
+
+        resp = self.client.post("/messages/new", data={"text": "hello"})
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.replica_statements, replica_reads)
+        self.assertEqual(Message.query.filter_by(text="hello").count(), 1)
+
+        # read-your-writes: the next page comes from the primary too
+        resp = self.client.get(f"/users/{self.u1_id}")
+        self.assertIn("hello", resp.get_data(as_text=True))
+        self.assertEqual(self.replica_statements, replica_reads)
+
+    def test_sticky_window_ends(self):
+        """Tests reads go back to the replica after the sticky window"""
+        app.config['REPLICA_STICKY_SECONDS'] = 0
+
+        self.client.post("/messages/new", data={"text": "hello"})
+        self.client.get(f"/users/{self.u1_id}")
+
+        self.assertGreater(self.replica_statements, 1)
+
+    def test_replica_down(self):
+        """Tests reads fail over to the primary when the replica is down"""
+        self.use_replicas([DOWN_URL])
+
+        resp = self.client.get("/users")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("@u1", resp.get_data(as_text=True))
+        self.assertFalse(
+            app.extensions['warbler_replicas'].replicas[0].healthy)
+
+    def test_replica_lagging(self):
+        """Tests a replica too far behind is skipped"""
+        app.config['REPLICA_MAX_LAG'] = -1
+        self.use_replicas([REPLICA_URL])
+
+        resp = self.client.get("/users")
+
+        self.assertEqual(resp.status_code, 200)
+        # only the health check ran there
+        self.assertEqual(self.replica_statements, 1)
@@ -0,0 +1,89 @@
+"""Schema migration and query plan tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_schema.py
+
+
+import os
+from unittest import TestCase
+
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from flask_migrate import downgrade, upgrade
+
+from models import db, User, Message, Follows, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+import cache
+from benchmarks import explain_routes
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+db.create_all()
+
+
+class MigrationTestCase(TestCase):
+    def setUp(self):
+        db.session.remove()
+        db.drop_all()
+        db.session.execute(db.text("DROP TABLE IF EXISTS alembic_version"))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        with app.app_context():
+            downgrade(revision="base")
+        db.session.execute(db.text("DROP TABLE IF EXISTS alembic_version"))
+        db.session.commit()
+        db.create_all()
+
+        # ids restart in the new tables, so cached users would be stale
+        cache.init_cache(app)
+
+    def test_migrations_match_models(self):
+        """Tests upgrading an empty database gives the models' schema"""
+        with app.app_context():
+            upgrade()
+
+        with db.engine.connect() as connection:
+            context = MigrationContext.configure(connection)
+            diff = compare_metadata(context, db.metadata)
+
+        self.assertEqual(diff, [])
+
+
+class QueryPlanTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        users = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            for i in range(3)]
+        db.session.commit()
+
+        u0, u1, u2 = users
+        msg = Message(text="hello world", user_id=u1.id)
+        db.session.add(msg)
+        db.session.flush()
+        db.session.add_all([
+            Follows(user_being_followed_id=u1.id, user_following_id=u0.id),
+            Follows(user_being_followed_id=u0.id, user_following_id=u2.id),
+            Like(user_id=u0.id, message_id=msg.id),
+        ])
+        db.session.commit()
+
+        self.u0_id = u0.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_no_sequential_scans(self):
+        """Tests every page's queries can be served by an index"""
+        with app.app_context():
+            failures = explain_routes.check(
+                User.query.get(self.u0_id), report=lambda line: None)
+
+        self.assertEqual(failures, [])
@@ -0,0 +1,248 @@
+"""Username search tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+
+import os
+import re
+from unittest import TestCase
+
+from sqlalchemy import select, tuple_
+from sqlalchemy.dialects import postgresql
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import search
+from pagination import decode_cursor, encode_cursor
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+USERNAMES = ["warbler", "warblerfan", "thewarbler", "robin", "sparrow"]
+
+
+class UserSearchTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        users = [
+            User.signup(name, f"{name}@email.com", "password", None)
+            for name in USERNAMES]
+        db.session.commit()
+        self.ids = {user.username: user.id for user in users}
+
+        search.ngram_index.build()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['USER_SEARCH_BACKEND'] = "auto"
+        app.config['PAGE_SIZE'] = 50
+
+    def test_ngram_ranking(self):
+        """Tests substring matches are found and exact matches rank first"""
+        ranked = [user_id for key, user_id in search.ngram_index.search("Warb")]
+
+        self.assertEqual(ranked[0], self.ids["warbler"])
+        self.assertEqual(
+            set(ranked),
+            {self.ids["warbler"], self.ids["warblerfan"],
+             self.ids["thewarbler"]})
+
+    def test_ngram_short_query_prefix(self):
+        """Tests queries shorter than a trigram match prefixes"""
+        ranked = [user_id for key, user_id in search.ngram_index.search("ro")]
+
+        self.assertEqual(ranked, [self.ids["robin"]])
+
+    def test_ngram_add_and_remove(self):
+        """Tests in-process writes update the index"""
+        search.ngram_index.add(self.ids["robin"], "redwarbler")
+        search.ngram_index.remove(self.ids["sparrow"])
+
+        found = {user_id for key, user_id in search.ngram_index.search("warb")}
+        self.assertIn(self.ids["robin"], found)
+        self.assertEqual(search.ngram_index.search("sparrow"), [])
+
+    def test_search_route_pages(self):
+        """Tests /users?q= pages through ranked results"""
+        app.config['USER_SEARCH_BACKEND'] = "ngram"
+        app.config['PAGE_SIZE'] = 2
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids["robin"]
+
+            first = c.get('/users?q=warbler').get_data(as_text=True)
+            self.assertIn("@warbler<", first)
+            self.assertIn("Older</a>", first)
+            self.assertNotIn("@robin<", first)
+
+    def test_signup_updates_index(self):
+        """Tests a new signup is searchable straight away"""
+        app.config['USER_SEARCH_BACKEND'] = "ngram"
+
+        with self.client as c:
+            c.post("/signup", data={
+                "username": "nightwarbler",
+                "email": "nw@email.com",
+                "password": "password"})
+
+            html = c.get('/users?q=nightw').get_data(as_text=True)
+
+        self.assertIn("@nightwarbler<", html)
+
+    def test_trigram_search(self):
+        """Tests the pg_trgm backend finds and ranks like the fallback"""
+        if not search.trigram_available():
+            self.skipTest("requires the pg_trgm extension")
+
+        app.config['USER_SEARCH_BACKEND'] = "trigram"
+
+        with app.test_request_context('/users?q=warb'):
+            page = search.search_users("warb")
+
+        self.assertEqual(page.items[0].id, self.ids["warbler"])
+        self.assertEqual(len(page.items), 3)
+
+    def test_trigram_cursor_type(self):
+        """Tests the pg_trgm backend's cursor compares with the score as the
+        same type it's ordered by"""
+        score = search._trigram_score("warb")
+        columns = (score, User.id)
+        values = decode_cursor(encode_cursor((0.1, 5)), columns)
+
+        sql = str(select(User.id)
+                  .where(tuple_(*columns) < tuple_(*values))
+                  .order_by(score.desc())
+                  .compile(dialect=postgresql.dialect()))
+
+        self.assertIsInstance(values[0], float)
+        self.assertEqual(sql.count("AS DOUBLE PRECISION)"), 2)
+        self.assertNotIn("REAL", sql)
+
+
+class MessageSearchTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        self.client = app.test_client()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            for text in ["The early bird catches the worm",
+                         "Birds of a feather",
+                         "Catching worms early",
+                         "Nothing to see here"]:
+                c.post("/messages/new", data={"text": text})
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['PAGE_SIZE'] = 50
+
+    def found(self, query):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get('/messages/search', query_string={"q": query})
+
+        self.assertEqual(resp.status_code, 200)
+        html = resp.get_data(as_text=True)
+        return {text for text in ["The early bird catches the worm",
+                                  "Birds of a feather",
+                                  "Catching worms early",
+                                  "Nothing to see here"]
+                if f"<p>{text}</p>" in html}
+
+    def test_stemmed_words(self):
+        """Tests words match their stems and all words must match"""
+        self.assertEqual(
+            self.found("worm early"),
+            {"The early bird catches the worm", "Catching worms early"})
+
+    def test_phrase(self):
+        """Tests quoted phrases must match in order"""
+        self.assertEqual(
+            self.found('"early bird"'), {"The early bird catches the worm"})
+
+    def test_prefix(self):
+        """Tests trailing * matches prefixes"""
+        self.assertEqual(
+            self.found("feath*"), {"Birds of a feather"})
+
+    def test_empty_query(self):
+        """Tests a query with no terms finds nothing rather than erroring"""
+        self.assertEqual(self.found('"" *'), set())
+
+    def test_delete_removes_from_index(self):
+        """Tests deleted messages are no longer found"""
+        msg = Message.query.filter_by(text="Birds of a feather").one()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/messages/{msg.id}/delete')
+
+        self.assertEqual(self.found("feather"), set())
+
+    def test_paging_and_reindex(self):
+        """Tests results page by relevance and rebuilding indexes messages
+        posted without a search document"""
+        db.session.add(Message(text="An early start", user_id=self.u1_id))
+        db.session.commit()
+
+        with app.app_context():
+            self.assertEqual(
+                search.reindex_messages(batch_size=2), Message.query.count())
+
+        app.config['PAGE_SIZE'] = 2
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get('/messages/search?q=early').get_data(as_text=True)
+
+        self.assertIn("Older</a>", html)
+        self.assertEqual(html.count('class="list-group-item"'), 2)
+
+    def test_paging_through_ties(self):
+        """Tests following the Older cursor reaches every match once, even
+        with ranks tied across pages"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            for i in range(6):
+                c.post("/messages/new", data={"text": f"bird {i}"})
+
+        app.config['PAGE_SIZE'] = 2
+        seen = []
+        url = '/messages/search?q=bird'
+
+        with self.client as c:
+            while url:
+                html = c.get(url).get_data(as_text=True)
+                seen += re.findall(r"<p>([^<]*bird[^<]*)</p>", html, re.I)
+                older = re.search(r'href="([^"]*)"\s+class="[^"]*">Older', html)
+                url = older and older.group(1).replace("&amp;", "&")
+
+        self.assertEqual(sorted(seen), sorted(
+            ["The early bird catches the worm", "Birds of a feather"]
+            + [f"bird {i}" for i in range(6)]))
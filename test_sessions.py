@@ -0,0 +1,241 @@
+"""Server-side session tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sessions.py
+
+
+import os
+import stat
+import tempfile
+import time
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import sessions
+from test_query_counts import count_queries
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class EncodingTestCase(TestCase):
+    def test_round_trip(self):
+        """Tests session values decode to what was encoded"""
+        data = {
+            CURR_USER_KEY: 12345,
+            "negative": -300,
+            "big": 2 ** 70,
+            "ratio": 0.5,
+            "csrf_token": "3f1e" * 10,
+            "raw": b"\x00\xff",
+            "flags": [True, False, None],
+            "_flashes": [("success", "Hello, u1!")],
+            "user": {"version": 2, "columns": {"id": 12345, "bio": ""}},
+        }
+
+        self.assertEqual(sessions.decode(sessions.encode(data)), data)
+
+    def test_compact(self):
+        """Tests small ints take a byte or two"""
+        self.assertEqual(len(sessions.encode(5)), 2)
+        self.assertEqual(len(sessions.encode(1000)), 3)
+
+    def test_unsupported_type(self):
+        """Tests values that can't be encoded are refused"""
+        with self.assertRaises(TypeError):
+            sessions.encode({"when": object()})
+
+
+class StoreTestMixin:
+    def test_get_set(self):
+        """Tests a session can be read back until it expires"""
+        self.store.set("a", b"data", time.time() + 60, 1)
+        self.store.set("b", b"old", time.time() - 1, 1)
+
+        self.assertEqual(self.store.get("a")[1], b"data")
+        self.assertIsNone(self.store.get("b"))
+
+    def test_delete_user(self):
+        """Tests revoking a user ends all and only their sessions"""
+        expires = time.time() + 60
+        self.store.set("a", b"1", expires, 1)
+        self.store.set("b", b"1", expires, 1)
+        self.store.set("c", b"2", expires, 2)
+
+        self.store.delete_user(1)
+
+        self.assertIsNone(self.store.get("a"))
+        self.assertIsNone(self.store.get("b"))
+        self.assertIsNotNone(self.store.get("c"))
+
+    def test_lazy_sweep(self):
+        """Tests expired sessions are deleted by a later save"""
+        self.store.sweep_interval = 0
+        self.store.set("old", b"", time.time() - 1, None)
+        self.store.set("new", b"", time.time() + 60, None)
+
+        self.assertEqual(self.stored_sids(), {"new"})
+
+
+class MemoryStoreTestCase(StoreTestMixin, TestCase):
+    def setUp(self):
+        self.store = sessions.MemoryStore()
+
+    def stored_sids(self):
+        return set(self.store.sessions)
+
+
+class SQLiteStoreTestCase(StoreTestMixin, TestCase):
+    def setUp(self):
+        path = os.path.join(tempfile.mkdtemp(), "sessions.sqlite3")
+        self.store = sessions.SQLiteStore(path)
+
+    def stored_sids(self):
+        rows = self.store._connection().execute("SELECT sid FROM sessions")
+        return {sid for sid, in rows}
+
+    def mode(self, path):
+        return stat.S_IMODE(os.stat(path).st_mode)
+
+    def test_file_is_private(self):
+        """Tests the session file and its WAL are readable only by their
+        owner, even if the file was created looser"""
+        self.store.set("a", b"data", time.time() + 60, 1)
+
+        for suffix in ("", "-wal", "-shm"):
+            self.assertEqual(self.mode(self.store.path + suffix), 0o600)
+
+        path = os.path.join(tempfile.mkdtemp(), "loose.sqlite3")
+        open(path, "w").close()
+        os.chmod(path, 0o644)
+        sessions.SQLiteStore(path)
+
+        self.assertEqual(self.mode(path), 0o600)
+
+
+class ServerSessionTestCase(TestCase):
+    def setUp(self):
+        app.config['SESSION_BACKEND'] = "memory"
+        sessions.init_sessions(app, CURR_USER_KEY)
+
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['SESSION_BACKEND'] = "cookie"
+        sessions.init_sessions(app, CURR_USER_KEY)
+
+    def sid(self, client):
+        """The session id in `client`'s cookie, or None."""
+        for cookie in client.cookie_jar:
+            if cookie.name == app.config['SESSION_COOKIE_NAME']:
+                return cookie.value
+
+    def log_in(self, client):
+        return client.post('/login', data={
+            "username": "u1", "password": "password"})
+
+    def test_login_gets_new_sid(self):
+        """Tests logging in moves the session to a new id"""
+        self.client.get('/login')
+        before = self.sid(self.client)
+
+        resp = self.log_in(self.client)
+        after = self.sid(self.client)
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertNotEqual(before, after)
+        self.assertLessEqual(len(after), 32)
+        self.assertIsNone(app.session_interface.store.get(before))
+
+    def test_user_from_session_snapshot(self):
+        """Tests the logged-in user is loaded from the session, without the
+        user cache or a query"""
+        self.log_in(self.client)
+        self.client.get('/messages/new')
+
+        app.extensions['warbler_cache'].delete(f"user:{self.u1_id}")
+
+        with count_queries() as statements:
+            resp = self.client.get('/messages/new')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(statements, [])
+
+    def test_profile_edit_replaces_snapshot(self):
+        """Tests a stale snapshot is reloaded after a profile edit"""
+        self.log_in(self.client)
+        self.client.get('/messages/new')
+        self.client.post('/users/profile', data={
+            "username": "renamed",
+            "email": "u1@email.com",
+            "image_url": "/static/images/default-pic.png",
+            "header_image_url": "",
+            "bio": "",
+            "password": "password"})
+
+        html = self.client.get('/messages/new').get_data(as_text=True)
+
+        self.assertIn('alt="renamed"', html)
+
+    def test_snapshot_expires(self):
+        """Tests an expired snapshot is reloaded, even when the cache never
+        saw the profile change"""
+        self.log_in(self.client)
+        self.client.get('/messages/new')
+
+        User.query.get(self.u1_id).username = "renamed"
+        db.session.commit()
+
+        html = self.client.get('/messages/new').get_data(as_text=True)
+        self.assertIn('alt="u1"', html)
+
+        with self.client.session_transaction() as sess:
+            snapshot = sess["user"]
+            snapshot["expires"] = int(time.time()) - 1
+            sess["user"] = snapshot
+
+        html = self.client.get('/messages/new').get_data(as_text=True)
+
+        self.assertIn('alt="renamed"', html)
+
+    def test_delete_user_revokes_sessions(self):
+        """Tests deleting an account logs out its other sessions"""
+        other = app.test_client()
+        self.log_in(self.client)
+        self.log_in(other)
+
+        other_sid = self.sid(other)
+
+        self.client.post('/users/delete')
+
+        self.assertIsNone(app.session_interface.store.get(other_sid))
+        resp = other.get('/messages/new')
+        self.assertEqual(resp.status_code, 302)
+
+    def test_logout_deletes_session(self):
+        """Tests an emptied session is deleted, with its cookie"""
+        self.log_in(self.client)
+        self.client.get('/')
+        sid = self.sid(self.client)
+
+        self.client.post('/logout')
+        # the flashed "logged out" message is shown and consumed
+        self.client.get('/login')
+
+        self.assertIsNone(app.session_interface.store.get(sid))
+        self.assertIsNone(self.sid(self.client))
@@ -0,0 +1,231 @@
+"""Follow suggestion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_suggestions.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Follows, FollowSuggestion, SuggestionUpdate
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import suggestions
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# who follows whom: u0 follows u1 and u2, who between them follow u3 (twice)
+# and u4; u5 follows u0
+FOLLOWS = [(0, 1), (0, 2), (1, 3), (2, 3), (2, 4), (1, 0), (5, 0)]
+
+
+class InterleavedCursor:
+    """A DB-API cursor that calls `then()` once, just after executing a
+    statement containing `marker`."""
+
+    def __init__(self, cursor, marker, then):
+        self.__dict__.update(cursor=cursor, marker=marker, then=then)
+
+    def execute(self, sql, *args):
+        self.cursor.execute(sql, *args)
+
+        if self.marker in sql:
+            then, self.__dict__["then"] = self.then, lambda: None
+            then()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.cursor, name, value)
+
+
+class InterleavedConnection:
+    """A DB-API connection whose cursors are InterleavedCursors."""
+
+    def __init__(self, connection, marker, then):
+        self.connection = connection
+        self.marker = marker
+        self.then = then
+
+    def cursor(self, *args, **kwargs):
+        return InterleavedCursor(
+            self.connection.cursor(*args, **kwargs), self.marker, self.then)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class SuggestionsTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+        SuggestionUpdate.query.delete()
+
+        users = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            for i in range(6)]
+        db.session.commit()
+        self.ids = [user.id for user in users]
+
+        db.session.add_all([
+            Follows(user_following_id=self.ids[follower],
+                    user_being_followed_id=self.ids[followed])
+            for follower, followed in FOLLOWS])
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.ids[0]
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def suggested(self, i):
+        """u<i>'s stored suggestions as [(u index, score)]."""
+        row = FollowSuggestion.query.get(self.ids[i])
+        db.session.expire_all()
+
+        if row is None:
+            return None
+
+        return [(self.ids.index(user_id), score)
+                for user_id, score in zip(row.suggested_ids, row.scores)]
+
+    def test_rebuild(self):
+        """Tests the full rebuild scores friends of friends"""
+        with app.app_context():
+            saved = suggestions.rebuild(report=lambda line: None)
+
+        self.assertEqual(saved, 3)
+        self.assertEqual(self.suggested(0), [(3, 2), (4, 1)])
+        # u1 follows u0, who follows u1 and u2
+        self.assertEqual(self.suggested(1), [(2, 1)])
+        self.assertEqual(self.suggested(5), [(1, 1), (2, 1)])
+        self.assertIsNone(self.suggested(3))
+
+    def test_rebuild_matches_recompute(self):
+        """Tests the graph rebuild and the SQL recompute agree"""
+        with app.app_context():
+            suggestions.rebuild(report=lambda line: None)
+            rebuilt = [self.suggested(i) or [] for i in range(6)]
+
+            suggestions.recompute(self.ids)
+            db.session.commit()
+
+        self.assertEqual([self.suggested(i) for i in range(6)], rebuilt)
+
+    def test_max_scan(self):
+        """Tests scoring a user reads no more follows than allowed"""
+        connection = db.engine.raw_connection()
+        try:
+            graph = suggestions.FollowGraph.load(connection)
+        finally:
+            connection.close()
+
+        # only u1's follows (u3 and u0) get read
+        self.assertEqual(
+            graph.suggestions(self.ids[0], 10, max_scan=2),
+            [(self.ids[3], 1)])
+
+    def test_load_reads_one_snapshot(self):
+        """Tests follows and users committed while the graph loads are left
+        out, rather than overrunning another user's follows"""
+
+        def follow_meanwhile():
+            with db.engine.begin() as other:
+                new_id = other.execute(db.text(
+                    "INSERT INTO users (username, email, password) "
+                    "VALUES ('late', 'late@email.com', 'x') "
+                    "RETURNING id")).scalar()
+                other.execute(
+                    db.insert(Follows),
+                    [{"user_following_id": follower,
+                      "user_being_followed_id": followed}
+                     for follower, followed in [
+                         (self.ids[0], self.ids[5]),
+                         (self.ids[0], self.ids[4]),
+                         (new_id, self.ids[0])]])
+
+        connection = db.engine.raw_connection()
+        try:
+            graph = suggestions.FollowGraph.load(InterleavedConnection(
+                connection, "max(id)", follow_meanwhile))
+        finally:
+            connection.close()
+
+        self.assertEqual(graph.max_id, max(self.ids))
+        for i in range(6):
+            self.assertEqual(
+                sorted(graph.following(self.ids[i])),
+                sorted(self.ids[followed]
+                       for follower, followed in FOLLOWS if follower == i))
+
+    def test_follow_updates_suggestions(self):
+        """Tests a follow is queued and applied by the worker"""
+        with app.app_context():
+            suggestions.rebuild(report=lambda line: None)
+
+        resp = self.client.post(f"/users/follow/{self.ids[3]}")
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(SuggestionUpdate.query.count(), 1)
+
+        with app.app_context():
+            self.assertEqual(suggestions.process_updates(), 1)
+
+        self.assertEqual(SuggestionUpdate.query.count(), 0)
+        # u0 now follows u3, so it's no longer suggested to them...
+        self.assertEqual(self.suggested(0), [(4, 1)])
+        # ...and u0's followers see u3 once more
+        self.assertEqual(self.suggested(5), [(1, 1), (2, 1), (3, 1)])
+
+    def test_unfollow_updates_suggestions(self):
+        """Tests an unfollow lowers or drops scores it contributed to"""
+        with app.app_context():
+            suggestions.rebuild(report=lambda line: None)
+
+        self.client.post(f"/users/stop-following/{self.ids[2]}")
+
+        with app.app_context():
+            suggestions.process_updates()
+
+        self.assertEqual(self.suggested(0), [(3, 1)])
+        self.assertEqual(self.suggested(5), [(1, 1)])
+
+    def test_merge(self):
+        """Tests re-scoring one account within a top-K list"""
+        pairs = [(7, 5), (8, 3), (9, 1)]
+
+        self.assertEqual(suggestions.merge(pairs, 9, 4, 3),
+                         [(7, 5), (9, 4), (8, 3)])
+        self.assertEqual(suggestions.merge(pairs, 8, 0, 3),
+                         [(7, 5), (9, 1)])
+        self.assertEqual(suggestions.merge(pairs, 6, 2, 3),
+                         [(7, 5), (8, 3), (6, 2)])
+
+    def test_home_sidebar(self):
+        """Tests the home page shows suggestions not yet followed"""
+        with app.app_context():
+            suggestions.rebuild(report=lambda line: None)
+
+        html = self.client.get("/").get_data(as_text=True)
+
+        self.assertIn("Who to follow", html)
+        self.assertIn("@u3", html)
+        self.assertIn("Followed by 2 people you follow", html)
+
+        # following from the sidebar hides them before the worker runs
+        self.client.post(f"/users/follow/{self.ids[3]}")
+        html = self.client.get("/").get_data(as_text=True)
+
+        self.assertNotIn("@u3", html)
+        self.assertIn("@u4", html)
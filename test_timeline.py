@@ -0,0 +1,217 @@
+"""Precomputed home timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+
+import datetime
+import os
+from unittest import TestCase
+
+from models import db, User, Message, TimelineDemotion, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import timeline
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TimelineTestCase(TestCase):
+    def setUp(self):
+        app.config['TIMELINE_MODE'] = "hybrid"
+        app.config['TIMELINE_CELEBRITY_FOLLOWERS'] = 2
+
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.u3_id = u3.id
+
+        m2 = Message(text="m2-text", user_id=u2.id)
+        db.session.add(m2)
+        db.session.commit()
+        self.m2_id = m2.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['TIMELINE_MODE'] = "read"
+        app.config['TIMELINE_BACKFILL_MESSAGES'] = 200
+
+    def timeline_ids(self, user_id):
+        return {
+            entry.message_id
+            for entry in TimelineEntry.query.filter_by(user_id=user_id)}
+
+    def test_post_fans_out(self):
+        """Tests a new message is written to the author's and followers'
+        timelines"""
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        u1.following.append(u2)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post("/messages/new", data={"text": "fanned"})
+
+        msg = Message.query.filter_by(text="fanned").one()
+        self.assertIn(msg.id, self.timeline_ids(self.u1_id))
+        self.assertIn(msg.id, self.timeline_ids(self.u2_id))
+        self.assertNotIn(msg.id, self.timeline_ids(self.u3_id))
+
+    def test_follow_backfills_and_unfollow_prunes(self):
+        """Tests following copies existing messages and unfollowing removes
+        them"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/users/follow/{self.u2_id}')
+            self.assertIn(self.m2_id, self.timeline_ids(self.u1_id))
+
+            resp = c.get('/')
+            self.assertIn("m2-text", resp.get_data(as_text=True))
+
+            c.post(f'/users/stop-following/{self.u2_id}')
+            self.assertNotIn(self.m2_id, self.timeline_ids(self.u1_id))
+
+    def test_batch_follow_backfills(self):
+        """Tests a batch of follows backfills from every account followed,
+        and a batch of unfollows prunes them all"""
+        m3 = Message(text="m3-text", user_id=self.u3_id)
+        db.session.add(m3)
+        db.session.commit()
+        m3_id = m3.id
+        user_ids = {"user_ids": [self.u2_id, self.u3_id]}
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post('/api/follows', json=user_ids)
+            self.assertEqual(self.timeline_ids(self.u1_id),
+                             {self.m2_id, m3_id})
+
+            c.delete('/api/follows', json=user_ids)
+            self.assertEqual(self.timeline_ids(self.u1_id), set())
+
+    def test_celebrity_read_on_demand(self):
+        """Tests accounts over the follower threshold aren't fanned out but
+        still show on followers' home pages"""
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        u3 = User.query.get(self.u3_id)
+        u2.followers.extend([u1, u3])
+        User.reconcile_counts()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post("/messages/new", data={"text": "celebrity"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get('/')
+
+        msg = Message.query.filter_by(text="celebrity").one()
+        self.assertNotIn(msg.id, self.timeline_ids(self.u1_id))
+        self.assertIn("celebrity", resp.get_data(as_text=True))
+
+    def leave_celebrity(self, path):
+        """Make u2 a celebrity followed by u1 and u3, have u3 POST to `path`,
+        and return u1's home page."""
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        u3 = User.query.get(self.u3_id)
+        u2.followers.extend([u1, u3])
+        User.reconcile_counts()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u3_id
+
+            c.post(path)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            return c.get('/').get_data(as_text=True)
+
+    def assert_demoted(self, html):
+        """Assert u2's messages are read on demand until the worker fans
+        them out to u1."""
+        self.assertEqual(self.timeline_ids(self.u1_id), set())
+        self.assertIn("m2-text", html)
+
+        with app.app_context():
+            timeline.run_worker(once=True, report=lambda line: None)
+
+        self.assertEqual(self.timeline_ids(self.u1_id), {self.m2_id})
+        self.assertEqual(TimelineDemotion.query.count(), 0)
+
+    def test_unfollow_demotes_celebrity(self):
+        """Tests an account an unfollow takes below the threshold is queued
+        to be fanned out"""
+        self.assert_demoted(
+            self.leave_celebrity(f'/users/stop-following/{self.u2_id}'))
+
+    def test_follower_deletion_demotes_celebrity(self):
+        """Tests an account a follower's deletion takes below the threshold
+        is queued to be fanned out"""
+        self.assert_demoted(self.leave_celebrity('/users/delete'))
+
+    def test_backfill_recent_messages(self):
+        """Tests following copies only each account's newest messages"""
+        app.config['TIMELINE_BACKFILL_MESSAGES'] = 2
+        posted = datetime.datetime(2020, 1, 1)
+        messages = [
+            Message(text=f"m3-{i}", user_id=self.u3_id,
+                    timestamp=posted + datetime.timedelta(days=i))
+            for i in range(3)]
+        db.session.add_all(messages)
+        db.session.commit()
+        m3_ids = [message.id for message in messages]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post('/api/follows', json={"user_ids": [self.u2_id, self.u3_id]})
+
+        self.assertEqual(self.timeline_ids(self.u1_id),
+                         {self.m2_id, *m3_ids[1:]})
+
+    def test_rebuild(self):
+        """Tests rebuilding recreates timelines from follows"""
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        u1.following.append(u2)
+        db.session.commit()
+
+        with app.app_context():
+            count = timeline.rebuild()
+            db.session.commit()
+
+        self.assertEqual(count, 2)
+        self.assertEqual(self.timeline_ids(self.u1_id), {self.m2_id})
+        self.assertEqual(self.timeline_ids(self.u2_id), {self.m2_id})
@@ -0,0 +1,163 @@
+"""Message soft-delete and compaction tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_tombstones.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Like, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import tombstones
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TombstoneTestCase(TestCase):
+    def setUp(self):
+        app.config['MESSAGE_SOFT_DELETE'] = True
+        app.config['TIMELINE_MODE'] = "write"
+
+        User.query.delete()
+
+        author = User.signup("author", "author@email.com", "password", None)
+        reader = User.signup("reader", "reader@email.com", "password", None)
+        db.session.commit()
+        self.author_id = author.id
+        self.reader_id = reader.id
+
+        db.session.add(Follows(user_being_followed_id=author.id,
+                               user_following_id=reader.id))
+        User.reconcile_counts()
+        db.session.commit()
+
+        self.author = self.client_for(self.author_id)
+        self.reader = self.client_for(self.reader_id)
+
+        for i in range(3):
+            self.author.post("/messages/new", data={"text": f"tombstone {i}"})
+        self.message_ids = [
+            message_id for (message_id,) in
+            db.session.query(Message.id)
+            .filter(Message.user_id == self.author_id)
+            .order_by(Message.id)]
+
+        self.reader.post("/api/likes", json={"message_ids": self.message_ids})
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['MESSAGE_SOFT_DELETE'] = False
+        app.config['TIMELINE_MODE'] = "read"
+
+    def client_for(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client
+
+    def counts(self, user_id):
+        user = User.query.get(user_id)
+        db.session.expire_all()
+        return user.messages_count, user.likes_count
+
+    def delete(self, index):
+        self.author.post(f"/messages/{self.message_ids[index]}/delete")
+
+    def test_soft_delete_hides_message(self):
+        """Tests a tombstoned message is left out of every page"""
+        self.delete(0)
+        message_id = self.message_ids[0]
+
+        self.assertIsNotNone(
+            Message.query.execution_options(include_deleted=True)
+            .get(message_id).deleted_at)
+        self.assertIsNone(Message.query.get(message_id))
+
+        pages = [
+            self.reader.get("/"),
+            self.reader.get(f"/users/{self.author_id}"),
+            self.reader.get(f"/users/{self.reader_id}/likes"),
+            self.reader.get("/messages/search?q=tombstone"),
+        ]
+        for resp in pages:
+            html = resp.get_data(as_text=True)
+            self.assertNotIn("tombstone 0", html)
+            self.assertIn("tombstone 1", html)
+
+        data = self.reader.get("/api/timeline").get_json()
+        self.assertNotIn(message_id, [msg["id"] for msg in data["messages"]])
+
+        self.assertEqual(
+            self.reader.get(f"/messages/{message_id}").status_code, 404)
+        self.assertEqual(
+            self.author.post(f"/messages/{message_id}/delete").status_code,
+            404)
+
+    def test_tombstone_cannot_be_liked(self):
+        """Tests likes of a tombstoned message are refused"""
+        self.reader.delete("/api/likes", json={"message_ids": self.message_ids})
+        self.delete(0)
+
+        resp = self.reader.post(
+            "/api/likes", json={"message_ids": self.message_ids[:1]})
+
+        self.assertEqual(resp.get_json()["results"][0]["status"], "not_found")
+        self.assertEqual(Like.query.count(), 0)
+
+    def test_counters(self):
+        """Tests the author's count drops at once and likers' counts at
+        compaction, matching reconcile_counts throughout"""
+        self.delete(0)
+
+        self.assertEqual(self.counts(self.author_id), (2, 0))
+        self.assertEqual(self.counts(self.reader_id), (0, 3))
+        self.assertEqual(User.reconcile_counts(), 0)
+
+        with app.app_context():
+            tombstones.compact(report=lambda line: None)
+
+        self.assertEqual(self.counts(self.reader_id), (0, 2))
+        self.assertEqual(User.reconcile_counts(), 0)
+
+    def test_compact_in_batches(self):
+        """Tests compaction deletes tombstones with their likes and timeline
+        entries, a batch at a time"""
+        self.delete(0)
+        self.delete(2)
+        lines = []
+
+        with app.app_context():
+            count = tombstones.compact(1, report=lines.append)
+
+        self.assertEqual(count, 2)
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(
+            [message_id for (message_id,) in db.session.execute(
+                db.select(Message.id).execution_options(include_deleted=True)
+                .where(Message.user_id == self.author_id))],
+            self.message_ids[1:2])
+        self.assertEqual(
+            [like.message_id for like in Like.query.all()],
+            self.message_ids[1:2])
+        self.assertEqual(
+            {entry.message_id for entry in TimelineEntry.query},
+            {self.message_ids[1]})
+
+    def test_hard_delete_when_off(self):
+        """Tests messages are deleted straight away without soft delete"""
+        app.config['MESSAGE_SOFT_DELETE'] = False
+        self.delete(0)
+
+        self.assertIsNone(
+            Message.query.execution_options(include_deleted=True)
+            .get(self.message_ids[0]))
+        self.assertEqual(self.counts(self.reader_id), (0, 2))
@@ -3,6 +3,7 @@
 
 from codecs import utf_32_be_decode
 import os
+import re
 from unittest import TestCase
 
 from models import db, User, Message, Like
@@ -309,6 +310,27 @@ class GeneralUserRoutesTestCase(UserBaseViewTestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Test Likes", html)
 
+    def test_likes_page_idempotency_key(self):
+        """Tests unliking from the likes page twice with its form's key
+        toggles once"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/users/{self.u2_id}/{self.m2_id}/likes')
+
+            html = c.get(f'/users/{self.u1_id}/likes').get_data(as_text=True)
+            key = re.search(
+                r'name="idempotency_key" value="([^"]+)"', html).group(1)
+
+            for i in range(2):
+                c.post(f'/users/{self.u1_id}/{self.m2_id}/likes',
+                       data={"idempotency_key": key})
+
+            u1 = User.query.get(self.u1_id)
+            self.assertEqual(u1.likes, [])
+            self.assertEqual(u1.likes_count, 0)
+
     def test_user_not_in_session(self):
         """Tests displaying signup page when no user in session"""
 
@@ -0,0 +1,368 @@
+"""Precomputed (fan-out-on-write) home timelines for Warbler.
+
+TIMELINE_MODE selects how the home page is built:
+
+- "read":   (default) query followed users' messages on every page view
+- "write":  copy each new message into its followers' `timeline_entries`
+            when it is posted, so home reads one indexed range
+- "hybrid": like "write", except accounts with at least
+            TIMELINE_CELEBRITY_FOLLOWERS followers are not fanned out; their
+            messages are merged in at read time instead
+
+Following someone copies only their TIMELINE_BACKFILL_MESSAGES most recent
+messages into the follower's timeline, so a follow costs the same however
+much they've posted; older ones are still on their profile.
+
+In hybrid mode, an account that falls below the threshold (through an
+unfollow or a follower's account being deleted) is queued in
+`timeline_demotions` in the same transaction, and `flask timeline-worker`
+copies its recent messages to its followers, a batch of followers per
+statement. Until then home pages keep merging it in at read time. Raising
+the setting demotes accounts without queueing them, so run
+`flask rebuild-timelines` after doing so.
+"""
+
+import time
+
+from flask import current_app
+from sqlalchemy import delete, or_, select, true
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, Follows, Message, TimelineDemotion, TimelineEntry, User
+from pagination import paginate
+
+# followers of a demoted account written per statement
+FOLLOWER_BATCH = 100
+
+FANOUT_MODES = ("write", "hybrid")
+
+
+def is_enabled():
+    """Is the precomputed timeline store being maintained and read?"""
+
+    return current_app.config['TIMELINE_MODE'] in FANOUT_MODES
+
+
+def _celebrity_threshold():
+    """Follower count at which an account is read on demand, or None."""
+
+    if current_app.config['TIMELINE_MODE'] != "hybrid":
+        return None
+
+    return current_app.config['TIMELINE_CELEBRITY_FOLLOWERS']
+
+
+def _celebrities(threshold):
+    """Select the ids of accounts with at least `threshold` followers."""
+
+    return select(User.id).where(User.followers_count >= threshold)
+
+
+def celebrities_among(user_ids):
+    """Return the subset of `user_ids` that are fanned out on read."""
+
+    threshold = _celebrity_threshold()
+    if threshold is None or not user_ids:
+        return set()
+
+    rows = db.session.execute(
+        _celebrities(threshold).where(User.id.in_(user_ids)))
+
+    return {user_id for (user_id,) in rows}
+
+
+def _insert_entries(select_stmt):
+    """Insert (user_id, message_id, author_id, timestamp) rows from a select,
+    skipping ones already present."""
+
+    stmt = (insert(TimelineEntry.__table__)
+            .from_select(
+                ["user_id", "message_id", "author_id", "timestamp"],
+                select_stmt)
+            .on_conflict_do_nothing())
+
+    return db.session.execute(stmt).rowcount
+
+
+def fan_out(message):
+    """Add a newly-posted (flushed) `message` to its timelines.
+
+    The author always gets their own message; followers get it unless the
+    author is a celebrity in hybrid mode.
+    """
+
+    if not is_enabled():
+        return
+
+    author_id = message.user_id
+
+    db.session.add(TimelineEntry(
+        user_id=author_id,
+        message_id=message.id,
+        author_id=author_id,
+        timestamp=message.timestamp,
+    ))
+
+    if celebrities_among([author_id]):
+        return
+
+    _insert_entries(
+        select(
+            Follows.user_following_id,
+            db.literal(message.id),
+            db.literal(author_id),
+            db.literal(message.timestamp),
+        )
+        .where(Follows.user_being_followed_id == author_id))
+
+
+def _recent_messages(author_id):
+    """The TIMELINE_BACKFILL_MESSAGES newest messages by `author_id` (a
+    value or a column of the enclosing query), as a LATERAL subquery."""
+
+    return (select(Message.id, Message.user_id, Message.timestamp)
+            .where(Message.user_id == author_id,
+                   Message.deleted_at.is_(None))
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(current_app.config['TIMELINE_BACKFILL_MESSAGES'])
+            .lateral())
+
+
+def backfill(follower_id, followed_ids):
+    """Copy the recent messages of the users in `followed_ids` into
+    `follower_id`'s timeline after new follows."""
+
+    if not is_enabled():
+        return
+
+    followed_ids = set(followed_ids) - celebrities_among(followed_ids)
+    if not followed_ids:
+        return
+
+    recent = _recent_messages(User.id)
+
+    _insert_entries(
+        select(
+            db.literal(follower_id),
+            recent.c.id,
+            recent.c.user_id,
+            recent.c.timestamp,
+        )
+        .select_from(User)
+        .join(recent, true())
+        .where(User.id.in_(followed_ids)))
+
+
+def queue_demotions(user_ids):
+    """Queue the users in `user_ids` who just fell below the celebrity
+    threshold, for a worker to copy their recent messages to their
+    followers.
+
+    Call after taking one off their followers_count: those now one short of
+    the threshold were read on demand until then, so their followers'
+    timelines hold none of their messages. `user_ids` may be a select.
+    """
+
+    threshold = _celebrity_threshold()
+    if threshold is None:
+        return
+
+    db.session.execute(
+        insert(TimelineDemotion.__table__)
+        .from_select(
+            ["user_id"],
+            select(User.id)
+            .where(User.id.in_(user_ids),
+                   User.followers_count == threshold - 1))
+        .on_conflict_do_nothing())
+
+
+def read_on_demand_among(user_ids):
+    """Return the subset of `user_ids` whose messages home pages merge in at
+    read time: celebrities, and demoted accounts not yet fanned out."""
+
+    threshold = _celebrity_threshold()
+    if threshold is None or not user_ids:
+        return set()
+
+    rows = db.session.execute(
+        select(User.id)
+        .where(User.id.in_(user_ids),
+               or_(User.followers_count >= threshold,
+                   User.id.in_(select(TimelineDemotion.user_id)))))
+
+    return {user_id for (user_id,) in rows}
+
+
+def _fan_out_recent(user_id):
+    """Copy `user_id`'s recent messages into each of their followers'
+    timelines, FOLLOWER_BATCH followers per statement; returns the number
+    of entries written."""
+
+    recent = _recent_messages(user_id)
+    written = 0
+    last_id = 0
+
+    while True:
+        follower_ids = db.session.scalars(
+            select(Follows.user_following_id)
+            .where(Follows.user_being_followed_id == user_id,
+                   Follows.user_following_id > last_id)
+            .order_by(Follows.user_following_id)
+            .limit(FOLLOWER_BATCH)).all()
+
+        if not follower_ids:
+            return written
+
+        written += _insert_entries(
+            select(
+                User.id,
+                recent.c.id,
+                recent.c.user_id,
+                recent.c.timestamp,
+            )
+            .select_from(User)
+            .join(recent, true())
+            .where(User.id.in_(follower_ids)))
+        last_id = follower_ids[-1]
+
+
+def process_demotions(limit=10):
+    """Claim up to `limit` queued demotions, oldest first, fan out the
+    accounts still below the threshold, and commit. Returns how many were
+    claimed."""
+
+    oldest = (select(TimelineDemotion.user_id)
+              .order_by(TimelineDemotion.queued_at)
+              .limit(limit)
+              .with_for_update(skip_locked=True))
+
+    claimed = db.session.scalars(
+        delete(TimelineDemotion)
+        .where(TimelineDemotion.user_id.in_(oldest))
+        .returning(TimelineDemotion.user_id)
+        .execution_options(synchronize_session=False)).all()
+
+    if is_enabled():
+        # accounts promoted again since are still read on demand
+        for user_id in sorted(set(claimed) - celebrities_among(claimed)):
+            _fan_out_recent(user_id)
+
+    db.session.commit()
+
+    return len(claimed)
+
+
+def run_worker(batch=10, interval=1.0, once=False, report=print):
+    """Fan out queued demotions as they arrive, polling every `interval`
+    seconds when the queue is empty; with `once`, stop when it is."""
+
+    while True:
+        applied = process_demotions(batch)
+
+        if applied:
+            report(f"Fanned out {applied} demoted accounts")
+        elif once:
+            return
+        else:
+            time.sleep(interval)
+
+
+def prune(follower_id, followed_ids):
+    """Remove the messages of the users in `followed_ids` from
+    `follower_id`'s timeline after unfollows."""
+
+    if not is_enabled() or not followed_ids:
+        return
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.user_id == follower_id,
+             TimelineEntry.author_id.in_(followed_ids))
+     .delete(synchronize_session=False))
+
+
+def message_cursor(message):
+    """Keyset pagination values for a message: (timestamp, id)."""
+
+    return (message.timestamp, message.id)
+
+
+def home_page(user):
+    """Return the current pagination.Page of `user`'s home timeline.
+
+    Reads the precomputed timeline when enabled, merging in any followed
+    celebrities' messages on demand; otherwise queries every followed
+    user's messages.
+    """
+
+    followed_ids = [
+        user_id for (user_id,) in
+        db.session
+        .query(Follows.user_being_followed_id)
+        .filter(Follows.user_following_id == user.id)
+    ]
+
+    if not is_enabled():
+        messages = (Message
+                    .query
+                    .options(db.selectinload(Message.user))
+                    .filter(Message.user_id.in_(followed_ids + [user.id])))
+
+        return paginate(
+            messages, (Message.timestamp, Message.id), message_cursor)
+
+    celebrity_ids = read_on_demand_among(followed_ids)
+
+    messages = (Message
+                .query
+                .options(db.selectinload(Message.user))
+                .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+                .filter(TimelineEntry.user_id == user.id))
+
+    if not celebrity_ids:
+        return paginate(
+            messages,
+            (TimelineEntry.timestamp, TimelineEntry.message_id),
+            message_cursor)
+
+    on_read = Message.query.filter(Message.user_id.in_(celebrity_ids))
+
+    return paginate(
+        messages.union(on_read).options(db.selectinload(Message.user)),
+        (Message.timestamp, Message.id),
+        message_cursor)
+
+
+def rebuild():
+    """Recompute every timeline from follows and messages.
+
+    Returns the number of entries written.
+    """
+
+    TimelineEntry.query.delete(synchronize_session=False)
+    db.session.execute(delete(TimelineDemotion))
+
+    if not is_enabled():
+        return 0
+
+    own = _insert_entries(
+        select(Message.user_id, Message.id, Message.user_id,
+               Message.timestamp)
+        .where(Message.user_id.isnot(None), Message.deleted_at.is_(None)))
+
+    fanned = (select(
+                Follows.user_following_id,
+                Message.id,
+                Message.user_id,
+                Message.timestamp)
+              .select_from(Message)
+              .join(Follows,
+                    Follows.user_being_followed_id == Message.user_id)
+              .where(Message.deleted_at.is_(None)))
+
+    threshold = _celebrity_threshold()
+    if threshold is not None:
+        fanned = fanned.where(Message.user_id.notin_(_celebrities(threshold)))
+
+    return own + _insert_entries(fanned)
@@ -0,0 +1,111 @@
+"""Soft-deleted messages ("tombstones") and their compaction.
+
+With MESSAGE_SOFT_DELETE on, deleting a message only sets its `deleted_at`.
+That is one UPDATE, plus the author's messages_count. From then on every
+ORM query leaves the message out (see models._hide_deleted_messages):
+lists, timelines, search, likes pages and lookups by id.
+
+Everything else is left for compaction, run periodically off the request
+path (`flask compact-messages`). It deletes tombstones in batches of
+MESSAGE_COMPACT_BATCH, one transaction each. Their likes and timeline
+entries go with them by ON DELETE CASCADE, and the likers' likes_count is
+fixed with one UPDATE per batch. Until then a user's likes_count still
+includes their likes of tombstoned messages.
+
+With the setting off (the default), messages are deleted straight away.
+"""
+
+import time
+
+from flask import current_app
+from sqlalchemy import any_, bindparam, delete, func, select, update
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from models import db, Like, Message, User
+
+
+def is_enabled():
+    return current_app.config['MESSAGE_SOFT_DELETE']
+
+
+def soft_delete(message):
+    """Tombstone `message` and take it off its author's count; returns
+    False if it already was."""
+
+    messages = Message.__table__
+
+    deleted = db.session.execute(
+        update(messages)
+        .where(messages.c.id == message.id, messages.c.deleted_at.is_(None))
+        .values(deleted_at=func.now())).rowcount
+
+    if deleted:
+        User.update_counts(User.id == message.user_id, messages_count=-1)
+
+    return bool(deleted)
+
+
+def hard_delete(message):
+    """Delete `message` now, with its likes (and their counters) and
+    timeline entries."""
+
+    User.update_counts(User.id == message.user_id, messages_count=-1)
+    User.update_counts(
+        User.id.in_(
+            select(Like.user_id).where(Like.message_id == message.id)),
+        likes_count=-1)
+    db.session.delete(message)
+
+
+def compact_batch(batch_size):
+    """Delete up to `batch_size` tombstones, skipping any another compaction
+    has locked; returns how many."""
+
+    messages = Message.__table__
+
+    ids = db.session.scalars(
+        select(messages.c.id)
+        .where(messages.c.deleted_at.isnot(None))
+        .order_by(messages.c.deleted_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+        .execution_options(include_deleted=True)).all()
+
+    if not ids:
+        return 0
+
+    batch = bindparam("ids", ids, type_=ARRAY(db.Integer))
+
+    likers = (select(Like.user_id, func.count().label("likes"))
+              .where(Like.message_id == any_(batch))
+              .group_by(Like.user_id)
+              .subquery())
+    db.session.execute(
+        update(User.__table__)
+        .where(User.id == likers.c.user_id)
+        .values(likes_count=User.likes_count - likers.c.likes))
+
+    db.session.execute(delete(messages).where(messages.c.id == any_(batch)))
+
+    return len(ids)
+
+
+def compact(batch_size=None, report=print):
+    """Delete every tombstone, a batch per transaction; returns how many."""
+
+    batch_size = batch_size or current_app.config['MESSAGE_COMPACT_BATCH']
+    total = 0
+    started = time.monotonic()
+
+    while True:
+        count = compact_batch(batch_size)
+        db.session.commit()
+
+        if not count:
+            break
+
+        total += count
+        report(f"Compacted {total} messages "
+               f"({time.monotonic() - started:.1f}s)")
+
+    return total